@@ -0,0 +1,86 @@
+# In-memory audio for running a redub without intermediate files.
+# Stages pass around keys like 'memory://name_(Vocals)' in place of file paths. The audio behind
+# a key is a pydub AudioSegment held in memory, so stage functions can accept either.
+import numpy as np
+from pydub import AudioSegment
+
+MEMORY_PREFIX = 'memory://'
+memory_audio = {} # Key -> AudioSegment
+
+def is_memory_audio(path):
+    return isinstance(path, str) and path.startswith(MEMORY_PREFIX)
+
+# Stores the audio and returns the key that stands in for its filename
+def register(name : str, audio : AudioSegment):
+    key = MEMORY_PREFIX + name
+    memory_audio[key] = audio
+    return key
+
+def clear():
+    memory_audio.clear()
+
+# Frees the audio of one job. Every key a job registers is derived from its input's name, i.e. '1_song_(Vocals)_segment_3.wav'.
+def release(name : str):
+    key = MEMORY_PREFIX + name
+    for existing in [existing for existing in memory_audio if existing == key or existing.startswith(key + '_')]:
+        del memory_audio[existing]
+
+# Returns an AudioSegment for either a memory key or a file
+def load_segment(path : str):
+    if is_memory_audio(path):
+        return memory_audio[path]
+    return AudioSegment.from_file(path)
+
+# Converts an AudioSegment to a (channels, samples) float32 array in [-1, 1]
+def segment_to_array(segment : AudioSegment):
+    samples = np.array(segment.get_array_of_samples(), dtype=np.float32).reshape(-1, segment.channels).T
+    return samples / float(1 << (8 * segment.sample_width - 1))
+
+# Converts a (channels, samples) or (samples,) float array to a 32 bit AudioSegment so no precision is lost between stages
+def array_to_segment(samples, sample_rate : int):
+    samples = np.atleast_2d(np.asarray(samples, dtype=np.float64))
+    pcm = (np.clip(samples, -1.0, 1.0) * 2147483647).astype(np.int32)
+    return AudioSegment(pcm.T.tobytes(), frame_rate=sample_rate, sample_width=4, channels=samples.shape[0])
+
+# (channels, samples) float32 array and its sample rate, without resampling. Files are read with soundfile, which is much faster than pydub.
+def load_samples(path : str):
+    if is_memory_audio(path):
+        segment = memory_audio[path]
+        return segment_to_array(segment), segment.frame_rate
+    import soundfile as sf
+    samples, sample_rate = sf.read(path, dtype='float32', always_2d=True)
+    return samples.T, sample_rate
+
+# (channels, samples) float32 array at the requested rate, resampled with librosa since pydub's resampler is low quality
+def load_array(path : str, sample_rate : int, channels = 2):
+    import librosa
+    segment = load_segment(path).set_channels(channels)
+    samples = segment_to_array(segment)
+    if segment.frame_rate != sample_rate:
+        samples = librosa.resample(samples, orig_sr=segment.frame_rate, target_sr=sample_rate)
+    return samples
+
+# Mono float32 samples at the requested rate, the same as librosa.load(path, sr=sample_rate) would give for a file
+def load_mono(path : str, sample_rate : int):
+    import librosa
+    segment = memory_audio[path]
+    samples = segment_to_array(segment).mean(axis=0)
+    if segment.frame_rate != sample_rate:
+        samples = librosa.resample(samples, orig_sr=segment.frame_rate, target_sr=sample_rate)
+    return samples
+
+# Stand-in for Amphion's load_wav(), which returns the 24 kHz samples and 24 kHz and 16 kHz tensors
+def load_wav(path : str, device):
+    import torch
+    speech = load_mono(path, 24000)
+    speech_tensor = torch.tensor(speech).unsqueeze(0).to(device)
+    speech16k = torch.tensor(load_mono(path, 16000)).unsqueeze(0).to(device)
+    return speech, speech_tensor, speech16k
+
+# Raw PCM bytes for piping into ffmpeg, along with the ffmpeg format, sample rate and channel count
+def to_raw_pcm(path : str):
+    segment = load_segment(path)
+    if segment.sample_width not in [2, 4]:
+        segment = segment.set_sample_width(2)
+    pcm_format = 's16le' if segment.sample_width == 2 else 's32le'
+    return segment.raw_data, pcm_format, segment.frame_rate, segment.channels
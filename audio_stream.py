@@ -0,0 +1,82 @@
+# Reads and writes audio a block at a time through ffmpeg pipes, so long inputs never have to fit in memory.
+# Blocks are (channels, samples) float32 arrays. In-memory audio gets the same interface over an array.
+import subprocess
+import numpy as np
+import audio_buffers
+
+# Decodes anything ffmpeg can read at the requested sample rate and channel count
+class AudioReader():
+    def __init__(self, filename : str, sample_rate : int, channels = 2):
+        self.filename = filename
+        self.channels = channels
+        self.finished = False
+        ffmpeg_cmd = ["ffmpeg", '-hide_banner', '-loglevel', 'error', '-i', filename, '-vn', '-f', 'f32le', '-acodec', 'pcm_f32le', '-ac', str(channels), '-ar', str(sample_rate), 'pipe:1']
+        self.process = subprocess.Popen(ffmpeg_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    # Returns up to the requested number of samples, fewer only at the end of the input
+    def read(self, samples : int):
+        data = self.process.stdout.read(samples * self.channels * 4)
+        if len(data) < samples * self.channels * 4:
+            self.finished = True
+        return np.frombuffer(data, dtype=np.float32).reshape(-1, self.channels).T
+
+    def close(self):
+        self.process.stdout.close()
+        if not self.finished: # Stopped reading early, ffmpeg doesn't need to finish
+            self.process.kill()
+            self.process.wait()
+            return
+        stderr = self.process.stderr.read()
+        if self.process.wait() != 0:
+            print(stderr.decode(errors='replace'))
+            raise RuntimeError('Error decoding "{}". ffmpeg return code: {}'.format(self.filename, self.process.returncode))
+
+# Same interface as AudioReader for audio that's already in memory
+class ArrayReader():
+    def __init__(self, samples):
+        self.samples = samples
+        self.position = 0
+
+    def read(self, samples : int):
+        block = self.samples[:, self.position:self.position + samples]
+        self.position += block.shape[1]
+        return block
+
+    def close(self):
+        pass
+
+def open_reader(path : str, sample_rate : int, channels = 2):
+    if audio_buffers.is_memory_audio(path):
+        return ArrayReader(audio_buffers.load_array(path, sample_rate, channels))
+    return AudioReader(path, sample_rate, channels)
+
+# Encodes blocks to a file with ffmpeg. codec_args are ffmpeg output options, i.e. ['-b:a', '128k'].
+class AudioEncoder():
+    def __init__(self, filename : str, sample_rate : int, channels = 2, codec_args = []):
+        self.filename = filename
+        ffmpeg_cmd = ["ffmpeg", '-hide_banner', '-loglevel', 'error', '-y', '-f', 'f32le', '-ar', str(sample_rate), '-ac', str(channels), '-i', 'pipe:0', *codec_args, filename]
+        self.process = subprocess.Popen(ffmpeg_cmd, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def write(self, block):
+        self.process.stdin.write(np.ascontiguousarray(block.T, dtype=np.float32).tobytes())
+
+    def close(self):
+        self.process.stdin.close()
+        stderr = self.process.stderr.read()
+        if self.process.wait() != 0:
+            print(stderr.decode(errors='replace'))
+            raise RuntimeError('Error encoding "{}". ffmpeg return code: {}'.format(self.filename, self.process.returncode))
+
+# Collects blocks in memory, for when the output stays in memory
+class ArrayWriter():
+    def __init__(self, channels = 2):
+        self.blocks = []
+        self.channels = channels
+
+    def write(self, block):
+        self.blocks.append(block)
+
+    def get_samples(self):
+        if len(self.blocks) == 0:
+            return np.zeros((self.channels, 0), dtype=np.float32)
+        return np.concatenate(self.blocks, axis=1)
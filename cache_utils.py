@@ -0,0 +1,31 @@
+# Helpers shared by the on-disk caches
+import hashlib
+import os
+
+CACHE_DIR = './models/cache'
+
+# Hashes the contents of a file in chunks so large files don't have to fit in memory
+def hash_file(filename : str, chunk_size = 1024 * 1024):
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+# Hashes a sequence of strings into one key
+def hash_key(*parts):
+    sha = hashlib.sha256()
+    for part in parts:
+        sha.update(str(part).encode('utf-8'))
+        sha.update(b'\0')
+    return sha.hexdigest()
+
+# Identifies an input file by its path, size and modification time, which is much cheaper than hashing a long video
+def get_input_key(input_filename : str):
+    stat = os.stat(input_filename)
+    return hash_key(os.path.abspath(input_filename), stat.st_size, stat.st_mtime_ns)
+
+def get_cache_dir(*subdirs):
+    cache_dir = os.path.join(CACHE_DIR, *subdirs)
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
@@ -0,0 +1,126 @@
+# Opt-in settings for running the Vevo pipelines on CPU, which otherwise run in fp32 with torch's default threading.
+# int8 dynamically quantizes the linear layers of the AR and flow matching transformers, which is where nearly all the
+# CPU time goes. bf16 autocasts the same transformers instead, which is faster on CPUs with native bf16 support
+# (AVX512-BF16/AMX). The tokenizers, mel extraction and vocoder stay in fp32 either way.
+# The two aren't combined, since the quantized layers only take fp32 input. Neither applies when a GPU is used.
+# "python cpu_inference.py" converts a clip with each precision and reports the error against fp32 and the throughput.
+import argparse
+import functools
+import time
+import torch
+
+CPU_PRECISIONS = ['fp32', 'int8', 'bf16']
+# The tokenizers and vocoder are mostly convolutions, which dynamic quantization doesn't cover
+TRANSFORMER_MODELS = ['ar_model', 'fmt_model']
+
+cpu_precision = 'fp32'
+# Sets the precision for pipelines loaded from now on, and torch's thread counts if given
+def configure(precision = 'fp32', threads = None, interop_threads = None):
+    global cpu_precision
+    if precision not in CPU_PRECISIONS:
+        raise RuntimeError("Unsupported CPU precision '{}'. Use one of {}.".format(precision, ', '.join(CPU_PRECISIONS)))
+    cpu_precision = precision
+    if threads is not None:
+        torch.set_num_threads(threads)
+    if interop_threads is not None:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError: # Only possible before torch starts any inter-op work
+            print('Warning: Inter-op threads were already started, keeping {}.'.format(torch.get_num_interop_threads()))
+
+# Runs a module's forward() under bf16 autocast. Its outputs can be bf16, which the fp32 code around it promotes back.
+def autocast_module(module):
+    forward = module.forward
+    @functools.wraps(forward)
+    def autocast_forward(*args, **kwargs):
+        with torch.autocast('cpu', dtype=torch.bfloat16):
+            return forward(*args, **kwargs)
+    module.forward = autocast_forward
+
+# Undoes autocast_module() on the transformers' submodules
+def remove_autocast(model):
+    for module in model.children():
+        vars(module).pop('forward', None)
+
+# Quantizes or autocasts a freshly loaded pipeline's transformers if it's on CPU and int8 or bf16 is configured.
+# bf16 wraps the transformers' submodules rather than the models, since the pipelines call into them at different places.
+# The precision is added to the model version, so the feature caches don't mix outputs of different precisions.
+def optimize_pipeline(pipeline, precision = None):
+    precision = precision if precision is not None else cpu_precision
+    pipeline.cpu_precision = precision if torch.device(pipeline.device).type == 'cpu' else 'fp32'
+    for name in TRANSFORMER_MODELS:
+        model = getattr(pipeline, name, None)
+        if model is not None and pipeline.cpu_precision == 'int8':
+            setattr(pipeline, name, torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8))
+        elif model is not None and pipeline.cpu_precision == 'bf16':
+            for module in model.children():
+                autocast_module(module)
+    if pipeline.cpu_precision != 'fp32':
+        pipeline.model_version = '{}-{}'.format(pipeline.model_version, pipeline.cpu_precision)
+        print('Running vevo on CPU in {} with {} threads.'.format(pipeline.cpu_precision, torch.get_num_threads()))
+    return pipeline
+
+# Converts the clip in timbre mode from a fixed seed, so every precision starts from the same noise.
+# Returns the output audio, its mel spectrogram and the seconds it took.
+def convert_clip(pipeline, clip : str, reference : str, steps : int, solver = 'euler', schedule = 'uniform'):
+    from vevo_cli import extract_codecs, inference_fm_batch, vevo_utils
+    start_time = time.perf_counter()
+    with torch.no_grad():
+        _, ref_speech24k, ref_speech16k = vevo_utils.load_wav(reference, pipeline.device)
+        ref_codecs = extract_codecs(pipeline, ref_speech16k)
+        prompt_mel = pipeline.extract_mel_feature(ref_speech24k)
+        src_codecs = extract_codecs(pipeline, vevo_utils.load_wav(clip, pipeline.device)[2])
+        gen_audio = inference_fm_batch(pipeline, [src_codecs], ref_codecs, prompt_mel, steps, [0], solver, schedule)[0]
+    elapsed = time.perf_counter() - start_time
+    with torch.no_grad():
+        mel = pipeline.extract_mel_feature(gen_audio.reshape(1, -1).to(pipeline.device)).cpu()
+    return gen_audio, mel, elapsed
+
+# Converts a clip in fp32 and each other precision, then reports how far each output's mel spectrogram is from fp32's
+# and how many seconds of audio each converts per second. Waveforms aren't compared, since the vocoder's phase can
+# drift without the output sounding any different.
+def benchmark(clip : str, reference : str, steps = 32, precisions = ('int8', 'bf16'), repeats = 2):
+    import vevo_cli
+    configure('fp32')
+    pipeline = vevo_cli.load_model()
+    if torch.device(pipeline.device).type != 'cpu':
+        raise RuntimeError('The CPU benchmark needs a CPU-only torch build, or CUDA_VISIBLE_DEVICES="".')
+    fp32_models = {name: getattr(pipeline, name) for name in TRANSFORMER_MODELS if hasattr(pipeline, name)}
+    results = []
+    reference_mel = None
+    for precision in ['fp32'] + list(precisions):
+        for name, model in fp32_models.items():
+            remove_autocast(model)
+            setattr(pipeline, name, model)
+        pipeline.model_version = 'benchmark'
+        optimize_pipeline(pipeline, precision)
+        convert_clip(pipeline, clip, reference, steps) # Warm up
+        timings = []
+        for _ in range(repeats):
+            gen_audio, mel, elapsed = convert_clip(pipeline, clip, reference, steps)
+            timings.append(elapsed)
+        if reference_mel is None:
+            reference_mel = mel
+        length = min(mel.shape[1], reference_mel.shape[1])
+        mel_error = (mel[:, :length] - reference_mel[:, :length]).abs().mean().item()
+        mel_snr = 10 * torch.log10(reference_mel[:, :length].pow(2).sum() / (mel[:, :length] - reference_mel[:, :length]).pow(2).sum().clamp(min=1e-12)).item()
+        audio_seconds = gen_audio.shape[-1] / vevo_cli.VEVO_SAMPLE_RATE
+        results.append((precision, min(timings), audio_seconds / min(timings), mel_error, mel_snr))
+    print('Threads: {} intra-op, {} inter-op. {:.1f} seconds of audio, {} steps.'.format(torch.get_num_threads(), torch.get_num_interop_threads(), audio_seconds, steps))
+    print('{:<10}{:>12}{:>14}{:>14}{:>12}'.format('precision', 'seconds', 'x realtime', 'mel error', 'mel SNR'))
+    for precision, seconds, realtime, mel_error, mel_snr in results:
+        snr = '{:.1f} dB'.format(mel_snr) if precision != 'fp32' else '-'
+        print('{:<10}{:>12.2f}{:>14.3f}{:>14.4f}{:>12}'.format(precision, seconds, realtime, mel_error, snr))
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='cpu_inference.py', description='Compares Vevo CPU precisions against fp32 for accuracy and speed.')
+    parser.add_argument('-i', '--input', type=str, required=True, help='Vocal clip to convert, ideally 5-10 seconds')
+    parser.add_argument('-v', '--reference_voice', type=str, required=True, help='Voice reference to convert with')
+    parser.add_argument('--steps', type=int, default=32, help='Flow matching steps. Default is 32.')
+    parser.add_argument('--repeats', type=int, default=2, help='Timed runs per precision, the fastest is reported. Default is 2.')
+    parser.add_argument('--cpu_threads', type=int, help='Intra-op threads. Default is torch\'s default.')
+    parser.add_argument('--cpu_interop_threads', type=int, help='Inter-op threads. Default is torch\'s default.')
+    args = parser.parse_args()
+    configure('fp32', args.cpu_threads, args.cpu_interop_threads)
+    benchmark(args.input, args.reference_voice, args.steps, repeats=args.repeats)
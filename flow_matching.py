@@ -0,0 +1,138 @@
+# Batched version of Amphion's FlowMatchingTransformer.reverse_diffusion().
+# The original samples one item at a time and normalizes classifier-free guidance with the std of the
+# whole batch, so several segments can't share a forward pass without changing each other's output.
+# This copy pads the segments to a common length, masks the padding out of the attention and
+# the guidance statistics, and draws each segment's noise from its own seed.
+# It also offers other ODE solvers and step schedules than Amphion's Euler steps, which can get the same quality
+# out of fewer steps. solver_context() swaps them into the pipelines' own inference_fm() and inference_ar_and_fm().
+# "python flow_matching.py" measures each solver's quality against 48 Euler steps and its speed.
+import argparse
+import contextlib
+import math
+import torch
+
+# reverse_diffusion() defaults in Amphion, which the pipelines don't override
+DEFAULT_CFG = 1.0
+DEFAULT_RESCALE_CFG = 0.75
+
+# euler is Amphion's sampler. midpoint and heun are second order and evaluate the model twice per step.
+SOLVERS = ['euler', 'midpoint', 'heun']
+# cosine takes smaller steps at both ends of the trajectory, where the flow changes fastest
+SCHEDULES = ['uniform', 'cosine']
+
+# Unbiased std over the valid frames of each item, matching tensor.std() on an unpadded item
+def masked_std(x : torch.Tensor, x_mask : torch.Tensor):
+    mask = x_mask.unsqueeze(-1).to(x.dtype)
+    count = mask.sum(dim=(1, 2)) * x.shape[-1]
+    mean = (x * mask).sum(dim=(1, 2)) / count
+    var = (((x - mean[:, None, None]) * mask) ** 2).sum(dim=(1, 2)) / (count - 1)
+    return var.sqrt()[:, None, None]
+
+# Predicts the flow at time t, with the same guidance as the original reverse_diffusion()
+def estimate_flow(fmt_model, xt, t, prompt, cond, x_mask, xt_mask, cfg, rescale_cfg):
+    prompt_len = prompt.shape[1]
+    xt_input = torch.cat([prompt, xt], dim=1)
+    flow_pred = fmt_model.diff_estimator(xt_input, t, cond, xt_mask)
+    flow_pred = flow_pred[:, prompt_len:, :]
+    if cfg > 0:
+        uncond_flow_pred = fmt_model.diff_estimator(xt, t, torch.zeros_like(cond)[:, : xt.shape[1], :], x_mask)
+        pos_flow_pred_std = masked_std(flow_pred, x_mask)
+        flow_pred_cfg = flow_pred + cfg * (flow_pred - uncond_flow_pred)
+        rescale_flow_pred = flow_pred_cfg * pos_flow_pred_std / masked_std(flow_pred_cfg, x_mask)
+        flow_pred = rescale_cfg * rescale_flow_pred + (1 - rescale_cfg) * flow_pred_cfg
+    return flow_pred * x_mask.unsqueeze(-1)
+
+# Draws the starting noise for each item from its own seed, so an item's output doesn't depend on what it's batched with
+def seeded_noise(lengths : list, seeds : list, mel_dim : int, dtype, device):
+    noise = torch.zeros((len(lengths), max(lengths), mel_dim), dtype=dtype)
+    for idx, (length, seed) in enumerate(zip(lengths, seeds)):
+        generator = torch.Generator().manual_seed(seed)
+        noise[idx, :length] = torch.randn((length, mel_dim), generator=generator, dtype=dtype)
+    return noise.to(device)
+
+# The n_timesteps + 1 times from 0 (noise) to 1 (mel) that the steps go between
+def get_timesteps(n_timesteps : int, schedule = 'uniform'):
+    if schedule == 'uniform':
+        return [i / n_timesteps for i in range(n_timesteps + 1)]
+    elif schedule == 'cosine':
+        return [(1 - math.cos(math.pi * i / n_timesteps)) / 2 for i in range(n_timesteps + 1)]
+    raise RuntimeError("Unrecognized step schedule '{}'. Use one of {}.".format(schedule, ', '.join(SCHEDULES)))
+
+# cond: (B, prompt_len + T, hidden) with padding at the end, prompt: (1 or B, prompt_len, mel_dim), x_mask: (B, T)
+@torch.no_grad()
+def reverse_diffusion(fmt_model, cond, prompt, x_mask, noise, n_timesteps : int, cfg = DEFAULT_CFG, rescale_cfg = DEFAULT_RESCALE_CFG, solver = 'euler', schedule = 'uniform'):
+    if solver not in SOLVERS:
+        raise RuntimeError("Unrecognized solver '{}'. Use one of {}.".format(solver, ', '.join(SOLVERS)))
+    batch_size = cond.shape[0]
+    prompt = prompt.expand(batch_size, -1, -1)
+    prompt_mask = torch.ones(batch_size, prompt.shape[1], dtype=x_mask.dtype, device=x_mask.device)
+    xt_mask = torch.cat([prompt_mask, x_mask], dim=1)
+    def flow(x, t):
+        t = t * torch.ones(batch_size, dtype=x.dtype, device=x.device)
+        return estimate_flow(fmt_model, x, t, prompt, cond, x_mask, xt_mask, cfg, rescale_cfg)
+    timesteps = get_timesteps(n_timesteps, schedule)
+    xt = noise
+    # t from 0 to 1: x0 = z ~ N(0, 1)
+    for t0, t1 in zip(timesteps[:-1], timesteps[1:]):
+        h = t1 - t0
+        if solver == 'euler': # Amphion evaluates the flow in the middle of the step
+            xt = xt + h * flow(xt, t0 + 0.5 * h)
+        elif solver == 'midpoint':
+            xt = xt + h * flow(xt + 0.5 * h * flow(xt, t0), t0 + 0.5 * h)
+        elif solver == 'heun':
+            k1 = flow(xt, t0)
+            xt = xt + 0.5 * h * (k1 + flow(xt + h * k1, t1))
+    return xt
+
+# Makes the pipeline's own inference_fm() and inference_ar_and_fm() sample with the given solver and schedule.
+# Amphion's reverse_diffusion() is left alone for its own euler steps, so the default output doesn't change.
+@contextlib.contextmanager
+def solver_context(pipeline, solver = 'euler', schedule = 'uniform'):
+    if solver == 'euler' and schedule == 'uniform':
+        yield
+        return
+    fmt_model = pipeline.fmt_model
+    def solver_reverse_diffusion(cond, prompt, x_mask = None, prompt_mask = None, n_timesteps = 10, cfg = DEFAULT_CFG, rescale_cfg = DEFAULT_RESCALE_CFG):
+        target_len = cond.shape[1] - prompt.shape[1]
+        if x_mask is None:
+            x_mask = torch.ones(cond.shape[0], target_len, device=cond.device)
+        noise = torch.randn((cond.shape[0], target_len, fmt_model.mel_dim), dtype=prompt.dtype, device=cond.device)
+        return reverse_diffusion(fmt_model, cond, prompt, x_mask, noise, n_timesteps, cfg, rescale_cfg, solver, schedule)
+    fmt_model.reverse_diffusion = solver_reverse_diffusion
+    try:
+        yield
+    finally:
+        del fmt_model.reverse_diffusion
+
+# Converts a clip with each solver, schedule and step count from the same seed, and reports how far each output's mel
+# spectrogram is from reference_steps of euler, along with the model evaluations and seconds it took.
+def benchmark(clip : str, reference : str, step_counts = (8, 12, 16, 24, 32), solvers = SOLVERS, schedules = SCHEDULES, reference_steps = 48):
+    import vevo_cli
+    from cpu_inference import convert_clip
+    pipeline = vevo_cli.load_model()
+    convert_clip(pipeline, clip, reference, 4) # Warm up
+    configs = [('euler', 'uniform', reference_steps)] + [(solver, schedule, steps) for solver in solvers for schedule in schedules for steps in step_counts]
+    results = []
+    reference_mel = None
+    for solver, schedule, steps in configs:
+        gen_audio, mel, elapsed = convert_clip(pipeline, clip, reference, steps, solver, schedule)
+        if reference_mel is None:
+            reference_mel = mel
+        length = min(mel.shape[1], reference_mel.shape[1])
+        mel_error = (mel[:, :length] - reference_mel[:, :length]).abs().mean().item()
+        evaluations = steps * (1 if solver == 'euler' else 2)
+        results.append((solver, schedule, steps, evaluations, elapsed, mel_error))
+    print('{:.1f} seconds of audio. Mel error is against {} euler steps.'.format(gen_audio.shape[-1] / vevo_cli.VEVO_SAMPLE_RATE, reference_steps))
+    print('{:<10}{:<10}{:>8}{:>14}{:>10}{:>12}'.format('solver', 'schedule', 'steps', 'evaluations', 'seconds', 'mel error'))
+    for solver, schedule, steps, evaluations, elapsed, mel_error in results:
+        print('{:<10}{:<10}{:>8}{:>14}{:>10.2f}{:>12.4f}'.format(solver, schedule, steps, evaluations, elapsed, mel_error))
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='flow_matching.py', description='Compares flow matching solvers and step counts against many euler steps.')
+    parser.add_argument('-i', '--input', type=str, required=True, help='Vocal clip to convert, ideally 5-10 seconds')
+    parser.add_argument('-v', '--reference_voice', type=str, required=True, help='Voice reference to convert with')
+    parser.add_argument('--steps', type=int, nargs='+', default=[8, 12, 16, 24, 32], help='Step counts to try. Default is 8 12 16 24 32.')
+    parser.add_argument('--reference_steps', type=int, default=48, help='Euler steps of the reference output. Default is 48.')
+    args = parser.parse_args()
+    benchmark(args.input, args.reference_voice, args.steps, reference_steps=args.reference_steps)
@@ -0,0 +1,92 @@
+# Records the finished stages of a redub job so an interrupted run can pick up where it left off.
+# Every artifact is stored with its content hash, and a stage is only reused if all of its files are still
+# there and unchanged. Each stage is also stored with a hash of its settings, chained with the settings of the
+# stages before it, so i.e. changing --steps redoes the conversion onwards but keeps the UVR stems.
+# Converted segments are recorded one at a time, keyed by the hash of the segment they were made from.
+import json
+import os
+from cache_utils import get_cache_dir, get_input_key, hash_file, hash_key
+
+MANIFEST_VERSION = 1
+STAGE_ORDER = ['extract', 'separate', 'segment', 'convert', 'recombine', 'overlay', 'mux']
+
+class JobManifest():
+    # stage_settings maps each stage in STAGE_ORDER to a list of the settings its output depends on
+    def __init__(self, filename : str, input_filename : str, stage_settings : dict):
+        self.filename = filename
+        self.input_key = get_input_key(input_filename)
+        self.settings_keys = {}
+        previous_key = self.input_key
+        for stage in STAGE_ORDER:
+            previous_key = hash_key(previous_key, *stage_settings.get(stage, []))
+            self.settings_keys[stage] = previous_key
+        self.stages = {}
+        self.segments = {}
+        if os.path.isfile(filename):
+            try:
+                with open(filename, 'r') as f:
+                    saved = json.load(f)
+                if saved.get('version') == MANIFEST_VERSION and saved.get('input_key') == self.input_key:
+                    self.stages = saved['stages']
+                    self.segments = saved['segments']
+            except Exception as e:
+                print('Warning: Ignoring unreadable manifest {}: {}'.format(filename, e))
+
+    def save(self):
+        # Written to a temp file first so an interrupted save can't corrupt the manifest
+        temp_filename = self.filename + '.tmp'
+        with open(temp_filename, 'w') as f:
+            json.dump({'version': MANIFEST_VERSION, 'input_key': self.input_key, 'stages': self.stages, 'segments': self.segments}, f, indent=1)
+        os.replace(temp_filename, self.filename)
+
+    def files_valid(self, files : dict):
+        for filename, file_hash in files.items():
+            if not os.path.isfile(filename) or hash_file(filename) != file_hash:
+                return False
+        return True
+
+    # Returns the data recorded for a finished stage, or None if the stage has to run again
+    def restore(self, stage : str):
+        entry = self.stages.get(stage)
+        if entry is None or entry['settings'] != self.settings_keys[stage]:
+            return None
+        if not self.files_valid(entry['files']):
+            print('Artifacts of the "{}" stage changed or are missing, running it again.'.format(stage))
+            return None
+        return entry['data']
+
+    # Records a finished stage along with the files it produced. Later stages were built on the old output, so they're dropped.
+    def record(self, stage : str, data : dict, files : list):
+        for later_stage in STAGE_ORDER[STAGE_ORDER.index(stage) + 1:]:
+            self.stages.pop(later_stage, None)
+        if STAGE_ORDER.index(stage) < STAGE_ORDER.index('convert'):
+            self.segments.clear()
+        self.stages[stage] = {'settings': self.settings_keys[stage], 'files': {filename: hash_file(filename) for filename in files}, 'data': data}
+        self.save()
+
+    # Returns the converted output of a segment if it was made from the same segment with the same settings
+    def restore_segment(self, segment : str):
+        entry = self.segments.get(segment)
+        if entry is None or entry['settings'] != self.settings_keys['convert']:
+            return None
+        if not os.path.isfile(segment) or hash_file(segment) != entry['source_hash'] or not self.files_valid(entry['files']):
+            return None
+        return entry['output']
+
+    def record_segment(self, segment : str, output : str):
+        self.segments[segment] = {'settings': self.settings_keys['convert'], 'source_hash': hash_file(segment), 'output': output, 'files': {output: hash_file(output)}}
+        self.save()
+
+    # Every artifact the manifest refers to, except the final output
+    def files(self):
+        files = set()
+        for stage, entry in self.stages.items():
+            if stage != 'mux':
+                files.update(entry['files'])
+        for entry in self.segments.values():
+            files.update(entry['files'])
+        return files
+
+def get_manifest_filename(input_filename : str, out_dir = None):
+    key = hash_key(os.path.abspath(input_filename), os.path.abspath(out_dir) if out_dir is not None else '')
+    return os.path.join(get_cache_dir('manifests'), '{}_{}.json'.format(os.path.splitext(os.path.basename(input_filename))[0], key[:16]))
@@ -0,0 +1,63 @@
+# Keeps what a finished redub needs to be remixed: the recombined converted vocals and the instrumental stem.
+# Changing the mix then only redoes the overlay and mux instead of UVR and Vevo.
+# Workspaces are found the same way as manifests, from the input filename and the output directory.
+import json
+import os
+import shutil
+import soundfile as sf
+import audio_buffers
+from cache_utils import get_cache_dir, get_input_key, hash_key
+
+WORKSPACE_VERSION = 1
+WORKSPACE_INDEX = 'workspace.json'
+
+def get_workspace_dir(input_filename : str, out_dir = None):
+    key = hash_key(os.path.abspath(input_filename), os.path.abspath(out_dir) if out_dir is not None else '')
+    return os.path.join(get_cache_dir('workspaces'), '{}_{}'.format(os.path.splitext(os.path.basename(input_filename))[0], key[:16]))
+
+# Copies a file into the workspace, or writes in-memory audio out losslessly. Returns the filename within the workspace.
+def store_audio(audio_input : str, workspace_dir : str, name : str):
+    if audio_buffers.is_memory_audio(audio_input):
+        filename = name + '.wav'
+        samples, sample_rate = audio_buffers.load_samples(audio_input)
+        sf.write(os.path.join(workspace_dir, filename), samples.T, sample_rate, subtype='PCM_32')
+    else:
+        filename = name + os.path.splitext(audio_input)[-1]
+        shutil.copyfile(audio_input, os.path.join(workspace_dir, filename))
+    return filename
+
+# instrumental is None if UVR was skipped, in which case the vocals are the whole mix
+def save_workspace(input_filename : str, out_dir, vocals : str, instrumental, video_input, inference_mode : str):
+    workspace_dir = get_workspace_dir(input_filename, out_dir)
+    # Written to a staging directory and renamed into place, so a half written workspace is never used
+    staging_dir = workspace_dir + '.tmp{}'.format(os.getpid())
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    os.makedirs(staging_dir)
+    index = {'version': WORKSPACE_VERSION,
+             'input_key': get_input_key(input_filename),
+             'video_input': os.path.abspath(video_input) if video_input is not None else None,
+             'inference_mode': inference_mode,
+             'vocals': store_audio(vocals, staging_dir, 'vocals'),
+             'instrumental': store_audio(instrumental, staging_dir, 'instrumental') if instrumental is not None else None}
+    with open(os.path.join(staging_dir, WORKSPACE_INDEX), 'w') as f:
+        json.dump(index, f, indent=1)
+    shutil.rmtree(workspace_dir, ignore_errors=True)
+    os.rename(staging_dir, workspace_dir)
+    print('Saved remix workspace: {}'.format(workspace_dir))
+
+# Returns the workspace of an input with full paths to its files
+def load_workspace(input_filename : str, out_dir = None):
+    workspace_dir = get_workspace_dir(input_filename, out_dir)
+    index_filename = os.path.join(workspace_dir, WORKSPACE_INDEX)
+    if not os.path.isfile(index_filename):
+        raise RuntimeError('No remix workspace for "{}". Redub it with --keep_workspace first.'.format(input_filename))
+    with open(index_filename, 'r') as f:
+        workspace = json.load(f)
+    if workspace.get('version') != WORKSPACE_VERSION:
+        raise RuntimeError('The remix workspace for "{}" is from another version. Redub it with --keep_workspace again.'.format(input_filename))
+    if workspace['input_key'] != get_input_key(input_filename):
+        raise RuntimeError('"{}" changed since it was redubbed. Redub it with --keep_workspace again.'.format(input_filename))
+    for stem in ['vocals', 'instrumental']:
+        if workspace[stem] is not None:
+            workspace[stem] = os.path.join(workspace_dir, workspace[stem])
+    return workspace
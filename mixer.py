@@ -0,0 +1,115 @@
+# Mixes the converted vocals back over the instrumental a block at a time with NumPy.
+# Both stems are decoded at the mix sample rate as they're read and every mixed block goes straight to the writer,
+# so memory use stays flat however long the input is. The output is as long as the instrumental, like pydub's overlay().
+import numpy as np
+from audio_stream import open_reader
+
+MIX_SAMPLE_RATE = 44100 # UVR's output rate, so the instrumental never has to be resampled
+CLIP_KNEE = 0.9 # Peaks that would clip are squashed smoothly from this level instead of hard clipped at full scale
+
+def db_to_gain(db : float):
+    return 10 ** (db / 20)
+
+# Soft clips only the half-waves (runs between zero crossings) that go over full scale. Within those, everything over
+# the knee is squashed smoothly into the headroom left below full scale. The rest of the mix is untouched, so a loud
+# master that never clips comes out as is. The last half-wave of each block is held back until the next block shows
+# where it ends, so the decision doesn't depend on where the blocks are cut.
+class SoftClipper():
+    def __init__(self, knee = CLIP_KNEE):
+        self.knee = knee
+        self.pending = None
+
+    def clip(self, samples):
+        magnitude = np.abs(samples)
+        if not (magnitude > 1.0).any():
+            return samples
+        samples = samples.copy()
+        headroom = 1.0 - self.knee
+        for channel in range(samples.shape[0]):
+            half_waves = np.concatenate([[0], np.cumsum(np.signbit(samples[channel, 1:]) != np.signbit(samples[channel, :-1]))])
+            clipping = np.isin(half_waves, half_waves[magnitude[channel] > 1.0]) & (magnitude[channel] > self.knee)
+            samples[channel, clipping] = np.sign(samples[channel, clipping]) * (self.knee + headroom * np.tanh((magnitude[channel, clipping] - self.knee) / headroom))
+        return samples
+
+    # Returns the clipped samples that are ready, which can be fewer than were given
+    def process(self, samples):
+        if self.pending is not None:
+            samples = np.concatenate([self.pending, samples], axis=1)
+        ready = samples.shape[1]
+        for channel in samples:
+            crossings = np.flatnonzero(np.signbit(channel[1:]) != np.signbit(channel[:-1]))
+            ready = min(ready, crossings[-1] + 1 if len(crossings) > 0 else ready)
+        if ready == 0: # No zero crossing in the whole block, i.e. DC. Don't hold it back indefinitely.
+            ready = samples.shape[1]
+        self.pending = samples[:, ready:]
+        return self.clip(samples[:, :ready])
+
+    # Returns whatever is still held back
+    def flush(self):
+        samples = self.pending if self.pending is not None else np.zeros((2, 0), dtype=np.float32)
+        self.pending = None
+        return self.clip(samples)
+
+# Lowers the instrumental while the vocals are active. The vocal level is measured in short windows, and the gain
+# moves towards the ducked level with a fast attack and slow release so the instrumental doesn't pump between words.
+# The gain is carried over between blocks, and interpolated across each window so it doesn't step.
+class Ducker():
+    def __init__(self, sample_rate : int, duck_db : float, threshold_db = -45.0, window_ms = 20, attack_ms = 10, release_ms = 400):
+        self.window = max(int(sample_rate * window_ms / 1000), 1)
+        self.ducked_gain = db_to_gain(-abs(duck_db))
+        self.threshold = db_to_gain(threshold_db)
+        self.attack = np.exp(-window_ms / attack_ms)
+        self.release = np.exp(-window_ms / release_ms)
+        self.gain = 1.0
+
+    # Returns the per-sample instrumental gain for a block of vocals
+    def process(self, vocals):
+        length = vocals.shape[1]
+        window_count = -(-length // self.window)
+        power = np.zeros(window_count * self.window)
+        power[:length] = np.mean(vocals * vocals, axis=0)
+        rms = np.sqrt(power.reshape(window_count, self.window).mean(axis=1))
+        targets = np.where(rms > self.threshold, self.ducked_gain, 1.0)
+        gains = np.empty(window_count)
+        previous_gain = gain = self.gain
+        for i, target in enumerate(targets):
+            coeff = self.attack if target < gain else self.release
+            gain = target + coeff * (gain - target)
+            gains[i] = gain
+        self.gain = gain
+        centres = np.concatenate([[-0.5 * self.window], (np.arange(window_count) + 0.5) * self.window])
+        return np.interp(np.arange(length), centres, np.concatenate([[previous_gain], gains])).astype(np.float32)
+
+# Mixes the stems into writer, anything with a write() that takes (2, samples) float32 blocks.
+# Volumes are in dB. duck_db lowers the instrumental by that much under the vocals, 0 disables ducking.
+def mix_stems(vocal_input : str, instrumental_input : str, writer, vocal_volume = 0, instrumental_volume = 0, duck_db = 0, sample_rate = MIX_SAMPLE_RATE, block_seconds = 10.0):
+    vocal_gain = db_to_gain(vocal_volume)
+    instrumental_gain = db_to_gain(instrumental_volume)
+    ducker = Ducker(sample_rate, duck_db) if duck_db != 0 else None
+    clipper = SoftClipper()
+    block = int(block_seconds * sample_rate)
+    if ducker is not None: # Whole windows per block, so only the last window of the input is ever partial
+        block = max(block // ducker.window, 1) * ducker.window
+    instrumental_reader = open_reader(instrumental_input, sample_rate)
+    vocal_reader = open_reader(vocal_input, sample_rate)
+    try:
+        while True:
+            instrumental = instrumental_reader.read(block)
+            if instrumental.shape[1] == 0:
+                break
+            vocals = vocal_reader.read(instrumental.shape[1])
+            if vocals.shape[1] < instrumental.shape[1]: # The vocals ended first
+                vocals = np.pad(vocals, ((0, 0), (0, instrumental.shape[1] - vocals.shape[1])))
+            vocals = vocals * vocal_gain
+            instrumental = instrumental * instrumental_gain
+            if ducker is not None:
+                instrumental = instrumental * ducker.process(vocals)
+            mixed = clipper.process(instrumental + vocals)
+            if mixed.shape[1] > 0:
+                writer.write(mixed)
+        mixed = clipper.flush()
+        if mixed.shape[1] > 0:
+            writer.write(mixed)
+    finally:
+        instrumental_reader.close()
+        vocal_reader.close()
@@ -0,0 +1,151 @@
+# Runs the fixed-architecture parts of the Vevo pipeline, the HuBERT content feature extractor and the vocoder,
+# through ONNX Runtime instead of PyTorch eager mode. They're exported to ONNX once and cached under ./models/Vevo/onnx,
+# per model snapshot. Each exported graph is checked against PyTorch on an input of a different length before it's used,
+# and anything that fails to export or doesn't match keeps running in PyTorch.
+# The ONNX sessions stand in for the pipeline's modules with the same call signatures, so nothing else has to know.
+# "python onnx_inference.py" exports the graphs ahead of time.
+import argparse
+import os
+import torch
+
+ONNX_DIR = './models/Vevo/onnx'
+ONNX_OPSET = 17
+HUBERT_OUTPUT_LAYER = 18 # The layer Vevo's content tokenizers are trained on
+
+use_onnx = False
+def configure(enabled = False):
+    global use_onnx
+    use_onnx = enabled
+
+# The HuBERT features the pipeline asks for, as a module with a single tensor in and out that can be exported
+class HubertFeatures(torch.nn.Module):
+    def __init__(self, hubert_model):
+        super().__init__()
+        self.hubert_model = hubert_model
+
+    def forward(self, wavs):
+        feats, _ = self.hubert_model.extract_features(wavs, num_layers=HUBERT_OUTPUT_LAYER)
+        return feats[-1]
+
+class Vocoder(torch.nn.Module):
+    def __init__(self, vocoder_model):
+        super().__init__()
+        self.vocoder_model = vocoder_model
+
+    def forward(self, mel):
+        return self.vocoder_model(mel)
+
+# What gets exported from the pipeline: the attribute, the exportable wrapper, input and output names, dynamic axes,
+# and a function returning an example input of the given length
+def get_components(pipeline):
+    mel_dim = getattr(getattr(pipeline, 'fmt_model', None), 'mel_dim', 100)
+    return {'hubert': ('hubert_model', HubertFeatures, 'wavs', 'feats', {0: 'batch', 1: 'samples'},
+                       lambda length: torch.randn(1, length * 160) * 0.1),
+            'vocoder': ('vocoder_model', Vocoder, 'mel', 'audio', {0: 'batch', 2: 'frames'},
+                        lambda length: torch.randn(1, mel_dim, length))}
+
+def create_session(filename : str, device):
+    import onnxruntime as ort
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.intra_op_num_threads = torch.get_num_threads()
+    providers = ['CPUExecutionProvider']
+    if torch.device(device).type == 'cuda' and 'CUDAExecutionProvider' in ort.get_available_providers():
+        providers.insert(0, 'CUDAExecutionProvider')
+    return ort.InferenceSession(filename, options, providers=providers)
+
+# Calls an ONNX session with torch tensors and returns a torch tensor on the pipeline's device
+class OnnxModule():
+    def __init__(self, filename : str, input_name : str, device):
+        self.session = create_session(filename, device)
+        self.input_name = input_name
+        self.device = device
+
+    def __call__(self, x):
+        output = self.session.run(None, {self.input_name: x.detach().float().cpu().numpy()})[0]
+        return torch.from_numpy(output).to(self.device)
+
+# Stands in for torchaudio's HuBERT model, which the pipeline only calls extract_features() on.
+# Batches are unpadded, so every item's feature length is the full length.
+class OnnxHubert(OnnxModule):
+    def extract_features(self, waveforms, lengths = None, num_layers = None):
+        if num_layers is not None and num_layers != HUBERT_OUTPUT_LAYER:
+            raise RuntimeError('The ONNX HuBERT graph only outputs layer {}, not {}.'.format(HUBERT_OUTPUT_LAYER, num_layers))
+        feats = self(waveforms)
+        return [feats], torch.full((feats.shape[0],), feats.shape[1], dtype=torch.int32, device=self.device)
+
+ONNX_MODULES = {'hubert': OnnxHubert, 'vocoder': OnnxModule}
+
+def get_onnx_filename(model_version : str, name : str):
+    return os.path.join(ONNX_DIR, model_version, '{}.onnx'.format(name))
+
+# Exports one component and checks it against PyTorch. Returns False if it can't be used.
+@torch.no_grad()
+def export_component(pipeline, name : str, filename : str, tolerance = 1e-3):
+    attribute, wrapper, input_name, output_name, dynamic_axes, example_input = get_components(pipeline)[name]
+    module = getattr(pipeline, attribute, None)
+    if module is None:
+        print('Warning: The pipeline has no {}, it will not be exported.'.format(attribute))
+        return False
+    module = wrapper(module).eval().cpu()
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    temp_filename = filename + '.tmp'
+    print('Exporting {} to ONNX...'.format(name))
+    try:
+        torch.onnx.export(module, (example_input(200),), temp_filename, input_names=[input_name], output_names=[output_name],
+                          dynamic_axes={input_name: dynamic_axes}, opset_version=ONNX_OPSET)
+        # A different length than the export, so a graph that baked in the example's shape fails here
+        test_input = example_input(321)
+        expected = module(test_input)
+        actual = OnnxModule(temp_filename, input_name, 'cpu')(test_input)
+        error = (actual - expected).abs().max().item() / max(expected.abs().max().item(), 1e-6)
+    except Exception as e:
+        print('Warning: {} could not be exported to ONNX and will run in PyTorch: {}'.format(name, e))
+        if os.path.isfile(temp_filename):
+            os.remove(temp_filename)
+        return False
+    finally:
+        module.to(pipeline.device)
+    if actual.shape != expected.shape or error > tolerance:
+        print('Warning: ONNX {} differs from PyTorch (relative error {:.2e}), it will run in PyTorch.'.format(name, error))
+        os.remove(temp_filename)
+        return False
+    os.replace(temp_filename, filename)
+    return True
+
+def export_pipeline(pipeline, model_version : str):
+    for name in get_components(pipeline):
+        filename = get_onnx_filename(model_version, name)
+        if not os.path.isfile(filename):
+            export_component(pipeline, name, filename)
+
+# Swaps the pipeline's HuBERT and vocoder for ONNX Runtime sessions if ONNX is enabled, exporting them first if needed.
+# Called before the precision suffix is added, so the graphs are cached per model snapshot.
+def apply_onnx(pipeline):
+    if not use_onnx:
+        return pipeline
+    export_pipeline(pipeline, pipeline.model_version)
+    replaced = []
+    for name, (attribute, _, input_name, _, _, _) in get_components(pipeline).items():
+        filename = get_onnx_filename(pipeline.model_version, name)
+        if os.path.isfile(filename):
+            setattr(pipeline, attribute, ONNX_MODULES[name](filename, input_name, pipeline.device))
+            replaced.append(name)
+    if len(replaced) > 0:
+        print('Running {} with ONNX Runtime.'.format(' and '.join(replaced)))
+        pipeline.model_version = '{}-onnx'.format(pipeline.model_version)
+    return pipeline
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='onnx_inference.py', description='Exports the Vevo HuBERT feature extractor and vocoder to ONNX.')
+    parser.add_argument('--force', action='store_true', help='Export again even if the graphs are already cached')
+    args = parser.parse_args()
+    import vevo_cli
+    pipeline = vevo_cli.load_model()
+    for name in get_components(pipeline):
+        filename = get_onnx_filename(pipeline.model_version, name)
+        if args.force or not os.path.isfile(filename):
+            if export_component(pipeline, name, filename):
+                print('Saved {}'.format(filename))
+        else:
+            print('Already exported: {}'.format(filename))
@@ -0,0 +1,248 @@
+# Long-running redub worker. The server keeps UVR and Vevo loaded between jobs so that
+# small redub requests don't pay for interpreter startup, imports and model loading every time.
+# Jobs are submitted over a local HTTP endpoint and processed one at a time in submission order.
+#   python redub_server.py serve
+#   python redub_server.py submit -i input.mp4 -v reference.wav
+import argparse
+import json
+import os
+import queue
+import sys
+import threading
+import time
+import traceback
+import urllib.error
+import urllib.request
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+# Finished jobs are forgotten after this long, or once there are more of them than this, oldest first
+FINISHED_JOB_RETENTION = 24 * 60 * 60
+MAX_FINISHED_JOBS = 1000
+
+job_queue = queue.Queue()
+jobs = {} # Job id -> job status dictionary
+jobs_lock = threading.Lock()
+
+def update_job(job_id : str, **kwargs):
+    with jobs_lock:
+        jobs[job_id].update(kwargs)
+
+# Drops finished jobs past the retention period or the count limit. Queued and running jobs are always kept.
+def prune_jobs():
+    with jobs_lock:
+        finished = sorted((job['finished'], job_id) for job_id, job in jobs.items() if 'finished' in job)
+        expired = len(finished) - MAX_FINISHED_JOBS
+        for idx, (finished_time, job_id) in enumerate(finished):
+            if idx < expired or time.time() - finished_time > FINISHED_JOB_RETENTION:
+                del jobs[job_id]
+
+def get_job(job_id : str):
+    with jobs_lock:
+        job = jobs.get(job_id)
+        return dict(job) if job is not None else None
+
+# Builds a redubber argument namespace from the defaults, overridden by the job's options
+# The job options as redubber command-line arguments, so they're checked and converted the same way as on the command line
+def options_to_argv(parser : argparse.ArgumentParser, options : dict):
+    actions = {action.dest: action for action in parser._actions if len(action.option_strings) > 0 and action.dest != 'help'}
+    argv = []
+    for key, value in options.items():
+        if key not in actions:
+            raise ValueError("Unknown job option '{}'".format(key))
+        action = actions[key]
+        if action.nargs == 0: # Flags like keep_temp_files
+            if not isinstance(value, bool):
+                raise ValueError("Job option '{}' must be true or false".format(key))
+            if value:
+                argv.append(action.option_strings[-1])
+        elif value is not None:
+            if isinstance(value, (bool, list, dict)):
+                raise ValueError("Job option '{}' must be a number or a string".format(key))
+            argv.append('{}={}'.format(action.option_strings[-1], value)) # Joined so negative numbers aren't taken for flags
+    return argv
+
+def raise_parser_error(message : str):
+    raise ValueError('Bad job option: {}'.format(message))
+
+def make_job_args(options : dict):
+    import redubber
+    parser = redubber.build_parser()
+    parser.error = raise_parser_error # Instead of exiting the server
+    args = parser.parse_args(options_to_argv(parser, options))
+    redubber.default_max_segment_duration(args)
+    # The models stay loaded at the precision and with the runtime the server was started with
+    import cpu_inference
+    import onnx_inference
+    if args.cpu_precision != cpu_inference.cpu_precision and 'cpu_precision' in options:
+        raise ValueError("This server runs vevo in {}. Start it with --cpu_precision {} instead.".format(cpu_inference.cpu_precision, args.cpu_precision))
+    args.cpu_precision = cpu_inference.cpu_precision
+    if args.onnx != onnx_inference.use_onnx and 'onnx' in options:
+        raise ValueError("This server {} ONNX Runtime. Restart it {} --onnx instead.".format('uses' if onnx_inference.use_onnx else "doesn't use", 'without' if onnx_inference.use_onnx else 'with'))
+    args.onnx = onnx_inference.use_onnx
+    return args
+
+def run_job(job_id : str, options : dict):
+    import redubber
+    update_job(job_id, status='running', started=time.time())
+    try:
+        args = make_job_args(options)
+        if args.input is None or args.reference_voice is None:
+            raise ValueError('Jobs require both an input and a reference voice.')
+        reference_voice = redubber.prepare_reference_voice(args.reference_voice, args.vevo_model, args.inference_mode)
+        output_filename = redubber.redub_file(args.input, reference_voice, args)
+        update_job(job_id, status='done', output=os.path.abspath(output_filename))
+    except Exception as e:
+        print(traceback.format_exc())
+        update_job(job_id, status='failed', error=str(e))
+    finally:
+        redubber.cleanup()
+        update_job(job_id, finished=time.time())
+
+def worker_loop():
+    while True:
+        job_id, options = job_queue.get()
+        print(f'Starting job {job_id}')
+        run_job(job_id, options)
+        print(f'Finished job {job_id}: {get_job(job_id)["status"]}')
+        job_queue.task_done()
+        prune_jobs()
+
+# Load the models up front so the first job doesn't pay for it
+def warm_up(vevo_model : str):
+    import uvr_cli
+    uvr_cli.get_separator()
+    if vevo_model == '1':
+        import vevo_cli
+        vevo_cli.get_pipeline()
+    elif vevo_model == '1.5':
+        import vevosing_cli
+        vevosing_cli.get_pipeline()
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+    def send_json(self, code : int, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        parts = self.path.strip('/').split('/')
+        if parts == ['jobs']:
+            with jobs_lock:
+                self.send_json(200, list(jobs.values()))
+        elif len(parts) == 2 and parts[0] == 'jobs':
+            job = get_job(parts[1])
+            if job is None:
+                self.send_json(404, {'error': 'Unknown job {}'.format(parts[1])})
+            else:
+                self.send_json(200, job)
+        else:
+            self.send_json(404, {'error': 'Unknown path {}'.format(self.path)})
+
+    def do_POST(self):
+        if self.path.strip('/') != 'jobs':
+            self.send_json(404, {'error': 'Unknown path {}'.format(self.path)})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            options = json.loads(self.rfile.read(length).decode('utf-8'))
+            if not isinstance(options, dict):
+                raise ValueError('The job must be a JSON object of redubber options.')
+            make_job_args(options) # Reject bad options before queueing
+        except ValueError as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        job_id = uuid.uuid4().hex
+        with jobs_lock:
+            jobs[job_id] = {'id': job_id, 'status': 'queued', 'options': options, 'submitted': time.time()}
+        job_queue.put((job_id, options))
+        self.send_json(202, get_job(job_id))
+
+    def log_message(self, format, *args):
+        pass # Keep the console for job progress
+
+def serve(host : str, port : int, vevo_model : str, warm : bool):
+    if warm:
+        warm_up(vevo_model)
+    threading.Thread(target=worker_loop, daemon=True).start()
+    server = ThreadingHTTPServer((host, port), JobRequestHandler)
+    print(f'Redub server listening on http://{host}:{port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+def request_json(url : str, body = None):
+    data = json.dumps(body).encode('utf-8') if body is not None else None
+    request = urllib.request.Request(url, data=data, headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return json.loads(response.read().decode('utf-8'))
+    except urllib.error.HTTPError as e:
+        raise RuntimeError(json.loads(e.read().decode('utf-8')).get('error', str(e)))
+
+# Submits a job and optionally waits for it to finish. Returns the final job status.
+def submit(host : str, port : int, options : dict, wait = True, poll_interval = 1.0):
+    base_url = f'http://{host}:{port}'
+    job = request_json(f'{base_url}/jobs', options)
+    print(f'Submitted job {job["id"]}')
+    while wait and job['status'] in ['queued', 'running']:
+        time.sleep(poll_interval)
+        job = request_json(f'{base_url}/jobs/{job["id"]}')
+    return job
+
+if __name__ == '__main__':
+    import cpu_inference
+    parser = argparse.ArgumentParser(prog='Redub Server', description='Keeps the redub models loaded and processes submitted jobs.')
+    parser.add_argument('--host', type=str, default=DEFAULT_HOST, help=f'Address to listen on or connect to. Default is {DEFAULT_HOST}.')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help=f'Port to listen on or connect to. Default is {DEFAULT_PORT}.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    serve_parser = subparsers.add_parser('serve', help='Run the worker server')
+    serve_parser.add_argument('--vevo_model', type=str, default='1', choices=['1', '1.5'], help='Vevo model to load at startup')
+    serve_parser.add_argument('--cpu_precision', type=str, default='fp32', choices=cpu_inference.CPU_PRECISIONS, help='Precision of vevo inference when there\'s no GPU. Default is fp32.')
+    serve_parser.add_argument('--cpu_threads', type=int, help='Intra-op threads torch uses on CPU')
+    serve_parser.add_argument('--cpu_interop_threads', type=int, help='Inter-op threads torch uses on CPU')
+    serve_parser.add_argument('--onnx', action='store_true', help='Run the vevo 1 HuBERT feature extractor and vocoder with ONNX Runtime')
+    serve_parser.add_argument('--no_warm_up', action='store_true', help="Don't load the models until the first job arrives")
+    submit_parser = subparsers.add_parser('submit', help='Submit a job to a running server')
+    submit_parser.add_argument('-i', '--input', type=str, required=True, help='Input video or audio to process')
+    submit_parser.add_argument('-v', '--reference_voice', type=str, required=True, help='Voice reference to redub with')
+    submit_parser.add_argument('-o', '--out_dir', type=str, default='./', help='Output directory. Default is the current directory.')
+    submit_parser.add_argument('--inference_mode', type=str, choices=['timbre','style','voice'], help='Vevo inference type')
+    submit_parser.add_argument('--steps', type=int, help='Vevo flow matching steps')
+    submit_parser.add_argument('--vevo_model', type=str, choices=['1', '1.5'], help='Vevo model version')
+    submit_parser.add_argument('--option', type=str, action='append', default=[], metavar='KEY=JSON', help='Any other redubber option, i.e. --option instrumental_volume=-3')
+    submit_parser.add_argument('--no_wait', action='store_true', help="Return as soon as the job is queued")
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        import onnx_inference
+        cpu_inference.configure(args.cpu_precision, args.cpu_threads, args.cpu_interop_threads)
+        onnx_inference.configure(args.onnx)
+        serve(args.host, args.port, args.vevo_model, not args.no_warm_up)
+    elif args.command == 'submit':
+        # Paths are sent as absolute paths since the server may run from a different directory
+        options = {'input': os.path.abspath(args.input), 'reference_voice': os.path.abspath(args.reference_voice), 'out_dir': os.path.abspath(args.out_dir)}
+        for key in ['inference_mode', 'steps', 'vevo_model']:
+            if getattr(args, key) is not None:
+                options[key] = getattr(args, key)
+        for option in args.option:
+            key, value = option.split('=', 1)
+            try:
+                options[key] = json.loads(value)
+            except ValueError: # Plain strings don't need to be quoted
+                options[key] = value
+        job = submit(args.host, args.port, options, wait=not args.no_wait)
+        if job['status'] == 'done':
+            print('Output file: {}'.format(job['output']))
+        elif job['status'] == 'failed':
+            print('Job failed: {}'.format(job['error']))
+            sys.exit(1)
+        else:
+            print('Job status: {}'.format(job['status']))
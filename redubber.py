@@ -1,21 +1,47 @@
 import argparse
+import hashlib
 import mimetypes
 import os
 import shutil
 import signal
 import subprocess
+import sys
+import threading
 import traceback
+import numpy as np
+import soundfile as sf
 from pydub import AudioSegment
-from pydub.silence import split_on_silence
-from uvr_cli import uvr_separate
+from uvr_cli import uvr_separate, uvr_separate_array, get_separation_key, get_stem_filenames, STEM_FORMATS, UVR_PRESET_NAMES
+import audio_buffers
+import cpu_inference
+import flow_matching
+import onnx_inference
+import vevo_output
+from silence import SilenceEnvelope
+from segment_planner import PlannedSegment, gate_segment, plan_segments
+from stage_pipeline import Stage, StagePipeline
+from job_manifest import JobManifest, get_manifest_filename
+from job_workspace import load_workspace, save_workspace
+from cache_utils import get_cache_dir, hash_file, hash_key
+from stem_cache import StemCache
+from audio_stream import ArrayWriter, AudioEncoder
+from mixer import MIX_SAMPLE_RATE, mix_stems
+
+# Stem names in the stem cache
+VOCALS = 'vocals'
+INSTRUMENTAL = 'instrumental'
+CONVERTED = 'converted'
 
 files_to_clean = [] # List of temp files to be cleaned up at the end
+protected_files = set() # Temp files recorded in the manifest of an unfinished job, kept so --resume can reuse them
 do_cleanup = True
 def cleanup():
     if do_cleanup:
         for filename in files_to_clean:
-            if os.path.isfile(filename):
+            if os.path.isfile(filename) and filename not in protected_files:
                 os.remove(filename)
+        files_to_clean.clear()
+    audio_buffers.clear()
 def signal_handler(sig, frame):
     cleanup()
 
@@ -45,30 +71,169 @@ def get_wav(filename : str, out_dir='./'):
         raise RuntimeError("Unsupported file type {} for file '{}'".format(mime, filename))
 
 def get_audio_duration(filename : str):
-    segment = AudioSegment.from_file(filename)
+    segment = audio_buffers.load_segment(filename)
     return segment.duration_seconds
 
-def separate_audio_from_video(video_input : str, out_dir='./'):
-    # Create a temp file that has no sound
-    video_no_audio = get_unique_filename(os.path.join(out_dir, os.path.splitext(os.path.basename(video_input))[0]), os.path.splitext(video_input)[-1].replace('.',''))
-    ffmpeg_cmd1 = ["ffmpeg", '-hide_banner', '-i', video_input, '-c:v', 'copy', '-an', video_no_audio]
-    result = subprocess.run(ffmpeg_cmd1, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-    if result.returncode != 0 or not os.path.isfile(video_no_audio):
-        print(' '.join(ffmpeg_cmd1))
-        print(result.stderr)
-        raise RuntimeError('Error rendering temp video. ffmpeg return code: {}'.format(result.returncode))
-    audio_no_video = get_unique_filename(os.path.join(out_dir, os.path.splitext(os.path.basename(video_input))[0]), 'mp3')
-    ffmpeg_cmd2 = ["ffmpeg", '-hide_banner', '-i', video_input, '-vn', '-acodec', 'mp3', '-b:a', '192k', audio_no_video]
-    result = subprocess.run(ffmpeg_cmd2, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-    if result.returncode != 0 or not os.path.isfile(video_no_audio):
-        print(' '.join(ffmpeg_cmd2))
+# Decodes the audio track of a video or audio file into memory at the UVR sample rate
+def load_audio_to_memory(input_filename : str, sample_rate = 44100, name = None):
+    if name is None:
+        name = os.path.splitext(os.path.basename(input_filename))[0]
+    audio = audio_buffers.array_to_segment(decode_audio(input_filename, sample_rate), sample_rate)
+    return audio_buffers.register(name, audio)
+
+# Hashes the decoded audio rather than the file, so the same audio in a different container or from a different temp file still matches
+def hash_decoded_audio(audio_input : str, sample_rate = 44100, chunk_size = 1024 * 1024):
+    sha = hashlib.sha256()
+    if audio_buffers.is_memory_audio(audio_input):
+        segment = audio_buffers.load_segment(audio_input)
+        sha.update('{} {} {}'.format(segment.frame_rate, segment.channels, segment.sample_width).encode('utf-8'))
+        sha.update(segment.raw_data)
+        return sha.hexdigest()
+    ffmpeg_cmd = ["ffmpeg", '-hide_banner', '-i', audio_input, '-vn', '-f', 'f32le', '-acodec', 'pcm_f32le', '-ac', '2', '-ar', str(sample_rate), 'pipe:1']
+    process = subprocess.Popen(ffmpeg_cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    for chunk in iter(lambda: process.stdout.read(chunk_size), b''):
+        sha.update(chunk)
+    if process.wait() != 0:
+        raise RuntimeError('Error decoding audio for hashing. ffmpeg return code: {}'.format(process.returncode))
+    return sha.hexdigest()
+
+# The stem cache is shared by every job in the process. A size of 0 disables it.
+stem_cache = None
+def get_stem_cache(stem_cache_size : float):
+    global stem_cache
+    if stem_cache_size <= 0:
+        return None
+    if stem_cache is None:
+        stem_cache = StemCache(get_cache_dir('stems'), 0)
+    stem_cache.max_bytes = int(stem_cache_size * 1024 ** 3)
+    return stem_cache
+
+# Runs UVR on a file, unless the same audio was already separated with the same settings
+def uvr_separate_cached(audio_input : str, count = 1, cache = None, stem_format = 'wav', window_seconds = 0, crossfade_seconds = 2.0, preset = 'quality'):
+    separate = lambda: uvr_separate(audio_input, count=count, stem_format=stem_format, window_seconds=window_seconds, crossfade_seconds=crossfade_seconds, preset=preset)
+    if cache is None:
+        return separate()
+    # Streaming changes the output slightly, so streamed stems are cached separately
+    streaming_key = [window_seconds, crossfade_seconds] if window_seconds > 0 else []
+    key = hash_key(hash_decoded_audio(audio_input), stem_format, *streaming_key, *get_separation_key(preset=preset))
+    vocal_stem, instrumental_stem = get_stem_filenames(audio_input, count=count, stem_format=stem_format)
+    if cache.get_files(key, {VOCALS: vocal_stem, INSTRUMENTAL: instrumental_stem}):
+        print('Using cached UVR stems.')
+        return vocal_stem, instrumental_stem
+    vocal_stem, instrumental_stem = separate()
+    cache.put_files(key, {VOCALS: vocal_stem, INSTRUMENTAL: instrumental_stem})
+    return vocal_stem, instrumental_stem
+
+# Runs UVR on in-memory audio and keeps the stems in memory
+def uvr_separate_memory(audio_input : str, sample_rate = 44100, cache = None, preset = 'quality'):
+    key = None
+    cached = None
+    if cache is not None:
+        key = hash_key(hash_decoded_audio(audio_input), 'arrays', sample_rate, *get_separation_key(preset=preset))
+        cached = cache.get_arrays(key)
+    if cached is not None:
+        print('Using cached UVR stems.')
+        vocals, instrumental = cached[VOCALS], cached[INSTRUMENTAL]
+    else:
+        mix = audio_buffers.load_array(audio_input, sample_rate, channels=2)
+        vocals, instrumental = uvr_separate_array(mix, preset=preset)
+        if cache is not None:
+            cache.put_arrays(key, {VOCALS: vocals, INSTRUMENTAL: instrumental})
+    audio_base = os.path.splitext(os.path.basename(audio_input))[0]
+    vocal_stem = audio_buffers.register(f'{audio_base}_(Vocals)', audio_buffers.array_to_segment(vocals, sample_rate))
+    instrumental_stem = audio_buffers.register(f'{audio_base}_(Instrumental)', audio_buffers.array_to_segment(instrumental, sample_rate))
+    return vocal_stem, instrumental_stem
+
+# The converted segment cache is shared by every job in the process, like the stem cache. A size of 0 disables it.
+segment_cache = None
+def get_segment_cache(segment_cache_size : float):
+    global segment_cache
+    if segment_cache_size <= 0:
+        return None
+    if segment_cache is None:
+        segment_cache = StemCache(get_cache_dir('segments'), 0, label='segments')
+    segment_cache.max_bytes = int(segment_cache_size * 1024 ** 3)
+    return segment_cache
+
+# Everything besides the segment audio and transcript that a converted segment depends on, including the model snapshot.
+# The seed isn't included. A different seed gives an equally good conversion, and identical segments should match anyway.
+def get_conversion_key(args, reference_voice : str):
+    if args.vevo_model == '1':
+        from vevo_cli import get_model_version
+    else:
+        from vevosing_cli import get_model_version
+    transcript_key = [args.input_language, args.ref_language] if args.vevo_model == '1.5' and args.inference_mode != 'timbre' else []
+    return hash_key(hash_file(reference_voice), get_model_version(), args.inference_mode, args.steps, args.solver, args.step_schedule, args.cpu_precision, args.onnx, *transcript_key)
+
+# Hashes the samples of a segment. Segments are short wavs or in-memory audio, so they're read directly instead of through ffmpeg.
+def hash_segment(segment : str):
+    samples, sample_rate = audio_buffers.load_samples(segment)
+    return hash_key(sample_rate, samples.shape, hashlib.sha256(np.ascontiguousarray(samples).tobytes()).hexdigest())
+
+# Returns the cached conversion of a segment under the name vevo would have given it, or None on a miss
+def restore_converted(cache : StemCache, key : str, segment : str, reference_voice : str, in_memory = False):
+    output = vevo_output.get_output_filename(segment, reference_voice)
+    if in_memory:
+        cached = cache.get_arrays(key)
+        if cached is None:
+            return None
+        return audio_buffers.register(output, audio_buffers.array_to_segment(cached[CONVERTED], int(cached['sample_rate'])))
+    return output if cache.get_files(key, {CONVERTED: output}) else None
+
+def store_converted(cache : StemCache, key : str, output : str):
+    if audio_buffers.is_memory_audio(output):
+        samples, sample_rate = audio_buffers.load_samples(output)
+        cache.put_arrays(key, {CONVERTED: samples, 'sample_rate': np.array(sample_rate)})
+    else:
+        cache.put_files(key, {CONVERTED: output})
+
+# Gives a segment the output that was converted from an identical segment
+def copy_converted(output : str, segment : str, reference_voice : str):
+    duplicate = vevo_output.get_output_filename(segment, reference_voice)
+    if audio_buffers.is_memory_audio(output):
+        return audio_buffers.register(duplicate, audio_buffers.load_segment(output))
+    shutil.copyfile(output, duplicate)
+    return duplicate
+
+# Writes an audio file or in-memory audio to a file in the given format
+def export_audio(audio_input : str, output_filename : str, format : str, bitrate : str):
+    audio_buffers.load_segment(audio_input).export(output_filename, format=format, bitrate=bitrate)
+    return output_filename
+
+# Decodes the audio track straight to raw float PCM over a pipe. Returns a (channels, samples) float32 array.
+def decode_audio(input_filename : str, sample_rate = 44100, channels = 2):
+    ffmpeg_cmd = ["ffmpeg", '-hide_banner', '-i', input_filename, '-vn', '-f', 'f32le', '-acodec', 'pcm_f32le', '-ac', str(channels), '-ar', str(sample_rate), 'pipe:1']
+    result = subprocess.run(ffmpeg_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        print(' '.join(ffmpeg_cmd))
+        print(result.stderr.decode(errors='replace'))
+        raise RuntimeError('Error decoding audio. ffmpeg return code: {}'.format(result.returncode))
+    return np.frombuffer(result.stdout, dtype=np.float32).reshape(-1, channels).T
+
+# Extracts the audio track to a lossless wav at the UVR sample rate. The video stream is never copied,
+# the final mux takes it straight from the original input.
+def extract_audio(video_input : str, out_dir='./', sample_rate = 44100, name = None):
+    if name is None:
+        name = os.path.splitext(os.path.basename(video_input))[0]
+    audio_no_video = get_unique_filename(os.path.join(out_dir, name), 'wav')
+    ffmpeg_cmd = ["ffmpeg", '-hide_banner', '-i', video_input, '-vn', '-acodec', 'pcm_s16le', '-ac', '2', '-ar', str(sample_rate), audio_no_video]
+    result = subprocess.run(ffmpeg_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    if result.returncode != 0 or not os.path.isfile(audio_no_video):
+        print(' '.join(ffmpeg_cmd))
         print(result.stderr)
         raise RuntimeError('Error rendering audio. ffmpeg return code: {}'.format(result.returncode))
-    return video_no_audio, audio_no_video
+    return audio_no_video
 
 def combine_audio_and_video(video_input :str, audio_input : str, audio_bitrate : int, out_dir = './'):
     category, mimetype = mimetypes.guess_type(video_input)[0].split('/')
-    ffmpeg_cmd = ["ffmpeg", '-hide_banner', '-i', video_input, '-i', audio_input, '-c:v', 'copy', '-c:a']
+    # In-memory audio is piped to ffmpeg as raw PCM
+    audio_data = None
+    audio_input_args = ['-i', audio_input]
+    if audio_buffers.is_memory_audio(audio_input):
+        audio_data, pcm_format, sample_rate, channels = audio_buffers.to_raw_pcm(audio_input)
+        audio_input_args = ['-f', pcm_format, '-ar', str(sample_rate), '-ac', str(channels), '-i', 'pipe:0']
+    # The video stream is copied from the original input, whatever audio it has is replaced
+    ffmpeg_cmd = ["ffmpeg", '-hide_banner', '-i', video_input, *audio_input_args, '-map', '0:v', '-map', '1:a', '-c:v', 'copy', '-c:a']
     # Determine which type of audio to use for recombine
     if mimetype == 'mp4':
         print('Using mp4/aac')
@@ -84,126 +249,121 @@ def combine_audio_and_video(video_input :str, audio_input : str, audio_bitrate :
     ffmpeg_cmd.extend(['-b:a', '{}k'.format(audio_bitrate)])
     output_filename = get_unique_filename(os.path.join(out_dir, os.path.splitext(os.path.basename(video_input))[0]), os.path.splitext(video_input)[-1].replace('.',''))
     ffmpeg_cmd.append(output_filename)
-    result = subprocess.run(ffmpeg_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    result = subprocess.run(ffmpeg_cmd, input=audio_data, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     if result.returncode != 0 or not os.path.isfile(output_filename):
         print(' '.join(ffmpeg_cmd))
-        print(result.stderr)
+        print(result.stderr.decode(errors='replace'))
         raise RuntimeError('Error rendering video. ffmpeg return code: {}'.format(result.returncode))
     return output_filename
 
-# For when the initial split attempt isn't enough. Returns the segment split into smaller segments, recursively if needed.
-def extra_split(segment : AudioSegment, max_duration : float, min_silence_len : int, silence_thresh : int, print_padding = '  '):
-    extra_segments = []
-    # Split again, raising the silence threshold and lowering the min silence length
-    segments = split_on_silence(segment, min_silence_len=min_silence_len - 10, silence_thresh=silence_thresh + 5, keep_silence=True)
-    for seg in segments:
-        if seg.duration_seconds <= max_duration: # Good segment
-            extra_segments.append(seg)
-        else: # Recursive split with higher thresholds
-            #print('{}Segment is {:.3f} seconds. Resorting to recursive split.'.format(print_padding,seg.duration_seconds))
-            extra_segments.extend(extra_split(seg, max_duration, min_silence_len - 10, silence_thresh + 5, print_padding+'  '))
-    
-    current_segment = AudioSegment.empty()
-    rejoined_segments = []
-    # Splitting might cause more fragments than necessary, so rejoin short ones if possible
-    for idx, seg in enumerate(extra_segments):
-        if current_segment.duration_seconds + seg.duration_seconds < max_duration: # Current segment can be added
-            new_segment = current_segment + seg
-            current_segment = new_segment
-        else: # Segment length exceeds max, add segment and start over with new segment
-            rejoined_segments.append(current_segment) # Append segment
-            current_segment = seg # Replace segment with current one not added
-        # Don't forget the  last segment         
-        if idx == len(extra_segments) - 1 and current_segment.duration_seconds > 0.0: 
-            rejoined_segments.append(current_segment)
-    #print('{}Segment was split into {} smaller segments.'.format(print_padding, len(rejoined_segments)))
-    return rejoined_segments
-
-# Split vocals into segments separated by silence if necessary
-def prepare_vocal_segments(input_vocal_stem : str, max_duration : float, min_silence_len : int, silence_thresh : int):
+# Split vocals into segments separated by silence if necessary.
+# Returns the segment names and the plan they were cut from, a list of PlannedSegment with each segment's position in the stem.
+# With vad, segments that are all silence aren't exported (their name is None), and long silences at the ends of the rest are left out.
+def prepare_vocal_segments(input_vocal_stem : str, max_duration : float, min_silence_len : int, silence_thresh : int, in_memory = False, vad = True):
     print('Preparing vocal segments')
-    vocal_segment = AudioSegment.from_file(input_vocal_stem)
+    vocal_segment = audio_buffers.load_segment(input_vocal_stem)
     total_duration = vocal_segment.duration_seconds
     segment_base_name = os.path.splitext(os.path.basename(input_vocal_stem))[0] + '_segment_'
-    segments = []
+    # The energy envelope is computed once and answers every silence query the planner and the gate make
+    envelope = SilenceEnvelope(vocal_segment) if total_duration > max_duration or vad else None
     if total_duration > max_duration:
         print('Audio length of {:.3f} exceeds max duration of {} seconds. Attempting to split on silence.'.format(total_duration, max_duration))
-        split_segments = split_on_silence(vocal_segment, min_silence_len=min_silence_len, silence_thresh=silence_thresh, keep_silence=True)
-        # We don't know how long each segment is, so combine them back into segments up to the max length
-        current_segment = AudioSegment.empty()
-        rejoined_segments = []
-        for idx, seg in enumerate(split_segments):
-            #print(current_segment.duration_seconds)
-            if seg.duration_seconds > max_duration: # Segment already exceeds max
-                rejoined_segments.append(current_segment)
-                print('  Warning: Segment is {:.3f} seconds. Attempting to split further...'.format(seg.duration_seconds))
-                extra_segments = extra_split(seg, max_duration, min_silence_len, silence_thresh)
-                print('  Segment was split into {} smaller segments.'.format(len(extra_segments)))
-                rejoined_segments.extend(extra_segments)
-                current_segment = AudioSegment.empty() # Clear out past segment
-            elif current_segment.duration_seconds + seg.duration_seconds < max_duration: # Current segment can be added
-                new_segment = current_segment + seg
-                current_segment = new_segment
-            else: # Segment length exceeds max, add segment and start over with new segment
-                rejoined_segments.append(current_segment) # Append segment
-                current_segment = seg # Replace segment with current one not added
-            # Don't forget the  last segment         
-            if idx == len(split_segments) - 1 and current_segment.duration_seconds > 0.0: 
-                rejoined_segments.append(current_segment)
-        # Export rejoined segments and add their names to the list
-        rejoined_duration = 0.0
-        for idx, seg in enumerate(rejoined_segments):
-            rejoined_duration += seg.duration_seconds
-            segment_name = '{}{}.wav'.format(segment_base_name, idx)
+        plan = plan_segments(envelope, max_duration, min_silence_len, silence_thresh)
+        for planned in plan:
+            if planned.over_max:
+                print('  Warning: Unable to split {:.3f} second segment any further.'.format((planned.end_ms - planned.start_ms) / 1000))
+        lengths = [(planned.end_ms - planned.start_ms) / 1000 for planned in plan]
+        print('Split into {} segments from {:.3f} to {:.3f} seconds long.'.format(len(plan), min(lengths), max(lengths)))
+    else:
+        plan = [PlannedSegment(0, len(vocal_segment), None, False)]
+    if vad:
+        for planned in plan:
+            gate_segment(envelope, planned, min_silence_len, silence_thresh)
+        silent_count = len([planned for planned in plan if not planned.voiced])
+        trimmed_ms = sum((planned.end_ms - planned.start_ms) - (planned.voice_end_ms - planned.voice_start_ms) for planned in plan if planned.voiced)
+        if silent_count > 0 or trimmed_ms > 0:
+            print('Skipping {} silent segments and {:.3f} seconds of silence at the edges of the others.'.format(silent_count, trimmed_ms / 1000))
+    # Export the voiced part of each segment and add their names to the list
+    segments = []
+    for idx, planned in enumerate(plan):
+        if not planned.voiced:
+            segments.append(None)
+            continue
+        seg = vocal_segment[planned.voice_start_ms:planned.voice_end_ms]
+        segment_name = '{}{}.wav'.format(segment_base_name, idx)
+        if in_memory:
+            segment_name = audio_buffers.register(segment_name, seg)
+        else:
             seg.export(segment_name, format="wav", bitrate="192k")
-            segments.append(segment_name)
-        if abs(rejoined_duration - total_duration) > 0.01:
-            print('Warning: split segments total {:.3f} seconds, but input audio was {:.3f} seconds.'.format(rejoined_duration, total_duration))
-    else: # Only one segment, still have to convert to wav
-        segments.append(segment_base_name + '0.wav')
-        vocal_segment.export(segments[0], format="wav", bitrate="192k")
-    return segments
-
-# Concatenate all vocal segments back into one segment
-def recombine_segments(original_input : str, converted_segments : list, original_segments : list, sync_segments : bool):
+        segments.append(segment_name)
+    return segments, plan
+
+# Sample index of a position in ms
+def planned_sample(position_ms : int, sample_rate : int):
+    return position_ms * sample_rate // 1000
+
+# Puts the converted vocal segments back together into one track. Segments that weren't converted (None) are silence.
+# With sync_segments, each segment is written into a preallocated buffer at its position in the segment plan and trimmed or padded
+# to fit, so the output stays in sync with the input. Otherwise the segments are joined end to end at whatever length they came out.
+# Either way, silence that was trimmed off the edges of a segment before conversion is put back.
+def recombine_segments(original_input : str, converted_segments : list, segment_plan : list, sync_segments : bool, in_memory = False):
     print('Combining vocal segments.')
-    recombined = AudioSegment.empty()
-    if len(converted_segments) != len(original_segments):
-        raise RuntimeError("Converted segment count {} doesn't match original segment count of {}. Something went wrong during vocal conversion.".format(len(converted_segments), len(original_segments)))
-    for idx,seg in enumerate(converted_segments):
-        next_segment = AudioSegment.from_file(seg)
-        # Sometimes, segment length doesn't match the original. We have to trim or extend to keep in sync.
-        original_seg_duration = get_audio_duration(original_segments[idx])
-        if sync_segments and (abs(original_seg_duration - next_segment.duration_seconds) > 0.01):
-            #print('Converted segment duration: {:.3f}, original segment duration: {:.3f}'.format(next_segment.duration_seconds, original_seg_duration))
-            if original_seg_duration > next_segment.duration_seconds:
-                diff_ms = int((original_seg_duration - next_segment.duration_seconds) * 1000)
-                print('Extending segment {} by {} ms'.format(idx, diff_ms))
-                filler = AudioSegment.silent(duration=diff_ms)
-                next_segment = next_segment + filler
-            elif original_seg_duration < next_segment.duration_seconds:
-                diff_ms = int((next_segment.duration_seconds - original_seg_duration) * 1000)
-                print('Trimming segment {} by {} ms'.format(idx, diff_ms))
-                next_segment = next_segment[:-diff_ms]
-        recombined = recombined + next_segment
-    output_filename = os.path.splitext(os.path.basename(original_input))[0] + '_(Recombined).mp3'
-    recombined.export(output_filename, format="mp3", bitrate="192k")
+    if len(converted_segments) != len(segment_plan):
+        raise RuntimeError("Converted segment count {} doesn't match original segment count of {}. Something went wrong during vocal conversion.".format(len(converted_segments), len(segment_plan)))
+    # Silent segments take the sample rate of the converted ones
+    sample_rate, channels = vevo_output.OUTPUT_SAMPLE_RATE, 1
+    for seg in converted_segments:
+        if seg is not None:
+            samples, sample_rate = audio_buffers.load_samples(seg)
+            channels = samples.shape[0]
+            break
+    recombined = None
+    if sync_segments:
+        recombined = np.zeros((channels, planned_sample(segment_plan[-1].end_ms, sample_rate)), dtype=np.float32)
+    unsynced_parts = []
+    for idx, (seg, planned) in enumerate(zip(converted_segments, segment_plan)):
+        silence = lambda start_ms, end_ms: np.zeros((channels, planned_sample(end_ms, sample_rate) - planned_sample(start_ms, sample_rate)), dtype=np.float32)
+        if seg is None:
+            if not sync_segments:
+                unsynced_parts.append(silence(planned.start_ms, planned.end_ms))
+            continue
+        samples, seg_sample_rate = audio_buffers.load_samples(seg)
+        if seg_sample_rate != sample_rate:
+            raise RuntimeError('Converted segment {} is {} Hz, but the other segments are {} Hz.'.format(idx, seg_sample_rate, sample_rate))
+        if not sync_segments:
+            unsynced_parts.extend([silence(planned.start_ms, planned.voice_start_ms), samples[:channels], silence(planned.voice_end_ms, planned.end_ms)])
+            continue
+        # Sometimes, segment length doesn't match the original. Whatever doesn't fit the segment's slot is trimmed, and anything missing stays silent.
+        start = planned_sample(planned.voice_start_ms, sample_rate)
+        slot_length = planned_sample(planned.voice_end_ms, sample_rate) - start
+        diff_ms = int(abs(slot_length - samples.shape[1]) * 1000 / sample_rate)
+        if diff_ms > 10 and slot_length > samples.shape[1]:
+            print('Extending segment {} by {} ms'.format(idx, diff_ms))
+        elif diff_ms > 10:
+            print('Trimming segment {} by {} ms'.format(idx, diff_ms))
+        length = min(slot_length, samples.shape[1])
+        recombined[:, start:start + length] = samples[:recombined.shape[0], :length]
+    if not sync_segments:
+        recombined = np.concatenate(unsynced_parts, axis=1)
+    output_filename = os.path.splitext(os.path.basename(original_input))[0] + '_(Recombined).wav'
+    if in_memory:
+        return audio_buffers.register(output_filename, audio_buffers.array_to_segment(recombined, sample_rate))
+    sf.write(output_filename, np.clip(recombined.T, -1.0, 1.0), sample_rate, subtype='PCM_32')
     return output_filename
 
-# Overlay the vocal and instrumental stems back on top of each other
-def overlay_stems(original_input : str, input_vocal_stem : str, input_instrumental_stem : str, instrumental_volume : int, vocal_volume : int, audio_bitrate : int):
+# Overlay the vocal and instrumental stems back on top of each other, mixing a block at a time straight into the mp3 encoder
+def overlay_stems(original_input : str, input_vocal_stem : str, input_instrumental_stem : str, instrumental_volume : int, vocal_volume : int, audio_bitrate : int, in_memory = False, duck_db = 0.0):
     print('Overlaying vocal and instrumental stems.')
-    vocal_segment = AudioSegment.from_file(input_vocal_stem)
-    instrumental_segment = AudioSegment.from_file(input_instrumental_stem)
-
-    # Boost volume if required
-    if instrumental_volume != 0:
-        instrumental_segment = instrumental_segment + instrumental_volume
-    if instrumental_volume != 0:
-        vocal_segment = vocal_segment + vocal_volume
-    overlaid = instrumental_segment.overlay(vocal_segment)
     output_filename = os.path.splitext(os.path.basename(original_input))[0] + '_(Overlaid).mp3'
-    overlaid.export(output_filename, format="mp3", bitrate="{}k".format(audio_bitrate))
+    if in_memory:
+        writer = ArrayWriter()
+        mix_stems(input_vocal_stem, input_instrumental_stem, writer, vocal_volume, instrumental_volume, duck_db)
+        return audio_buffers.register(output_filename, audio_buffers.array_to_segment(writer.get_samples(), MIX_SAMPLE_RATE))
+    writer = AudioEncoder(output_filename, MIX_SAMPLE_RATE, 2, ['-b:a', '{}k'.format(audio_bitrate)])
+    try:
+        mix_stems(input_vocal_stem, input_instrumental_stem, writer, vocal_volume, instrumental_volume, duck_db)
+    finally:
+        writer.close()
     return output_filename
 
 def change_file_directory(filename, new_output_path):
@@ -231,32 +391,429 @@ def change_file_directory(filename, new_output_path):
 
     return new_file_path
 
-if __name__ == '__main__':
+# Settings of the final mix, shared with the remix command
+def add_mix_arguments(parser):
+    parser.add_argument('--audio_bitrate', type=int, default=128, help='Bitrate, in kbps, of the final output audio. Default is 128.')
+    parser.add_argument('--instrumental_volume', type=int, default=0, help='Boost (or reduce) volume of the instrumental track, in dB')
+    parser.add_argument('--vocal_volume', type=int, default=0, help='Boost (or reduce) volume of the vocal track, in dB')
+    parser.add_argument('--duck_db', type=float, default=0, help='Lower the instrumental track by this many dB while there are vocals over it. 0 disables ducking. Default is 0.')
+
+# argparse type for counts that have to be at least 1
+def positive_int(value : str):
+    count = int(value)
+    if count < 1:
+        raise argparse.ArgumentTypeError('must be at least 1, got {}'.format(value))
+    return count
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog='Redubber',
+        description='Redubs audio or video using a reference voice.',
+        epilog='Specify the inputs on the command-line. Use -i and -v to explicitly specify input type if context specific parsing fails.')
+    parser.add_argument('-i', '--input', type=str, help='Input video or audio to process')
+    parser.add_argument('-d', '--in_dir', type=str, help='Input directory. All found video and audio will be processed.')
+    parser.add_argument('-o', '--out_dir', type=str, help='Output directory to use when batch processing from --in_dir.')
+    parser.add_argument('-k', '--keep_temp_files', action='store_true', help='Keep intermediate temp files')
+    parser.add_argument('-v', '--reference_voice', type=str, help='Voice reference to redub with')
+    add_mix_arguments(parser)
+    parser.add_argument('--inference_mode', type=str, default='timbre', choices=['timbre','style','voice'], help='Vevo inference type. "style" and "voice" are less reliable but attempt more accurate accents.')
+    parser.add_argument('--ref_language', type=str, default='en', choices=['en', 'zh'], help='Reference language (used by whisper transcription for vevo 1.5 style)')
+    parser.add_argument('--input_language', type=str, default='en', choices=['en', 'zh'], help='Source language (used by whisper transcription for vevo 1.5 style)')
+    parser.add_argument('--whisper_device', type=str, choices=['cuda', 'cpu'], help='Device to run whisper transcription on (vevo 1.5 style and voice). Default is cuda if available, otherwise cpu.')
+    parser.add_argument('--silence_thresh', type=int, default=-48, help='(in dBFS) anything quieter than this will be considered silence')
+    parser.add_argument('--skip_uvr', action='store_true', help='Skip Ultimate Vocal Remover inference')
+    parser.add_argument('--skip_vad', action='store_true', help='Convert silent segments and the silence at the edges of segments too, instead of passing the silence through.')
+    parser.add_argument('--skip_trim', action='store_true', help='Skip trimming and extending when reassembling output segments. This may cause a desync in the output video.')
+    parser.add_argument('--steps', type=int, default=48, help='Vevo flow matching steps.')
+    parser.add_argument('--solver', type=str, default='euler', choices=flow_matching.SOLVERS, help='Flow matching ODE solver. midpoint and heun run the model twice per step. Default is euler.')
+    parser.add_argument('--step_schedule', type=str, default='uniform', choices=flow_matching.SCHEDULES, help='Spacing of the flow matching steps. Default is uniform.')
+    parser.add_argument('--max_segment_duration', type=float, help='Maximum vocal segment duration, in seconds.')
+    parser.add_argument('--min_silence_len', type=int, default=350, help='minimum length (in ms) of silence when splitting vocals into chunks')
+    parser.add_argument('--vevo_model', type=str, default='1', choices=['1', '1.5'], help='Vevo model version, either 1 or 1.5 (a.k.a vevosing)')
+    parser.add_argument('--batch_size', type=int, default=1, help='Number of segments to convert at once (vevo 1 timbre mode only). Default is 1.')
+    parser.add_argument('--max_batch_frames', type=int, help='Maximum total padded frames (50 per second) in one batch when --batch_size is greater than 1.')
+    parser.add_argument('--cpu_precision', type=str, default='fp32', choices=cpu_inference.CPU_PRECISIONS, help='Precision of vevo inference when there\'s no GPU. int8 quantizes the transformers, bf16 autocasts them. Default is fp32.')
+    parser.add_argument('--cpu_threads', type=int, help='Intra-op threads torch uses on CPU. Default is torch\'s default.')
+    parser.add_argument('--workers', type=positive_int, default=1, help='Convert segments in this many CPU worker processes, each pinned to its share of the cores. Default is 1 (no workers).')
+    parser.add_argument('--cpu_interop_threads', type=int, help='Inter-op threads torch uses on CPU. Default is torch\'s default.')
+    parser.add_argument('--onnx', action='store_true', help='Run the vevo 1 HuBERT feature extractor and vocoder with ONNX Runtime. They\'re exported to ./models/Vevo/onnx the first time.')
+    parser.add_argument('--in_memory', action='store_true', help='Pass audio between stages in memory instead of through intermediate files.')
+    parser.add_argument('--pipeline', action='store_true', help='Overlap the stages of different files when batch processing. UVR and Vevo still take turns on the GPU.')
+    parser.add_argument('--extract_workers', type=positive_int, default=1, help='Worker threads for audio extraction with --pipeline. Default is 1.')
+    parser.add_argument('--segment_workers', type=positive_int, default=1, help='Worker threads for vocal segmentation with --pipeline. Default is 1.')
+    parser.add_argument('--finish_workers', type=positive_int, default=1, help='Worker threads for recombining, overlaying and muxing with --pipeline. Default is 1.')
+    parser.add_argument('--stem_format', type=str, default='wav', choices=STEM_FORMATS, help='Format of the UVR stems when they\'re written to disk. wav and flac are lossless. Default is wav.')
+    parser.add_argument('--uvr_preset', type=str, default='quality', choices=UVR_PRESET_NAMES, help='UVR speed/quality preset. "tuned" uses the results of "python uvr_cli.py autotune". Default is quality.')
+    parser.add_argument('--uvr_window', type=float, default=0, help='Stream the input through UVR in windows of this many seconds, so memory use doesn\'t grow with the input length. 0 separates the whole input at once. Default is 0.')
+    parser.add_argument('--uvr_crossfade', type=float, default=2.0, help='Seconds of overlap crossfaded between neighbouring --uvr_window windows. Default is 2.')
+    parser.add_argument('--stem_cache_size', type=float, default=10, help='Size limit, in GB, of the cache of UVR stems reused when the same audio is redubbed again. 0 disables the cache. Default is 10.')
+    parser.add_argument('--segment_cache_size', type=float, default=5, help='Size limit, in GB, of the cache of converted vocal segments reused when the same segment is converted again with the same settings. 0 disables the cache. Default is 5.')
+    parser.add_argument('--keep_workspace', action='store_true', help='Keep the converted vocals and instrumental stem of each job, so "python redubber.py remix" can redo the mix with new settings.')
+    parser.add_argument('--resume', action='store_true', help='Keep the intermediate files of unfinished jobs and reuse them on the next run with the same input.')
+    parser.add_argument('--queue_size', type=positive_int, default=1, help='Files that can wait between two stages with --pipeline. Default is 1.')
+    return parser
+
+# Converts the reference to wav if needed and checks that it isn't too long for the inference mode
+def prepare_reference_voice(reference_voice : str, vevo_model : str, inference_mode : str):
+    reference_voice = get_wav(reference_voice)
+    # Assert appropriate reference audio duration depending on inference mode
+    reference_duration = get_audio_duration(reference_voice)
+    # 45 seconds for vevo 1 timbre, 15 seconds for vevo 1 voice, 30 seconds for vevo 1.5 across all modes
+    max_reference_duration = 45.0 if vevo_model == '1' and inference_mode == 'timbre' else (15.0 if vevo_model == '1' else 30.0)
+    if reference_duration > max_reference_duration:
+        raise RuntimeError('Reference audio duration of {} seconds exceeds max duration of {} seconds for {} inference mode. Please use shorter reference voice.'.format(reference_duration, max_reference_duration, inference_mode))
+    return reference_voice
+
+# Fills in the segment duration if it wasn't specified, since the limit depends on the model and inference mode
+def default_max_segment_duration(args):
+    if args.max_segment_duration is None:
+        if args.vevo_model == '1' and args.inference_mode == 'timbre':
+            args.max_segment_duration = 45.0 # only vevo 1 timbre can take a long segment
+        else:
+            args.max_segment_duration= 12
+
+# State of one input file as it moves through the redub stages
+class RedubJob():
+    def __init__(self, input_filename : str, index = 1):
+        self.input_filename = input_filename
+        self.index = index
+        # Temp files and in-memory audio are named after this so jobs in flight at the same time don't clash
+        self.name = '{}_{}'.format(index, os.path.splitext(os.path.basename(input_filename))[0])
+        self.video_input = None
+        self.uvr_input = None
+        self.vocal_stem = None
+        self.instrumental_stem = None
+        self.vocal_segments = None
+        self.segment_plan = None # Where each vocal segment sits in the vocal stem
+        self.converted_vocals = None
+        self.output_filename = None
+        self.error = None
+        self.manifest = None # JobManifest when resuming
+
+# Settings each stage's output depends on, besides the output of the stages before it
+def get_stage_settings(args, reference_voice : str):
+    return {'separate': [args.skip_uvr, args.stem_format, args.uvr_window, args.uvr_crossfade, args.uvr_preset],
+            'segment': [args.max_segment_duration, args.min_silence_len, args.silence_thresh, args.skip_vad],
+            'convert': [hash_file(reference_voice), args.vevo_model, args.inference_mode, args.steps, args.solver, args.step_schedule, args.input_language, args.ref_language, args.cpu_precision, args.onnx],
+            'recombine': [args.skip_trim],
+            'overlay': [args.instrumental_volume, args.vocal_volume, args.duck_db, args.audio_bitrate],
+            'mux': [args.audio_bitrate]}
+
+# Opens the job's manifest if resuming. A job that already finished with the same settings gets its output filled in, so every stage is skipped.
+def open_manifest(job : RedubJob, args, reference_voice : str):
+    if not args.resume:
+        return
+    job.manifest = JobManifest(get_manifest_filename(job.input_filename, args.out_dir), job.input_filename, get_stage_settings(args, reference_voice))
+    protected_files.update(job.manifest.files())
+    finished = job.manifest.restore('mux')
+    if finished is not None:
+        print('"{}" was already redubbed: {}'.format(job.input_filename, finished['output_filename']))
+        job.output_filename = finished['output_filename']
+
+# Returns the recorded output of a stage if it can be reused, otherwise None
+def restore_stage(job : RedubJob, stage : str):
+    if job.manifest is None:
+        return None
+    data = job.manifest.restore(stage)
+    if data is not None:
+        print('Resuming from the "{}" stage output.'.format(stage))
+    return data
+
+def record_stage(job : RedubJob, stage : str, data : dict, files : list):
+    if job.manifest is not None:
+        job.manifest.record(stage, data, files)
+        protected_files.update(job.manifest.files())
+
+def stage_extract(job : RedubJob, args):
+    print(f'Processing "{job.input_filename}"')
+    input_category, input_mimetype = mimetypes.guess_type(job.input_filename)[0].split('/')
+    job.uvr_input = job.input_filename
+    if input_category == 'video': # The video stream is copied from the original input at the end
+        job.video_input = job.input_filename
+    restored = restore_stage(job, 'extract')
+    if restored is not None:
+        job.uvr_input = restored['uvr_input']
+        if job.uvr_input != job.input_filename:
+            files_to_clean.append(job.uvr_input)
+        return
+    if args.in_memory:
+        print('Decoding audio into memory')
+        job.uvr_input = load_audio_to_memory(job.input_filename, name=job.name)
+    elif input_category == 'video':
+        print('Extracting audio from video')
+        job.uvr_input = extract_audio(job.input_filename, name=job.name)
+        files_to_clean.append(job.uvr_input)
+    record_stage(job, 'extract', {'uvr_input': job.uvr_input}, [job.uvr_input] if job.uvr_input != job.input_filename else [])
+
+def stage_separate(job : RedubJob, args):
+    # Detect if we want to skip the uvr step
+    if args.skip_uvr:
+        job.vocal_stem = job.uvr_input
+    elif args.in_memory:
+        job.vocal_stem, job.instrumental_stem = uvr_separate_memory(job.uvr_input, cache=get_stem_cache(args.stem_cache_size), preset=args.uvr_preset)
+    else:
+        restored = restore_stage(job, 'separate')
+        if restored is not None:
+            job.vocal_stem, job.instrumental_stem = restored['vocal_stem'], restored['instrumental_stem']
+        else:
+            job.vocal_stem, job.instrumental_stem = uvr_separate_cached(job.uvr_input, count=job.index, cache=get_stem_cache(args.stem_cache_size), stem_format=args.stem_format,
+                                                                               window_seconds=args.uvr_window, crossfade_seconds=args.uvr_crossfade, preset=args.uvr_preset)
+            record_stage(job, 'separate', {'vocal_stem': job.vocal_stem, 'instrumental_stem': job.instrumental_stem}, [job.vocal_stem, job.instrumental_stem])
+        files_to_clean.extend([job.vocal_stem, job.instrumental_stem])
+
+def stage_segment(job : RedubJob, args):
+    restored = restore_stage(job, 'segment')
+    if restored is not None:
+        job.vocal_segments = restored['vocal_segments']
+        job.segment_plan = [PlannedSegment(start_ms, end_ms, None, over_max, voice_start_ms, voice_end_ms, voiced) for start_ms, end_ms, over_max, voice_start_ms, voice_end_ms, voiced in restored['segment_plan']]
+    else:
+        job.vocal_segments, job.segment_plan = prepare_vocal_segments(job.vocal_stem, args.max_segment_duration, args.min_silence_len, args.silence_thresh, in_memory = args.in_memory, vad = not args.skip_vad)
+        # Plain ints and bools, the manifest is JSON
+        segment_plan = [[int(planned.start_ms), int(planned.end_ms), bool(planned.over_max), int(planned.voice_start_ms), int(planned.voice_end_ms), bool(planned.voiced)] for planned in job.segment_plan]
+        record_stage(job, 'segment', {'vocal_segments': job.vocal_segments, 'segment_plan': segment_plan}, [segment for segment in job.vocal_segments if segment is not None])
+    voiced_segments = [segment for segment in job.vocal_segments if segment is not None]
+    files_to_clean.extend(voiced_segments)
+    print('Total segments to process: {}'.format(len(voiced_segments)))
+
+def stage_convert(job : RedubJob, args, reference_voice : str):
+    voiced_segments = [segment for segment in job.vocal_segments if segment is not None] # Silent segments are never converted
+    # When resuming, only the segments without a valid converted output are run through vevo
+    converted = {}
+    if job.manifest is not None:
+        for segment in voiced_segments:
+            output = job.manifest.restore_segment(segment)
+            if output is not None:
+                converted[segment] = output
+        if len(converted) > 0:
+            print('Resuming with {} of {} segments already converted.'.format(len(converted), len(voiced_segments)))
+    resumed = len(converted)
+    # Each segment is recorded as soon as it's done, so a crash only loses the segments in flight
+    def on_output(segment, output):
+        if job.manifest is not None:
+            job.manifest.record_segment(segment, output)
+            protected_files.add(output)
+    # Vevo 1.5 style and voice modes condition on transcripts. The whole vocal stem is transcribed once and sliced at the segments.
+    transcripts = {}
+    if args.vevo_model == '1.5' and args.inference_mode != 'timbre' and len(converted) < len(voiced_segments):
+        from vevosing_cli import slice_transcript, transcribe_words
+        words = transcribe_words(job.vocal_stem, hash_decoded_audio(job.vocal_stem), args.input_language, args.whisper_device)
+        transcripts = {segment: slice_transcript(words, planned.voice_start_ms, planned.voice_end_ms) for segment, planned in zip(job.vocal_segments, job.segment_plan) if segment is not None}
+    # Identical segments, i.e. a repeated chorus, are converted once. The rest are looked up in the cache.
+    conversion_key = get_conversion_key(args, reference_voice)
+    segment_keys = {segment: hash_key(conversion_key, hash_segment(segment), transcripts.get(segment, '')) for segment in voiced_segments if segment not in converted}
+    first_with_key = {}
+    duplicates = {}
+    for segment, key in segment_keys.items():
+        if key in first_with_key:
+            duplicates[segment] = first_with_key[key]
+        else:
+            first_with_key[key] = segment
+    cache = get_segment_cache(args.segment_cache_size)
+    cache_key = lambda segment: hash_key(segment_keys[segment], 'arrays' if args.in_memory else 'files')
+    if cache is not None:
+        for segment in first_with_key.values():
+            output = restore_converted(cache, cache_key(segment), segment, reference_voice, in_memory = args.in_memory)
+            if output is not None:
+                converted[segment] = output
+                on_output(segment, output)
+    remaining = [idx for idx, segment in enumerate(job.vocal_segments) if segment is not None and segment not in converted and segment not in duplicates]
+    remaining_segments = [job.vocal_segments[idx] for idx in remaining]
+    def on_converted(segment, output):
+        if cache is not None:
+            store_converted(cache, cache_key(segment), output)
+        on_output(segment, output)
+    outputs = []
+    if len(remaining_segments) > 0 and args.workers > 1:
+        import segment_workers
+        if args.batch_size > 1:
+            print('Warning: --batch_size is ignored with --workers, each worker converts one segment at a time.')
+        if args.vevo_model == '1.5' and args.inference_mode != 'timbre': # So the workers don't each load whisper for it
+            from vevosing_cli import transcribe_reference
+            transcribe_reference(reference_voice, args.ref_language, args.whisper_device)
+        outputs = segment_workers.convert_segments(remaining_segments,
+                                                   reference_voice,
+                                                   args.workers,
+                                                   {'vevo_model': args.vevo_model, 'cpu_precision': args.cpu_precision, 'onnx': args.onnx},
+                                                   {'inference_mode': args.inference_mode, 'steps': args.steps, 'solver': args.solver, 'schedule': args.step_schedule,
+                                                    'src_language': args.input_language, 'ref_language': args.ref_language},
+                                                   seeds = remaining, # Same seeds as an uninterrupted run
+                                                   transcripts = [transcripts.get(segment) for segment in remaining_segments],
+                                                   in_memory = args.in_memory,
+                                                   on_output = on_converted)
+    elif len(remaining_segments) > 0 and args.vevo_model == '1':
+        from vevo_cli import vevo_infer
+        outputs = vevo_infer(remaining_segments,
+                             reference_voice,
+                             inference_mode=args.inference_mode,
+                             flow_matching_steps = args.steps,
+                             batch_size = args.batch_size,
+                             max_batch_frames = args.max_batch_frames,
+                             in_memory = args.in_memory,
+                             seeds = remaining, # Same seeds as an uninterrupted run
+                             on_output = on_converted,
+                             solver = args.solver,
+                             schedule = args.step_schedule)
+    elif len(remaining_segments) > 0 and args.vevo_model == '1.5':
+        from vevosing_cli import vevosing_infer
+        outputs = vevosing_infer(remaining_segments,
+                                 reference_voice,
+                                 inference_mode=args.inference_mode,
+                                 flow_matching_steps = args.steps,
+                                 src_language = args.input_language,
+                                 ref_language = args.ref_language,
+                                 in_memory = args.in_memory,
+                                 on_output = on_converted,
+                                 content_transcripts = [transcripts.get(segment) for segment in remaining_segments],
+                                 whisper_device = args.whisper_device,
+                                 solver = args.solver,
+                                 schedule = args.step_schedule)
+    converted.update(zip(remaining_segments, outputs))
+    for segment, original in duplicates.items():
+        converted[segment] = copy_converted(converted[original], segment, reference_voice)
+        on_output(segment, converted[segment])
+    if len(duplicates) > 0:
+        print('Reused the conversion of {} duplicate segments.'.format(len(duplicates)))
+    if cache is not None:
+        print('Converted segment cache: {} hits, {} misses.'.format(cache.hits, cache.misses))
+    job.converted_vocals = [converted[segment] if segment is not None else None for segment in job.vocal_segments]
+    if resumed < len(voiced_segments): # The recombined vocals are out of date
+        record_stage(job, 'convert', {}, [])
+    files_to_clean.extend(converted.values())
+
+# Muxes the final audio with the video, or saves it as mp3 for audio inputs. Returns the output filename.
+def write_output(input_filename : str, video_input, recombined_audio : str, inference_mode : str, audio_bitrate : int, out_dir = None):
+    if video_input is not None:
+        recombined_video = combine_audio_and_video(video_input, recombined_audio, audio_bitrate)
+        split = os.path.splitext(os.path.basename(input_filename))
+        output_filename = f'{split[0]}_(Redub-{inference_mode}){split[-1]}'
+        if out_dir is not None:
+            output_filename = change_file_directory(output_filename, out_dir)
+        shutil.move(recombined_video, output_filename)
+    else:
+        basename = os.path.splitext(os.path.basename(input_filename))[0]
+        output_filename = f'{basename}_(Redub-{inference_mode}).mp3'
+        if out_dir is not None:
+            output_filename = change_file_directory(output_filename, out_dir)
+        if os.path.splitext(recombined_audio)[-1] == '.mp3' and not audio_buffers.is_memory_audio(recombined_audio):
+            shutil.move(recombined_audio, output_filename)
+        else: # In-memory audio, or the lossless recombined vocals if uvr was skipped
+            export_audio(recombined_audio, output_filename, 'mp3', '{}k'.format(audio_bitrate))
+    print('Output file: {}'.format(output_filename))
+    return output_filename
+
+# Recombines the converted vocals, overlays the instrumental and muxes the result
+def stage_finish(job : RedubJob, args):
+    restored = restore_stage(job, 'recombine')
+    if restored is not None:
+        reassembled_vocals = restored['reassembled_vocals']
+    else:
+        reassembled_vocals = recombine_segments(job.name, job.converted_vocals, job.segment_plan, not args.skip_trim, in_memory = args.in_memory)
+        record_stage(job, 'recombine', {'reassembled_vocals': reassembled_vocals}, [reassembled_vocals])
+    files_to_clean.append(reassembled_vocals)
+
+    # If uvr was skipped, we don't have to overlay the vocal + instrumental stems
+    recombined_audio = None
+    if not args.skip_uvr:
+        restored = restore_stage(job, 'overlay')
+        if restored is not None:
+            recombined_audio = restored['recombined_audio']
+        else:
+            recombined_audio = overlay_stems(job.name, reassembled_vocals, job.instrumental_stem, args.instrumental_volume, args.vocal_volume, args.audio_bitrate, in_memory = args.in_memory, duck_db = args.duck_db)
+            record_stage(job, 'overlay', {'recombined_audio': recombined_audio}, [recombined_audio])
+    else:
+        recombined_audio = reassembled_vocals
+    
+    if job.video_input is not None:
+        files_to_clean.append(recombined_audio)
+    output_filename = write_output(job.input_filename, job.video_input, recombined_audio, args.inference_mode, args.audio_bitrate, args.out_dir)
+    if args.keep_workspace:
+        save_workspace(job.input_filename, args.out_dir, reassembled_vocals, job.instrumental_stem if not args.skip_uvr else None, job.video_input, args.inference_mode)
+    job.output_filename = output_filename
+    if job.manifest is not None:
+        # The job is done, so its temp files can be cleaned up. The manifest stays to skip the job on the next run.
+        record_stage(job, 'mux', {'output_filename': output_filename}, [output_filename])
+        protected_files.difference_update(job.manifest.files())
+    # The output is written, so the job's in-memory audio isn't needed anymore. Other jobs in a batch may still be running.
+    audio_buffers.release(job.name)
+
+# Stages do nothing for a job that already has its output, i.e. one that was found finished in its manifest
+def unless_finished(stage_func):
+    def run(job : RedubJob):
+        if job.output_filename is None:
+            stage_func(job)
+    return run
+
+def get_stages(args, reference_voice : str):
+    accelerator_lock = threading.Lock() # UVR and Vevo take turns on the GPU
+    return [Stage('extract', unless_finished(lambda job: stage_extract(job, args)), workers=args.extract_workers),
+            Stage('separate', unless_finished(lambda job: stage_separate(job, args)), lock=accelerator_lock),
+            Stage('segment', unless_finished(lambda job: stage_segment(job, args)), workers=args.segment_workers),
+            Stage('convert', unless_finished(lambda job: stage_convert(job, args, reference_voice)), lock=accelerator_lock),
+            Stage('finish', unless_finished(lambda job: stage_finish(job, args)), workers=args.finish_workers)]
+
+# Runs the full redub on one input file and returns the output filename
+def redub_file(input_filename : str, reference_voice : str, args, index = 1):
+    job = RedubJob(input_filename, index)
+    open_manifest(job, args, reference_voice)
+    try:
+        for stage in get_stages(args, reference_voice):
+            stage.func(job)
+    finally:
+        audio_buffers.release(job.name)
+    return job.output_filename
+
+# Runs several files through the stages at once, so i.e. the next file is extracted and segmented while the current one is in Vevo.
+# Returns the finished jobs in input order.
+def redub_files_pipelined(input_filenames : list, reference_voice : str, args):
+    jobs = [RedubJob(input_filename, idx + 1) for idx, input_filename in enumerate(input_filenames)]
+    for job in jobs:
+        open_manifest(job, args, reference_voice)
+    pipeline = StagePipeline(get_stages(args, reference_voice), queue_size=args.queue_size)
+    jobs = pipeline.run(jobs)
+    failed = [job for job in jobs if job.error is not None]
+    if len(failed) > 0:
+        print('{} of {} files failed:'.format(len(failed), len(jobs)))
+        for job in failed:
+            print('  "{}": {}'.format(job.input_filename, job.error))
+    return jobs
+
+# Redoes only the overlay and mux of a file redubbed with --keep_workspace, using the mix settings in args
+def remix_file(input_filename : str, args):
+    workspace = load_workspace(input_filename, args.out_dir)
+    print(f'Remixing "{input_filename}"')
+    if workspace['instrumental'] is not None:
+        name = os.path.splitext(os.path.basename(input_filename))[0]
+        recombined_audio = overlay_stems(name, workspace['vocals'], workspace['instrumental'], args.instrumental_volume, args.vocal_volume, args.audio_bitrate, duck_db = args.duck_db)
+        files_to_clean.append(recombined_audio)
+    else: # UVR was skipped, there's nothing to mix
+        recombined_audio = workspace['vocals']
+    return write_output(input_filename, workspace['video_input'], recombined_audio, workspace['inference_mode'], args.audio_bitrate, args.out_dir)
+
+def build_remix_parser():
+    parser = argparse.ArgumentParser(
+        prog='redubber.py remix',
+        description='Redoes the final mix of files redubbed with --keep_workspace, without running UVR or Vevo again.')
+    parser.add_argument('inputs', type=str, nargs='+', help='The original inputs that were redubbed')
+    parser.add_argument('-o', '--out_dir', type=str, help='Output directory the inputs were redubbed to, if any')
+    parser.add_argument('-k', '--keep_temp_files', action='store_true', help='Keep intermediate temp files')
+    add_mix_arguments(parser)
+    return parser
+
+if __name__ == '__main__' and len(sys.argv) > 1 and sys.argv[1] == 'remix':
     try:
         signal.signal(signal.SIGINT, signal_handler)
-        parser = argparse.ArgumentParser(
-            prog='Redubber',
-            description='Redubs audio or video using a reference voice.',
-            epilog='Specify the inputs on the command-line. Use -i and -v to explicitly specify input type if context specific parsing fails.')
-        parser.add_argument('-i', '--input', type=str, help='Input video or audio to process')
-        parser.add_argument('-d', '--in_dir', type=str, help='Input directory. All found video and audio will be processed.')
-        parser.add_argument('-o', '--out_dir', type=str, help='Output directory to use when batch processing from --in_dir.')
-        parser.add_argument('-k', '--keep_temp_files', action='store_true', help='Keep intermediate temp files')
-        parser.add_argument('-v', '--reference_voice', type=str, help='Voice reference to redub with')
-        parser.add_argument('--audio_bitrate', type=int, default=128, help='Bitrate, in kbps, of the final output audio. Default is 128.')
-        parser.add_argument('--inference_mode', type=str, default='timbre', choices=['timbre','style','voice'], help='Vevo inference type. "style" and "voice" are less reliable but attempt more accurate accents.')
-        parser.add_argument('--instrumental_volume', type=int, default=0, help='Boost (or reduce) volume of the instrumental track, in dB')
-        parser.add_argument('--ref_language', type=str, default='en', choices=['en', 'zh'], help='Reference language (used by whisper transcription for vevo 1.5 style)')
-        parser.add_argument('--input_language', type=str, default='en', choices=['en', 'zh'], help='Source language (used by whisper transcription for vevo 1.5 style)')
-        parser.add_argument('--silence_thresh', type=int, default=-48, help='(in dBFS) anything quieter than this will be considered silence')
-        parser.add_argument('--skip_uvr', action='store_true', help='Skip Ultimate Vocal Remover inference')
-        parser.add_argument('--skip_trim', action='store_true', help='Skip trimming and extending when reassembling output segments. This may cause a desync in the output video.')
-        parser.add_argument('--steps', type=int, default=48, help='Vevo flow matching steps.')
-        parser.add_argument('--max_segment_duration', type=float, help='Maximum vocal segment duration, in seconds.')
-        parser.add_argument('--min_silence_len', type=int, default=350, help='minimum length (in ms) of silence when splitting vocals into chunks')
-        parser.add_argument('--vevo_model', type=str, default='1', choices=['1', '1.5'], help='Vevo model version, either 1 or 1.5 (a.k.a vevosing)')
-        parser.add_argument('--vocal_volume', type=int, default=0, help='Boost (or reduce) volume of the vocal track, in dB')
-        
+        args = build_remix_parser().parse_args(sys.argv[2:])
+        if args.keep_temp_files:
+            do_cleanup = False
+        for input_filename in args.inputs:
+            remix_file(input_filename, args)
+    except Exception:
+        print(traceback.format_exc())
+    cleanup()
+elif __name__ == '__main__':
+    try:
+        signal.signal(signal.SIGINT, signal_handler)
+        parser = build_parser()
         args, unknown_args = parser.parse_known_args()
         if help in args:
             parser.print_help()
@@ -284,20 +841,13 @@ if __name__ == '__main__':
         if args.reference_voice is None:
             raise RuntimeError('Reference voice sample required.')
         else: # Convert specified reference to wav if necessary
-            reference_voice = get_wav(args.reference_voice)
+            reference_voice = prepare_reference_voice(args.reference_voice, args.vevo_model, args.inference_mode)
         
-        # Assert appropriate reference audio duration depending on inference mode
-        reference_duration = get_audio_duration(reference_voice)
-        # 45 seconds for vevo 1 timbre, 15 seconds for vevo 1 voice, 30 seconds for vevo 1.5 across all modes
-        max_reference_duration = 45.0 if args.vevo_model == '1' and args.inference_mode == 'timbre' else (15.0 if args.vevo_model == '1' else 30.0)
-        if reference_duration > max_reference_duration:
-            raise RuntimeError('Reference audio duration of {} seconds exceeds max duration of {} seconds for {} inference mode. Please use shorter reference voice.'.format(reference_duration, max_reference_duration, args.inference_mode))
-        
-        if args.max_segment_duration is None:
-            if args.vevo_model == '1' and args.inference_mode == 'timbre':
-                args.max_segment_duration = 45.0 # only vevo 1 timbre can take a long segment
-            else:
-                args.max_segment_duration= 12
+        default_max_segment_duration(args)
+        cpu_inference.configure(args.cpu_precision, args.cpu_threads, args.cpu_interop_threads)
+        onnx_inference.configure(args.onnx)
+        if args.resume and args.in_memory:
+            raise RuntimeError("--resume can't be used with --in_memory, there are no intermediate files to resume from.")
         
         # If --in_dir was specified, add all files
         if args.in_dir is not None:
@@ -314,71 +864,15 @@ if __name__ == '__main__':
                 args.out_dir = args.in_dir + '.out'
             print(f'Output directory: "{args.out_dir}"')
 
-        for input_filename in input_filenames:
-            print(f'Processing "{input_filename}"')
-            input_category, input_mimetype = mimetypes.guess_type(input_filename)[0].split('/')
-            uvr_input = input_filename
-            video_no_audio = None
-            if input_category == 'video':
-                print('Separating audio from video')
-                video_no_audio, audio_no_video = separate_audio_from_video(input_filename)
-                files_to_clean.extend([video_no_audio, audio_no_video])
-                uvr_input = audio_no_video
-            # Detect if we want to skip the uvr step
-            vocal_stem = None
-            intrumental_stem = None
-            if not args.skip_uvr:
-                vocal_stem, intrumental_stem = uvr_separate(uvr_input)
-                files_to_clean.extend([vocal_stem, intrumental_stem])
-            else:
-                vocal_stem = uvr_input
-
-            vocal_segments = prepare_vocal_segments(vocal_stem, args.max_segment_duration, args.min_silence_len, args.silence_thresh)
-            files_to_clean.extend(vocal_segments)
-            print('Total segments to process: {}'.format(len(vocal_segments)))
-            if args.vevo_model == '1':
-                from vevo_cli import vevo_infer
-                coverted_vocals = vevo_infer(vocal_segments, reference_voice, inference_mode=args.inference_mode, flow_matching_steps = args.steps)
-            elif args.vevo_model == '1.5':
-                from vevosing_cli import vevosing_infer
-                coverted_vocals = vevosing_infer(vocal_segments,
-                                                reference_voice,
-                                                inference_mode=args.inference_mode,
-                                                flow_matching_steps = args.steps,
-                                                src_language = args.input_language,
-                                                ref_language = args.ref_language)
-            files_to_clean.extend(coverted_vocals)
-            reassembled_vocals = recombine_segments(uvr_input, coverted_vocals, vocal_segments, not args.skip_trim)
-            files_to_clean.append(reassembled_vocals)
-
-            # If uvr was skipped, we don't have to overlay the vocal + instrumental stems
-            recombined_audio = None
-            if not args.skip_uvr:
-                recombined_audio = overlay_stems(uvr_input, reassembled_vocals, intrumental_stem, args.instrumental_volume, args.vocal_volume, args.audio_bitrate)
-            else:
-                recombined_audio = reassembled_vocals
-            
-            if video_no_audio is not None:
-                files_to_clean.append(recombined_audio)
-                recombined_video = combine_audio_and_video(video_no_audio, recombined_audio, args.audio_bitrate)
-                split = os.path.splitext(os.path.basename(input_filename))
-                output_filename = f'{split[0]}_(Redub-{args.inference_mode}){split[-1]}'
-                if args.out_dir is not None:
-                    output_filename = change_file_directory(output_filename, args.out_dir)
-                shutil.move(recombined_video, output_filename)
-                print('Output file: {}'.format(output_filename))
-            else:
-                basename = os.path.splitext(os.path.basename(input_filename))[0]
-                ext = os.path.splitext(os.path.basename(recombined_audio))[-1]
-                output_filename = f'{basename}_(Redub-{args.inference_mode}){ext}'
-                if args.out_dir is not None:
-                    output_filename = change_file_directory(output_filename, args.out_dir)
-                shutil.move(recombined_audio, output_filename)
-                print('Output file: {}'.format(output_filename))
+        if args.pipeline and len(input_filenames) > 1:
+            redub_files_pipelined(input_filenames, reference_voice, args)
+        else:
+            for idx, input_filename in enumerate(input_filenames):
+                redub_file(input_filename, reference_voice, args, index = idx + 1)
     except argparse.ArgumentError as e:
         print(e)
     except ValueError as e:
         print(e)
     except Exception:
         print(traceback.format_exc())
-    cleanup()
\ No newline at end of file
+    cleanup()
@@ -0,0 +1,148 @@
+# Caches everything the Vevo pipelines compute from the reference voice.
+# The pipelines take the reference as a file path, so every segment re-reads, resamples and re-encodes it.
+# ReferenceCache hooks the pipeline module's load_wav() so the reference is only loaded once,
+# then memoizes the pipeline's feature extractors (content-style tokens, mel prompt, etc.) whenever
+# they're called on the loaded reference tensors. Results are kept in memory and on disk,
+# keyed by the reference file hash and the model version.
+import functools
+import json
+import os
+import sys
+import torch
+import audio_buffers
+from cache_utils import get_cache_dir, hash_file, hash_key
+
+# Pipeline methods that only depend on their input audio. Any that the pipeline doesn't have are skipped.
+FEATURE_METHODS = ['extract_hubert_feature', 'extract_hubert_codec', 'extract_mel_feature', 'extract_prosody_code', 'extract_whisper_feature']
+
+class ReferenceCache():
+    def __init__(self, pipeline, model_version : str):
+        self.pipeline = pipeline
+        self.model_version = model_version
+        self.device = getattr(pipeline, 'device', torch.device('cpu'))
+        self.references = {} # Reference path -> (size and modification time, file hash, loaded audio)
+        self.reference_tensors = {} # id() of a loaded reference tensor -> (file hash, index in the loaded audio)
+        self.features = {} # In-memory feature cache
+        self.hits = 0
+        self.misses = 0
+        self.install()
+
+    def install(self):
+        self.utils_module = sys.modules[type(self.pipeline).__module__]
+        self.original_load_wav = getattr(self.utils_module, 'load_wav', None)
+        if self.original_load_wav is not None:
+            self.utils_module.load_wav = self.load_wav
+        else:
+            print('Warning: pipeline module has no load_wav(), reference features will not be cached.')
+        for method_name in FEATURE_METHODS:
+            method = getattr(self.pipeline, method_name, None)
+            if method is not None:
+                setattr(self.pipeline, method_name, self.wrap_feature_method(method_name, method))
+
+    # Loads the reference once. Later calls with the same path return the same tensors, which is what the feature cache keys on.
+    # A file that was replaced at the same path (a different size or modification time) is hashed and loaded again.
+    def register(self, reference_voice : str):
+        path = os.path.abspath(reference_voice)
+        if self.original_load_wav is None:
+            return path
+        stat = os.stat(path)
+        file_stat = (stat.st_size, stat.st_mtime_ns)
+        reference = self.references.get(path)
+        if reference is not None and reference[0] == file_stat:
+            return path
+        if reference is not None: # The old tensors can't be looked up anymore
+            for item in reference[2]:
+                if torch.is_tensor(item):
+                    self.reference_tensors.pop(id(item), None)
+        file_hash = hash_file(path)
+        loaded = self.original_load_wav(path, self.device)
+        self.references[path] = (file_stat, file_hash, loaded)
+        for idx, item in enumerate(loaded):
+            if torch.is_tensor(item):
+                self.reference_tensors[id(item)] = (file_hash, idx)
+        return path
+
+    def load_wav(self, wav_path, *args, **kwargs):
+        if audio_buffers.is_memory_audio(wav_path): # In-memory segments go through the same hook
+            return audio_buffers.load_wav(wav_path, *args, **kwargs)
+        if isinstance(wav_path, str):
+            reference = self.references.get(os.path.abspath(wav_path))
+            if reference is not None:
+                return reference[2]
+        return self.original_load_wav(wav_path, *args, **kwargs)
+
+    # Describes a non-tensor argument for the cache key. Models are named after the pipeline attribute that holds them.
+    def describe_arg(self, arg):
+        if arg is None or isinstance(arg, (str, int, float, bool)):
+            return repr(arg)
+        for name, value in vars(self.pipeline).items():
+            if value is arg:
+                return name
+        return type(arg).__name__
+
+    def wrap_feature_method(self, method_name : str, method):
+        @functools.wraps(method)
+        def cached_method(*args, **kwargs):
+            reference = None
+            key_parts = [method_name]
+            for arg in list(args) + [kwargs[k] for k in sorted(kwargs)]:
+                if torch.is_tensor(arg) and id(arg) in self.reference_tensors:
+                    reference = self.reference_tensors[id(arg)]
+                    key_parts.append('reference_{}'.format(reference[1]))
+                elif torch.is_tensor(arg): # Some other tensor, can't cache this call
+                    return method(*args, **kwargs)
+                else:
+                    key_parts.append(self.describe_arg(arg))
+            key_parts.extend(sorted(kwargs))
+            if reference is None:
+                return method(*args, **kwargs)
+            return self.get_feature(reference[0], key_parts, lambda: method(*args, **kwargs))
+        return cached_method
+
+    def get_feature(self, file_hash : str, key_parts : list, compute):
+        key = hash_key(self.model_version, file_hash, *key_parts)
+        if key in self.features:
+            self.hits += 1
+            return self.features[key]
+        cache_filename = os.path.join(get_cache_dir('reference', self.model_version, file_hash), '{}_{}.pt'.format(key_parts[0], key[:16]))
+        result = None
+        if os.path.isfile(cache_filename):
+            try:
+                result = torch.load(cache_filename, map_location=self.device)
+                self.hits += 1
+            except Exception as e:
+                print('Warning: Ignoring unreadable cache file {}: {}'.format(cache_filename, e))
+        if result is None:
+            self.misses += 1
+            result = compute()
+            torch.save(move_to_cpu(result), cache_filename)
+        self.features[key] = result
+        return result
+
+    # Transcripts are cached separately since they depend on the whisper model and language, not the vevo model
+    def get_transcript(self, reference_voice : str, language : str, whisper_model_name : str, transcribe):
+        file_hash = hash_file(reference_voice)
+        key = hash_key(whisper_model_name, file_hash, language)
+        if key not in self.features:
+            self.features[key] = load_transcript(file_hash, language, whisper_model_name, transcribe)
+        return self.features[key]
+
+# Reads a reference transcript from the disk cache, or transcribes and caches it. Usable without a loaded pipeline.
+def load_transcript(file_hash : str, language : str, whisper_model_name : str, transcribe):
+    cache_filename = os.path.join(get_cache_dir('reference', whisper_model_name, file_hash), 'transcript_{}.json'.format(language))
+    if os.path.isfile(cache_filename):
+        with open(cache_filename, 'r') as f:
+            return json.load(f)['text']
+    transcript = transcribe()
+    with open(cache_filename, 'w') as f:
+        json.dump({'text': transcript, 'language': language}, f)
+    return transcript
+
+def move_to_cpu(result):
+    if torch.is_tensor(result):
+        return result.detach().cpu()
+    elif isinstance(result, (tuple, list)):
+        return type(result)(move_to_cpu(item) for item in result)
+    elif isinstance(result, dict):
+        return {k: move_to_cpu(v) for k, v in result.items()}
+    return result
@@ -0,0 +1,131 @@
+# Plans where to cut the vocal stem into segments for Vevo.
+# Candidate cut points are the middles of the silences found in the energy envelope. Silences long enough to hold a
+# segment get more candidates near their edges and spread through them. If a stretch of audio
+# longer than the max duration has no candidates, more are added from looser thresholds (shorter, louder silences)
+# until every stretch can be cut or the thresholds run out, the same way the old recursive split loosened them.
+# Then a dynamic program picks which candidates to cut at. It first minimizes the number of segments.
+# Among plans with that many segments, it prefers cuts in long, deep silences found at the strictest thresholds.
+# It also prefers evenly sized segments, because batched segments are padded to the longest one.
+import bisect
+import numpy as np
+from silence import SilenceEnvelope
+
+# Each looser level raises the silence threshold by this many dB and shortens the min silence length by this many ms
+LEVEL_THRESH_STEP = 5
+LEVEL_LENGTH_STEP = 10
+# A cut costs between 0 and 2 within its level, so one cut from a looser level costs more than any from a stricter one
+LEVEL_COST = 3.0
+DEPTH_RANGE_DB = 20.0 # Silence this far below the threshold counts as fully deep
+PADDING_COST = 1.0 # Weight of each segment's squared relative length, which is lowest when segments are even
+VAD_MIN_VOICE_MS = 100 # Segments with less sound than this in total are treated as silence
+VAD_PAD_MS = 250 # Silence kept on either side of the voice when a segment's edges are trimmed
+
+# A place the audio can be cut within a silence, in its middle unless a position is given
+class CutPoint():
+    def __init__(self, silence_start_ms : int, silence_end_ms : int, silence_dbfs : float, level : int, position_ms = None):
+        self.position_ms = position_ms if position_ms is not None else (silence_start_ms + silence_end_ms) // 2
+        self.silence_start_ms = silence_start_ms
+        self.silence_end_ms = silence_end_ms
+        self.silence_dbfs = silence_dbfs
+        self.level = level # 0 for the configured thresholds, higher for looser ones
+
+    def cost(self, min_silence_len : int, silence_thresh : int):
+        length_cost = min(1.0, min_silence_len / max(self.silence_end_ms - self.silence_start_ms, 1))
+        depth_cost = 1.0 - min(max((silence_thresh - self.silence_dbfs) / DEPTH_RANGE_DB, 0.0), 1.0)
+        return self.level * LEVEL_COST + length_cost + depth_cost
+
+# One planned segment, [start_ms, end_ms) of the vocal stem
+class PlannedSegment():
+    def __init__(self, start_ms : int, end_ms : int, end_cut : CutPoint, over_max : bool, voice_start_ms = None, voice_end_ms = None, voiced = True):
+        self.start_ms = start_ms
+        self.end_ms = end_ms
+        self.end_cut = end_cut # The cut that ends this segment, None for the last segment
+        self.over_max = over_max # There's no silence in it to split it under the max duration
+        # The part of the segment that gets converted. Anything outside it, or the whole segment if it isn't voiced, stays silent.
+        self.voice_start_ms = voice_start_ms if voice_start_ms is not None else start_ms
+        self.voice_end_ms = voice_end_ms if voice_end_ms is not None else end_ms
+        self.voiced = voiced
+
+# The cut points in one silence. Besides the middle, a silence that's long compared to min_silence_len can be cut
+# min_silence_len / 2 from either end, and at even steps in between so even a silence longer than max_duration_ms
+# can be cut into pieces under it.
+def silence_cut_points(start : int, end : int, silence_dbfs : float, level : int, min_silence_len : int, max_duration_ms : int):
+    positions = {(start + end) // 2}
+    first, last = start + min_silence_len // 2, end - min_silence_len // 2
+    if last > first:
+        steps = -(-(last - first) // max_duration_ms)
+        positions.update(first + (last - first) * step // steps for step in range(steps + 1))
+    return [CutPoint(start, end, silence_dbfs, level, position) for position in sorted(positions)]
+
+def largest_gap(cut_points : list, length_ms : int):
+    positions = [0] + [cut.position_ms for cut in cut_points] + [length_ms]
+    return max(end - start for start, end in zip(positions, positions[1:]))
+
+# Candidate cut points sorted by position, loosening the thresholds until the audio can be cut under max_duration_ms
+def find_cut_points(envelope : SilenceEnvelope, max_duration_ms : int, min_silence_len : int, silence_thresh : int):
+    cut_points = []
+    silence_starts = [] # Kept alongside cut_points for the overlap check
+    level = 0
+    while min_silence_len - level * LEVEL_LENGTH_STEP >= 1 and silence_thresh + level * LEVEL_THRESH_STEP < 0:
+        level_silence_len = min_silence_len - level * LEVEL_LENGTH_STEP
+        level_silence_thresh = silence_thresh + level * LEVEL_THRESH_STEP
+        for start, end in envelope.detect_silence(0, envelope.length_ms, level_silence_len, level_silence_thresh):
+            cuts = [cut for cut in silence_cut_points(start, end, envelope.range_dbfs(start, end), level, level_silence_len, max_duration_ms)
+                    if 0 < cut.position_ms < envelope.length_ms]
+            if len(cuts) == 0:
+                continue
+            # Looser silences contain the stricter ones, so skip any that overlap a silence already found
+            idx = bisect.bisect_left(silence_starts, start)
+            if idx > 0 and cut_points[idx - 1].silence_end_ms > start:
+                continue
+            if idx < len(cut_points) and cut_points[idx].silence_start_ms < end:
+                continue
+            silence_starts[idx:idx] = [start] * len(cuts)
+            cut_points[idx:idx] = cuts
+        if largest_gap(cut_points, envelope.length_ms) <= max_duration_ms:
+            break
+        level += 1
+    return cut_points
+
+# Picks cut points so every segment is under max_duration (in seconds) where possible. Returns a list of PlannedSegment.
+def plan_segments(envelope : SilenceEnvelope, max_duration : float, min_silence_len : int, silence_thresh : int):
+    max_duration_ms = int(max_duration * 1000)
+    cut_points = find_cut_points(envelope, max_duration_ms, min_silence_len, silence_thresh)
+    positions = np.array([0] + [cut.position_ms for cut in cut_points] + [envelope.length_ms], dtype=np.int64)
+    cut_costs = np.array([0.0] + [cut.cost(min_silence_len, silence_thresh) for cut in cut_points] + [0.0])
+    # Best plan ending at each position: segment count, cost, and the previous position in the plan
+    counts = np.zeros(len(positions), dtype=np.int64)
+    costs = np.zeros(len(positions))
+    previous = np.zeros(len(positions), dtype=np.int64)
+    first_in_range = np.searchsorted(positions, positions - max_duration_ms, side='left')
+    for j in range(1, len(positions)):
+        # Positions within max_duration_ms of this one. If there are none, the segment from the previous position has to run long.
+        candidates = np.arange(min(first_in_range[j], j - 1), j)
+        lengths = (positions[j] - positions[candidates]) / max_duration_ms
+        candidate_counts = counts[candidates] + 1
+        candidate_costs = costs[candidates] + PADDING_COST * lengths ** 2 + cut_costs[j]
+        fewest = candidate_counts == candidate_counts.min()
+        best = np.flatnonzero(fewest)[np.argmin(candidate_costs[fewest])]
+        counts[j] = candidate_counts[best]
+        costs[j] = candidate_costs[best]
+        previous[j] = candidates[best]
+    # Walk back from the end of the audio
+    plan = []
+    j = len(positions) - 1
+    while j > 0:
+        i = previous[j]
+        end_cut = cut_points[j - 1] if j < len(positions) - 1 else None
+        plan.append(PlannedSegment(int(positions[i]), int(positions[j]), end_cut, bool(positions[j] - positions[i] > max_duration_ms)))
+        j = i
+    plan.reverse()
+    return plan
+
+# Voice activity gate. Marks a planned segment as not voiced if it's (nearly) all silence, otherwise narrows its voice
+# range to leave out long silences at either end, keeping VAD_PAD_MS of them so the voice isn't clipped.
+def gate_segment(envelope : SilenceEnvelope, planned : PlannedSegment, min_silence_len : int, silence_thresh : int):
+    voice = envelope.detect_nonsilent(planned.start_ms, planned.end_ms, min_silence_len, silence_thresh)
+    if sum(end - start for start, end in voice) < VAD_MIN_VOICE_MS:
+        planned.voiced = False
+        return
+    planned.voice_start_ms = int(max(planned.start_ms + voice[0][0] - VAD_PAD_MS, planned.start_ms))
+    planned.voice_end_ms = int(min(planned.start_ms + voice[-1][1] + VAD_PAD_MS, planned.end_ms))
@@ -0,0 +1,207 @@
+# Converts vocal segments in several CPU worker processes at once. A single process doesn't scale past a few cores,
+# since the segments are too short for PyTorch's intra-op parallelism to keep many threads busy.
+# Each worker is pinned to its own set of cores, within one NUMA node where the machine has several, loads the
+# pipeline once and takes segments from a shared queue. The pool is kept around between files like the loaded models.
+# Outputs come back in the order the segments were given, whichever worker finished them.
+import multiprocessing
+import os
+import queue
+import traceback
+import audio_buffers
+
+NUMA_NODE_DIR = '/sys/devices/system/node'
+
+# Parses a kernel cpu list like '0-15,32-47'
+def parse_cpu_list(cpu_list : str):
+    cores = []
+    for part in cpu_list.strip().split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            cores.extend(range(int(first), int(last) + 1))
+        elif part != '':
+            cores.append(int(part))
+    return cores
+
+def get_available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+# The available cores grouped by NUMA node, or in one group if the machine doesn't report any nodes
+def get_numa_nodes(available : list):
+    nodes = []
+    if os.path.isdir(NUMA_NODE_DIR):
+        for name in sorted(os.listdir(NUMA_NODE_DIR)):
+            cpulist_filename = os.path.join(NUMA_NODE_DIR, name, 'cpulist')
+            if name.startswith('node') and os.path.isfile(cpulist_filename):
+                with open(cpulist_filename, 'r') as f:
+                    cores = [core for core in parse_cpu_list(f.read()) if core in available]
+                if len(cores) > 0:
+                    nodes.append(cores)
+    return nodes if len(nodes) > 0 else [available]
+
+# Splits the available cores between the workers. Workers are spread over the NUMA nodes in turn and split their
+# node's cores evenly, so a worker's threads and memory stay on one node. Workers share cores if there are too few.
+def get_core_sets(workers : int):
+    nodes = get_numa_nodes(get_available_cores())
+    core_sets = [None] * workers
+    for node_idx, node in enumerate(nodes):
+        node_workers = list(range(node_idx, workers, len(nodes)))
+        cores_per_worker = len(node) // len(node_workers) if len(node_workers) > 0 else 0
+        for idx, worker_idx in enumerate(node_workers):
+            if cores_per_worker > 0:
+                core_sets[worker_idx] = node[idx * cores_per_worker:(idx + 1) * cores_per_worker]
+            else:
+                core_sets[worker_idx] = [node[idx % len(node)]]
+    return core_sets
+
+# Converts one segment with the worker's pipeline. Returns the output filename, or the output key and its samples for in-memory output.
+def convert_segment(settings : dict, task : dict):
+    import torch
+    segment = task['segment']
+    if task['audio'] is not None: # In-memory segments are sent along, the worker has its own memory audio
+        samples, sample_rate = task['audio']
+        audio_buffers.register(segment[len(audio_buffers.MEMORY_PREFIX):], audio_buffers.array_to_segment(samples, sample_rate))
+    # Seeded by the segment's index, so the output doesn't depend on which worker converts it
+    torch.manual_seed(task['seed'])
+    options = task['options']
+    if settings['vevo_model'] == '1':
+        from vevo_cli import vevo_infer
+        output = vevo_infer([segment], task['reference_voice'], inference_mode=options['inference_mode'], flow_matching_steps=options['steps'],
+                            in_memory=task['audio'] is not None, seeds=[task['seed']], solver=options['solver'], schedule=options['schedule'])[0]
+    else:
+        from vevosing_cli import vevosing_infer
+        output = vevosing_infer([segment], task['reference_voice'], inference_mode=options['inference_mode'], flow_matching_steps=options['steps'],
+                                src_language=options['src_language'], ref_language=options['ref_language'], in_memory=task['audio'] is not None,
+                                content_transcripts=[task['transcript']], solver=options['solver'], schedule=options['schedule'])[0]
+    if audio_buffers.is_memory_audio(output):
+        audio_buffers.memory_audio.pop(segment, None)
+        samples, sample_rate = audio_buffers.load_samples(output)
+        audio_buffers.memory_audio.pop(output)
+        return output, samples, sample_rate
+    return output
+
+# Hides the GPU and pins the worker to its cores, in the worker itself so the parent and its other threads are left alone.
+# The parent's main module, and with it torch, is already imported by then, but that doesn't start CUDA or torch's thread
+# pools. They only start on first use, and the pool threads inherit the affinity set here.
+def apply_worker_environment(cores : list):
+    os.environ.update({'CUDA_VISIBLE_DEVICES': '', 'OMP_NUM_THREADS': str(len(cores)), 'MKL_NUM_THREADS': str(len(cores))})
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+
+def worker_main(worker_idx : int, cores : list, settings : dict, task_queue, result_queue):
+    apply_worker_environment(cores)
+    try:
+        import torch
+        import cpu_inference
+        import onnx_inference
+        cpu_inference.configure(settings['cpu_precision'], len(cores), 1)
+        onnx_inference.configure(settings['onnx'])
+        if settings['vevo_model'] == '1':
+            from vevo_cli import get_pipeline
+        else:
+            from vevosing_cli import get_pipeline
+        get_pipeline(torch.device('cpu'))
+    except Exception:
+        result_queue.put((None, None, 'Worker {} could not load vevo:\n{}'.format(worker_idx, traceback.format_exc())))
+        return
+    result_queue.put((None, worker_idx, None))
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        try:
+            result_queue.put((task['idx'], convert_segment(settings, task), None))
+        except Exception:
+            result_queue.put((task['idx'], None, traceback.format_exc()))
+
+class WorkerPool():
+    def __init__(self, workers : int, settings : dict):
+        self.settings = settings
+        context = multiprocessing.get_context('spawn') # Forking a process with torch's thread pools running isn't safe
+        self.task_queue = context.Queue()
+        self.result_queue = context.Queue()
+        self.processes = []
+        for worker_idx, cores in enumerate(get_core_sets(workers)):
+            process = context.Process(target=worker_main, args=(worker_idx, cores, settings, self.task_queue, self.result_queue), daemon=True)
+            process.start()
+            self.processes.append(process)
+            print('Started vevo worker {} on cores {}'.format(worker_idx, ','.join(str(core) for core in cores)))
+        try:
+            for _ in self.processes: # Wait for every worker to load its models, so a load error surfaces here
+                self.get_result()
+        except BaseException:
+            self.close(terminate = True)
+            raise
+
+    # Waits for the next result, checking that the workers are still alive
+    def get_result(self):
+        while True:
+            try:
+                idx, result, error = self.result_queue.get(timeout=5)
+            except queue.Empty:
+                dead = [process for process in self.processes if not process.is_alive()]
+                if len(dead) > 0:
+                    raise RuntimeError('{} vevo worker(s) exited unexpectedly (exit code {}).'.format(len(dead), dead[0].exitcode))
+                continue
+            if error is not None:
+                raise RuntimeError('Vevo worker failed:\n{}'.format(error))
+            return idx, result
+
+    # Lets the workers finish their queued segments unless terminate is set
+    def close(self, terminate = False):
+        for _ in self.processes:
+            self.task_queue.put(None)
+        for process in self.processes:
+            if not terminate:
+                process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+        self.processes = []
+
+# The pool is started on first use and kept for later files unless the settings change
+loaded_pool = None
+def get_pool(workers : int, settings : dict):
+    global loaded_pool
+    if loaded_pool is not None and (len(loaded_pool.processes) != workers or loaded_pool.settings != settings):
+        close_pool()
+    if loaded_pool is None:
+        print('Starting {} vevo workers...'.format(workers))
+        loaded_pool = WorkerPool(workers, settings)
+    return loaded_pool
+
+def close_pool(terminate = False):
+    global loaded_pool
+    if loaded_pool is not None:
+        loaded_pool.close(terminate)
+        loaded_pool = None
+
+# Converts the segments across the worker pool. settings pick the models each worker loads (vevo_model, cpu_precision, onnx),
+# options are the inference options shared by all segments. seeds and transcripts are per segment.
+# on_output is called with each segment and its output as it comes back. Returns the outputs in segment order.
+def convert_segments(voice_segments : list, reference_voice : str, workers : int, settings : dict, options : dict, seeds : list, transcripts = None, in_memory = False, on_output = None):
+    pool = get_pool(workers, settings)
+    print('Converting {} segments with {} workers...'.format(len(voice_segments), workers))
+    for idx, segment in enumerate(voice_segments):
+        pool.task_queue.put({'idx': idx,
+                             'segment': segment,
+                             'audio': audio_buffers.load_samples(segment) if in_memory else None,
+                             'seed': seeds[idx],
+                             'transcript': transcripts[idx] if transcripts is not None else None,
+                             'reference_voice': os.path.abspath(reference_voice),
+                             'options': options})
+    outputs = [None] * len(voice_segments)
+    try:
+        for _ in voice_segments:
+            idx, result = pool.get_result()
+            if in_memory: # Registered under the same key the worker gave it
+                key, samples, sample_rate = result
+                result = audio_buffers.register(key[len(audio_buffers.MEMORY_PREFIX):], audio_buffers.array_to_segment(samples, sample_rate))
+            outputs[idx] = result
+            print('Converted {}/{}: {}'.format(sum(output is not None for output in outputs), len(outputs), result))
+            if on_output is not None:
+                on_output(voice_segments[idx], result)
+    except BaseException:
+        close_pool(terminate = True) # Workers may still be busy with the failed run's segments
+        raise
+    return outputs
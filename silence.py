@@ -0,0 +1,94 @@
+# Vectorized replacement for pydub.silence.
+# pydub computes the rms of every min_silence_len window one millisecond at a time in Python, and
+# every call with new thresholds scans the samples again. SilenceEnvelope computes the signal energy
+# of every millisecond once, then answers any threshold, window length or time range from the
+# cumulative sum of that envelope with NumPy. The results match pydub's detect_silence(),
+# detect_nonsilent() and split_on_silence(keep_silence=True) with the default seek_step of 1 ms.
+import numpy as np
+from pydub import AudioSegment
+
+def db_to_float(db : float):
+    return 10 ** (db / 20)
+
+class SilenceEnvelope():
+    def __init__(self, audio : AudioSegment, block_ms = 60000):
+        self.length_ms = len(audio)
+        self.channels = audio.channels
+        samples = np.frombuffer(audio.raw_data, dtype=np.dtype('<i{}'.format(audio.sample_width))) if audio.sample_width > 1 else np.array(audio.get_array_of_samples())
+        scale = float(audio.max_possible_amplitude)
+        # First frame of every millisecond, the same way pydub converts slice positions to frames
+        frame_count = len(samples) // self.channels
+        self.boundaries = np.minimum((np.arange(self.length_ms + 1) * (audio.frame_rate / 1000.0)).astype(np.int64), frame_count)
+        # Energy of each millisecond, computed in blocks so the squared samples of a long input never exist all at once
+        energy = np.zeros(self.length_ms)
+        for block_start in range(0, self.length_ms, block_ms):
+            block_end = min(block_start + block_ms, self.length_ms)
+            first_frame, last_frame = self.boundaries[block_start], self.boundaries[block_end]
+            block = samples[first_frame * self.channels:last_frame * self.channels].astype(np.float64) / scale
+            cumulative = np.concatenate([[0.0], np.cumsum((block * block).reshape(-1, self.channels).sum(axis=1))])
+            local_boundaries = self.boundaries[block_start:block_end + 1] - first_frame
+            energy[block_start:block_end] = np.diff(cumulative[local_boundaries])
+        self.cumulative_energy = np.concatenate([[0.0], np.cumsum(energy)])
+
+    # Rms of every window of window_ms, for windows starting at each millisecond of [start_ms, end_ms - window_ms]
+    def window_rms(self, start_ms : int, end_ms : int, window_ms : int):
+        window_starts = np.arange(start_ms, end_ms - window_ms + 1)
+        energy = self.cumulative_energy[window_starts + window_ms] - self.cumulative_energy[window_starts]
+        sample_count = (self.boundaries[window_starts + window_ms] - self.boundaries[window_starts]) * self.channels
+        return np.sqrt(energy / np.maximum(sample_count, 1))
+
+    # Same as pydub's detect_silence() on audio[start_ms:end_ms]. Ranges are relative to start_ms.
+    def detect_silence(self, start_ms : int, end_ms : int, min_silence_len : int, silence_thresh : float):
+        end_ms = min(end_ms, self.length_ms)
+        segment_len = end_ms - start_ms
+        if segment_len < min_silence_len or min_silence_len < 1:
+            return []
+        silence_starts = np.flatnonzero(self.window_rms(start_ms, end_ms, min_silence_len) <= db_to_float(silence_thresh))
+        if len(silence_starts) == 0:
+            return []
+        # A new range starts wherever consecutive silent windows are more than one window apart
+        breaks = np.flatnonzero(np.diff(silence_starts) > min_silence_len)
+        range_starts = silence_starts[np.concatenate([[0], breaks + 1])]
+        range_ends = silence_starts[np.concatenate([breaks, [len(silence_starts) - 1]])] + min_silence_len
+        return [[int(start), int(end)] for start, end in zip(range_starts, range_ends)]
+
+    # Same as pydub's detect_nonsilent() on audio[start_ms:end_ms]. Ranges are relative to start_ms.
+    def detect_nonsilent(self, start_ms : int, end_ms : int, min_silence_len : int, silence_thresh : float):
+        end_ms = min(end_ms, self.length_ms)
+        segment_len = end_ms - start_ms
+        silent_ranges = self.detect_silence(start_ms, end_ms, min_silence_len, silence_thresh)
+        if not silent_ranges:
+            return [[0, segment_len]]
+        if silent_ranges[0][0] == 0 and silent_ranges[0][1] == segment_len:
+            return []
+        prev_end = 0
+        nonsilent_ranges = []
+        for silence_start, silence_end in silent_ranges:
+            nonsilent_ranges.append([prev_end, silence_start])
+            prev_end = silence_end
+        if silent_ranges[-1][1] != segment_len:
+            nonsilent_ranges.append([prev_end, segment_len])
+        if nonsilent_ranges[0] == [0, 0]:
+            nonsilent_ranges.pop(0)
+        return nonsilent_ranges
+
+    # Same as pydub's split_on_silence(keep_silence=True) on audio[start_ms:end_ms], but returns absolute
+    # [start, end] ranges in ms instead of audio. Chunks are cut halfway through each silence.
+    def split_on_silence(self, start_ms : int, end_ms : int, min_silence_len : int, silence_thresh : float):
+        end_ms = min(end_ms, self.length_ms)
+        segment_len = end_ms - start_ms
+        output_ranges = [[start - segment_len, end + segment_len] for start, end in self.detect_nonsilent(start_ms, end_ms, min_silence_len, silence_thresh)]
+        for range_i, range_ii in zip(output_ranges, output_ranges[1:]):
+            if range_ii[0] < range_i[1]:
+                range_i[1] = (range_i[1] + range_ii[0]) // 2
+                range_ii[0] = range_i[1]
+        return [[start_ms + max(start, 0), start_ms + min(end, segment_len)] for start, end in output_ranges]
+
+    # Loudness of audio[start_ms:end_ms] in dBFS, like AudioSegment.dBFS
+    def range_dbfs(self, start_ms : int, end_ms : int):
+        end_ms = min(end_ms, self.length_ms)
+        energy = self.cumulative_energy[end_ms] - self.cumulative_energy[start_ms]
+        sample_count = (self.boundaries[end_ms] - self.boundaries[start_ms]) * self.channels
+        if energy <= 0 or sample_count == 0:
+            return -float('inf')
+        return 10 * np.log10(energy / sample_count)
@@ -0,0 +1,79 @@
+# Runs jobs through a sequence of stages connected by bounded queues, so different jobs can be in
+# different stages at the same time. Each stage has its own worker threads. Stages that share a lock
+# never run at the same time, which is how the model stages take turns on the accelerator.
+# A job that fails in one stage skips the rest and comes out the other end with its error set.
+import queue
+import threading
+import traceback
+
+class Stage():
+    def __init__(self, name : str, func, workers = 1, lock = None):
+        self.name = name
+        self.func = func # Called with the job, modifies it in place
+        self.workers = workers
+        self.lock = lock
+
+class StagePipeline():
+    def __init__(self, stages : list, queue_size = 1):
+        # A stage without workers, or a queue without room, would never let a job through
+        if queue_size < 1 or any(stage.workers < 1 for stage in stages):
+            raise RuntimeError('Pipeline stages need at least 1 worker and a queue size of at least 1.')
+        self.stages = stages
+        self.queue_size = queue_size
+
+    def run_stage(self, stage : Stage, job):
+        if stage.lock is not None:
+            with stage.lock:
+                stage.func(job)
+        else:
+            stage.func(job)
+
+    def worker(self, stage : Stage, in_queue : queue.Queue, out_queue : queue.Queue, remaining : list, remaining_lock : threading.Lock, next_workers : int):
+        while True:
+            job = in_queue.get()
+            if job is None:
+                break
+            if job.error is None:
+                try:
+                    self.run_stage(stage, job)
+                except Exception as e:
+                    print(traceback.format_exc())
+                    print('Stage "{}" failed for "{}"'.format(stage.name, job.input_filename))
+                    job.error = e
+            out_queue.put(job)
+        # The last worker of a stage to finish tells every worker of the next stage to stop
+        with remaining_lock:
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                for _ in range(next_workers):
+                    out_queue.put(None)
+
+    # Runs all jobs through every stage and returns them in their original order
+    def run(self, jobs : list):
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        queues.append(queue.Queue()) # Finished jobs, unbounded so the last stage never blocks
+        threads = []
+        for idx, stage in enumerate(self.stages):
+            next_workers = self.stages[idx + 1].workers if idx + 1 < len(self.stages) else 1
+            remaining = [stage.workers]
+            remaining_lock = threading.Lock()
+            for _ in range(stage.workers):
+                thread = threading.Thread(target=self.worker, args=(stage, queues[idx], queues[idx + 1], remaining, remaining_lock, next_workers), daemon=True)
+                thread.start()
+                threads.append(thread)
+        # Feed jobs from a separate thread since the first queue is bounded
+        def feed():
+            for job in jobs:
+                queues[0].put(job)
+            for _ in range(self.stages[0].workers):
+                queues[0].put(None)
+        threading.Thread(target=feed, daemon=True).start()
+        finished = []
+        while True:
+            job = queues[-1].get()
+            if job is None:
+                break
+            finished.append(job)
+        for thread in threads:
+            thread.join()
+        return sorted(finished, key=lambda job: job.index)
@@ -0,0 +1,107 @@
+# Content-addressed cache of separated stems.
+# UVR output only depends on the input audio and the separation settings, so redubbing the same source
+# again (i.e. with another reference voice or inference mode) can skip separation entirely.
+# Converted vocal segments are cached the same way, with one stem per entry.
+# Each entry is a directory named after its key, holding one file per stem. The entry's index file is touched
+# whenever it's used, and the least recently used entries are deleted when the cache grows past max_bytes.
+import json
+import os
+import shutil
+import time
+import numpy as np
+
+ENTRY_INDEX = 'entry.json'
+
+class StemCache():
+    def __init__(self, cache_dir : str, max_bytes : int, label = 'stems'):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.label = label # What's cached, for messages
+        self.hits = 0
+        self.misses = 0
+
+    def entry_dir(self, key : str):
+        return os.path.join(self.cache_dir, key)
+
+    # Returns a dict of stem name to cached filename, or None on a miss
+    def get(self, key : str):
+        index_filename = os.path.join(self.entry_dir(key), ENTRY_INDEX)
+        try:
+            with open(index_filename, 'r') as f:
+                entry = json.load(f)
+            stems = {name: os.path.join(self.entry_dir(key), filename) for name, filename in entry['stems'].items()}
+        except Exception:
+            self.misses += 1
+            return None
+        if not all(os.path.isfile(filename) for filename in stems.values()):
+            self.misses += 1
+            return None
+        os.utime(index_filename) # Mark as recently used
+        self.hits += 1
+        return stems
+
+    # Copies the cached stems to the given filenames. Returns False on a miss.
+    # They're copied rather than linked so nothing that later writes to those filenames can change the cache.
+    def get_files(self, key : str, destinations : dict):
+        stems = self.get(key)
+        if stems is None:
+            return False
+        for name, destination in destinations.items():
+            shutil.copyfile(stems[name], destination)
+        return True
+
+    # Loads the cached stems as arrays, or returns None on a miss
+    def get_arrays(self, key : str):
+        stems = self.get(key)
+        if stems is None:
+            return None
+        return {name: np.load(filename) for name, filename in stems.items()}
+
+    # Stores copies of the stem files
+    def put_files(self, key : str, files : dict):
+        staging_dir = self.staging_dir(key)
+        stems = {}
+        for name, filename in files.items():
+            stems[name] = '{}{}'.format(name, os.path.splitext(filename)[-1])
+            shutil.copyfile(filename, os.path.join(staging_dir, stems[name]))
+        self.commit_entry(key, staging_dir, stems)
+
+    def put_arrays(self, key : str, arrays : dict):
+        staging_dir = self.staging_dir(key)
+        stems = {}
+        for name, array in arrays.items():
+            stems[name] = '{}.npy'.format(name)
+            np.save(os.path.join(staging_dir, stems[name]), array)
+        self.commit_entry(key, staging_dir, stems)
+
+    # Entries are written to a staging directory and renamed into place, so a half written entry is never used
+    def staging_dir(self, key : str):
+        staging_dir = os.path.join(self.cache_dir, '{}.tmp{}'.format(key, os.getpid()))
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        os.makedirs(staging_dir)
+        return staging_dir
+
+    def commit_entry(self, key : str, staging_dir : str, stems : dict):
+        with open(os.path.join(staging_dir, ENTRY_INDEX), 'w') as f:
+            json.dump({'stems': stems, 'created': time.time()}, f)
+        shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+        os.rename(staging_dir, self.entry_dir(key))
+        self.evict()
+
+    # Deletes the least recently used entries until the cache fits in max_bytes
+    def evict(self):
+        entries = []
+        total_bytes = 0
+        for key in os.listdir(self.cache_dir):
+            index_filename = os.path.join(self.entry_dir(key), ENTRY_INDEX)
+            if not os.path.isfile(index_filename):
+                continue
+            entry_bytes = sum(entry.stat().st_size for entry in os.scandir(self.entry_dir(key)) if entry.is_file())
+            entries.append((os.path.getmtime(index_filename), entry_bytes, key))
+            total_bytes += entry_bytes
+        for last_used, entry_bytes, key in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            print('Evicting cached {} {}'.format(self.label, key[:16]))
+            shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+            total_bytes -= entry_bytes
@@ -6,20 +6,38 @@
 # from UVR.py was also copied over. uvr_separate() is based on how UVR.py uses separate.
 # This module assumes that it's one directory up from ultimatevocalremovergui
 
+import argparse
 import hashlib
 import json
 import os
 import sys
+import time
 import yaml
+import librosa
+import numpy as np
+import soundfile as sf
+import torch
 from ml_collections import ConfigDict
 from huggingface_hub import hf_hub_download
+from audio_stream import AudioEncoder, AudioReader
+from cache_utils import CACHE_DIR
 # Need to add uvr to module search path
 sys.path.append(os.path.join(os.path.dirname(__file__), 'ultimatevocalremovergui'))
 from ultimatevocalremovergui.gui_data.constants import *
 from ultimatevocalremovergui.separate import (
     SeperateMDXC, clear_gpu_cache
 )
+from ultimatevocalremovergui.lib_v5.tfc_tdf_v3 import TFC_TDF_net
 MDX_MODELS_DIR = './models'
+MDX_MODEL_NAME = 'karafan/MDX23C-8KFFT-InstVoc_HQ.ckpt'
+MODEL_HASH_INDEX = os.path.join(CACHE_DIR, 'model_hashes.json')
+UVR_SAMPLE_RATE = 44100
+STEM_FORMATS = ['wav', 'flac', 'mp3'] # wav is 32 bit PCM, flac is 24 bit, mp3 is what UVR wrote by default
+# Overlap is the number of model chunks that cover each sample. UVR's default of 12 is the quality preset.
+# The batch size comes from the autotune results for this device if there are any, otherwise it's 1.
+UVR_PRESETS = {'fast': {'overlap': 2}, 'balanced': {'overlap': 4}, 'quality': {'overlap': 12}}
+UVR_PRESET_NAMES = list(UVR_PRESETS) + ['tuned'] # tuned uses the fastest overlap and batch size found by autotune
+UVR_TUNING_FILE = os.path.join(CACHE_DIR, 'uvr_tuning.json')
 MDX_HASH_DIR = './ultimatevocalremovergui/models/MDX_Net_Models/model_data'
 MDX_HASH_JSON = os.path.join(MDX_HASH_DIR, 'model_data.json')
 MDX_C_CONFIG_PATH = os.path.join(MDX_HASH_DIR, 'mdx_c_configs')
@@ -365,20 +383,240 @@ def cached_source_callback(process_method, model_name=None):
             sources = value
     return model, sources
 
-def uvr_separate(filename : str, export_path = './', count = 1, cpu_only = False):
-    # Download the model if it's not downloaded yet
-    if not os.path.exists(MDX_MODELS_DIR):
-        os.makedirs(MDX_MODELS_DIR)
-    hf_hub_download(repo_id="SayanoAI/RVC-Studio", repo_type="dataset", filename="karafan/MDX23C-8KFFT-InstVoc_HQ.ckpt", local_dir=MDX_MODELS_DIR)
-    print('Initializing UVR...',end='')
-    model = ModelData(model_name='karafan/MDX23C-8KFFT-InstVoc_HQ.ckpt')
-    if cpu_only:
-        model.is_gpu_conversion = -1
+# ModelData hashes the last 10 MB of the checkpoint every time a process starts, and only remembers it in model_hash_table.
+# The hashes are kept on disk by path, size and mtime, and any that still match are put back in model_hash_table before ModelData looks.
+def load_model_hash_index():
+    if not os.path.isfile(MODEL_HASH_INDEX):
+        return
+    try:
+        with open(MODEL_HASH_INDEX, 'r') as f:
+            index = json.load(f)
+    except Exception as e:
+        print('Warning: Ignoring unreadable model hash index {}: {}'.format(MODEL_HASH_INDEX, e))
+        return
+    for model_path, entry in index.items():
+        if os.path.isfile(model_path):
+            stat = os.stat(model_path)
+            if entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+                model_hash_table[model_path] = entry['hash']
+
+def save_model_hash_index():
+    index = {}
+    for model_path, model_hash in model_hash_table.items():
+        if model_hash and os.path.isfile(model_path):
+            stat = os.stat(model_path)
+            index[model_path] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hash': model_hash}
+    os.makedirs(os.path.dirname(MODEL_HASH_INDEX), exist_ok=True)
+    with open(MODEL_HASH_INDEX, 'w') as f:
+        json.dump(index, f, indent=1)
+
+# Keeps the MDX23C model loaded between files. SeperateMDXC.demix() builds the network and loads the checkpoint on
+# every call, so this holds one copy of the network and runs the same chunked inference with it.
+class MDXCSeparator():
+    def __init__(self, cpu_only = False):
+        self.model_data = get_model_data(cpu_only)
+        self.cpu_only = cpu_only
+        # SeperateMDXC works out the device and inference settings from the model data
+        settings = SeperateMDXC(self.model_data, get_process_data(self.model_data, None, './', 'resident'))
+        self.device = settings.device
+        self.configs = self.model_data.mdx_c_configs
+        self.segment_size = self.configs.inference.dim_t if settings.is_mdx_c_seg_def else settings.mdx_segment_size
+        self.model = TFC_TDF_net(self.configs, device=self.device)
+        self.model.load_state_dict(torch.load(self.model_data.model_path, map_location='cpu'))
+        self.model.to(self.device).eval()
+
+    # Same as SeperateMDXC.demix() without pitch shifting. mix is a (2, samples) float array at 44.1 kHz.
+    # Returns a dict of stem name to (2, samples) float array.
+    # Overlap and batch size are read from the model data every time, so presets can change them between files.
+    @torch.no_grad()
+    def demix(self, mix):
+        overlap = self.model_data.overlap_mdx23
+        batch_size = self.model_data.mdx_batch_size
+        chunk_size = self.configs.audio.hop_length * (self.segment_size - 1)
+        hop_size = chunk_size // overlap
+        mix = torch.tensor(mix, dtype=torch.float32)
+        pad_size = hop_size - (mix.shape[1] - chunk_size) % hop_size
+        mix = torch.cat([torch.zeros(2, chunk_size - hop_size), mix, torch.zeros(2, pad_size + chunk_size - hop_size)], 1)
+        chunks = mix.unfold(1, chunk_size, hop_size).transpose(0, 1)
+        batches = [chunks[i:i + batch_size] for i in range(0, len(chunks), batch_size)]
+        # This model separates both stems, so there's always more than one target instrument
+        estimated = torch.zeros(self.model.num_target_instruments, *mix.shape, device=self.device)
+        cnt = 0
+        for idx, batch in enumerate(batches):
+            print('\r{0:07.4f}% '.format((idx + 1) / len(batches) * 100), end='')
+            for w in self.model(batch.to(self.device)):
+                estimated[..., cnt * hop_size:cnt * hop_size + chunk_size] += w
+                cnt += 1
+        estimated = estimated[..., chunk_size - hop_size:-(pad_size + chunk_size - hop_size)] / overlap
+        return {k: v for k, v in zip(self.configs.training.instruments, estimated.cpu().numpy())}
+
+    # Separates a file and writes each stem straight from the float output to <audio_file_base>_(<stem>).<stem_format>
+    def separate(self, filename : str, export_path : str, audio_file_base : str, stem_format = 'wav'):
+        sources = self.demix(load_mix(filename))
+        print('')
+        for stem, source in sources.items():
+            write_stem(source, os.path.join(export_path, '{}_({}).{}'.format(audio_file_base, stem, stem_format)), stem_format, self.model_data)
+        self.clear_gpu_cache()
+
+    # Separates a file in windows of window_seconds read one at a time, and writes the stems as it goes,
+    # so memory use doesn't depend on the length of the input. Neighbouring windows overlap by
+    # crossfade_seconds and are crossfaded linearly, so the seams don't click.
+    def separate_streaming(self, filename : str, export_path : str, audio_file_base : str, stem_format = 'wav', window_seconds = 60.0, crossfade_seconds = 2.0):
+        window = int(window_seconds * UVR_SAMPLE_RATE)
+        crossfade = int(crossfade_seconds * UVR_SAMPLE_RATE)
+        if crossfade * 2 > window:
+            raise RuntimeError('UVR crossfade of {} seconds is too long for {} second windows.'.format(crossfade_seconds, window_seconds))
+        fade_in = ((np.arange(crossfade) + 0.5) / max(crossfade, 1)).astype(np.float32)
+        reader = AudioReader(filename, UVR_SAMPLE_RATE)
+        writers = {}
+        tails = {} # End of the last window's stems, to be crossfaded with the start of the next window
+        mix = reader.read(window)
+        window_idx = 0
+        while mix.shape[1] > 0:
+            window_idx += 1
+            print('\rWindow {} '.format(window_idx), end='')
+            sources = self.demix(mix)
+            next_block = reader.read(window - crossfade)
+            is_last = next_block.shape[1] == 0
+            for stem, source in sources.items():
+                if stem not in writers:
+                    writers[stem] = StemWriter(os.path.join(export_path, '{}_({}).{}'.format(audio_file_base, stem, stem_format)), stem_format, self.model_data)
+                if stem in tails:
+                    source[:, :crossfade] = tails[stem] * (1.0 - fade_in) + source[:, :crossfade] * fade_in
+                if is_last:
+                    writers[stem].write(source)
+                else:
+                    writers[stem].write(source[:, :source.shape[1] - crossfade])
+                    tails[stem] = source[:, source.shape[1] - crossfade:]
+            if is_last:
+                break
+            mix = np.concatenate([mix[:, mix.shape[1] - crossfade:], next_block], axis=1)
+        print('')
+        reader.close()
+        for writer in writers.values():
+            writer.close()
+        if len(writers) == 0:
+            raise RuntimeError('No audio could be decoded from "{}"'.format(filename))
+        self.clear_gpu_cache()
+
+    def clear_gpu_cache(self):
+        if not self.cpu_only: # Frees UVR's activations for Vevo. The weights stay loaded.
+            print('Clearing GPU Cache.')
+            clear_gpu_cache()
+
+# Loads a file as a (2, samples) float array at the UVR sample rate, the same way UVR's prepare_mix() does
+def load_mix(filename : str):
+    mix, _ = librosa.load(filename, mono=False, sr=UVR_SAMPLE_RATE)
+    if mix.ndim == 1:
+        mix = np.asfortranarray([mix, mix])
+    return mix
+
+# Writes a stem a block at a time. The lossless formats skip the mp3 encode and decode, and the mp3 quality loss before vevo.
+class StemWriter():
+    def __init__(self, filename : str, stem_format : str, model : ModelData):
+        self.filename = filename
+        self.encoder = None
+        self.file = None
+        if stem_format == 'mp3': # Encoded by ffmpeg from a pipe, at the same bitrate UVR used
+            self.encoder = AudioEncoder(filename, UVR_SAMPLE_RATE, 2, ['-b:a', model.mp3_bit_set])
+        elif stem_format == 'wav':
+            self.file = sf.SoundFile(filename, 'w', samplerate=UVR_SAMPLE_RATE, channels=2, subtype=model.wav_type_set)
+        elif stem_format == 'flac':
+            self.file = sf.SoundFile(filename, 'w', samplerate=UVR_SAMPLE_RATE, channels=2, subtype='PCM_24')
+        else:
+            raise RuntimeError("Unsupported stem format '{}'. Use one of {}.".format(stem_format, ', '.join(STEM_FORMATS)))
+
+    # block is a (2, samples) float array
+    def write(self, block):
+        block = np.clip(block, -1.0, 1.0)
+        if self.encoder is not None:
+            self.encoder.write(block)
+        else:
+            self.file.write(block.T)
+
+    def close(self):
+        if self.encoder is not None:
+            self.encoder.close()
+        else:
+            self.file.close()
+
+# Writes a whole (channels, samples) float stem
+def write_stem(source, filename : str, stem_format : str, model : ModelData):
+    writer = StemWriter(filename, stem_format, model)
+    writer.write(source)
+    writer.close()
+
+# ModelData is cheap once the hash is known, so it's loaded separately from the network for things that only need the settings
+loaded_model_data = {}
+def get_model_data(cpu_only = False):
+    if cpu_only not in loaded_model_data:
+        # Download the model if it's not downloaded yet
+        if not os.path.isfile(os.path.join(MDX_MODELS_DIR, MDX_MODEL_NAME)):
+            os.makedirs(MDX_MODELS_DIR, exist_ok=True)
+            hf_hub_download(repo_id="SayanoAI/RVC-Studio", repo_type="dataset", filename=MDX_MODEL_NAME, local_dir=MDX_MODELS_DIR)
+        load_model_hash_index()
+        model = ModelData(model_name=MDX_MODEL_NAME)
+        save_model_hash_index()
+        if cpu_only:
+            model.is_gpu_conversion = -1
+        loaded_model_data[cpu_only] = model
+    return loaded_model_data[cpu_only]
+
+# Autotune results are stored per device, since the best batch size depends on the hardware
+def get_device_key(cpu_only = False):
+    if not cpu_only and torch.cuda.is_available():
+        return 'cuda:{}'.format(torch.cuda.get_device_name(0))
+    return 'cpu:{}:{}'.format(os.cpu_count(), torch.get_num_threads())
+
+def load_tuning(cpu_only = False):
+    if not os.path.isfile(UVR_TUNING_FILE):
+        return None
+    with open(UVR_TUNING_FILE, 'r') as f:
+        return json.load(f).get(get_device_key(cpu_only))
+
+# Sets the overlap and batch size of the model data for one of UVR_PRESET_NAMES
+def set_uvr_preset(preset = 'quality', cpu_only = False):
+    model = get_model_data(cpu_only)
+    tuning = load_tuning(cpu_only)
+    if preset == 'tuned' and tuning is None:
+        print('Warning: UVR hasn\'t been tuned on this device, using the balanced preset. Run "python uvr_cli.py autotune" first.')
+        preset = 'balanced'
+    if preset == 'tuned':
+        model.overlap_mdx23 = tuning['tuned']['overlap']
+        model.mdx_batch_size = tuning['tuned']['batch_size']
+    elif preset in UVR_PRESETS:
+        model.overlap_mdx23 = UVR_PRESETS[preset]['overlap']
+        model.mdx_batch_size = tuning['batch_sizes'].get(str(model.overlap_mdx23), 1) if tuning is not None else 1
+    else:
+        raise RuntimeError("Unknown UVR preset '{}'. Use one of {}.".format(preset, ', '.join(UVR_PRESET_NAMES)))
+    return model
+
+# Everything besides the input audio that changes the separated stems
+def get_separation_key(cpu_only = False, preset = 'quality'):
+    model = set_uvr_preset(preset, cpu_only)
+    return [model.model_hash, model.is_mdx_c_seg_def, model.mdx_segment_size, model.overlap_mdx23, model.mdx_batch_size]
+
+# Filenames that uvr_separate() writes the vocal and instrumental stems to
+def get_stem_filenames(filename : str, export_path = './', count = 1, stem_format = 'wav'):
+    # Note that this won't match if you change the model to something with different stem names, like denoise
     audio_file_base = f"{count}_{os.path.splitext(os.path.basename(filename))[0]}"
+    output_vocal_stem = os.path.join(export_path,'{}_({}).{}'.format(audio_file_base, VOCAL_STEM, stem_format))
+    output_instrumental_stem = os.path.join(export_path, '{}_({}).{}'.format(audio_file_base, INST_STEM, stem_format))
+    return output_vocal_stem, output_instrumental_stem
+
+# The separator is loaded on first use and kept around so batch runs don't reload the model for every file
+loaded_separators = {}
+def get_separator(cpu_only = False):
+    if cpu_only not in loaded_separators:
+        print('Loading UVR model...')
+        loaded_separators[cpu_only] = MDXCSeparator(cpu_only)
+    return loaded_separators[cpu_only]
+
+def get_process_data(model : ModelData, filename : str, export_path : str, audio_file_base : str):
     set_progress_bar = lambda step, inference_iterations=0 : print('\r{0:07.4f}% '.format(inference_iterations / step * 10), end='')
     write_to_console = lambda progress_text, base_text='':print('{} {}'.format(base_text,progress_text),end='')
 
-    process_data = {
+    return {
         'model_data': model, 
         'export_path': export_path,
         'audio_file_base': audio_file_base,
@@ -392,24 +630,136 @@ def uvr_separate(filename : str, export_path = './', count = 1, cpu_only = False
         'is_ensemble_master': False,
         'is_4_stem_ensemble': False}
 
-    seperator = SeperateMDXC(model, process_data)
-    
-    seperator.seperate()
-    if not cpu_only:
-        print('Clearing GPU Cache.')
-        clear_gpu_cache()
-    # Return output filenames of stems (note that this won't match if you change the model to something with different stem names, like denoise)
-    # Also note that save_format is hard-coded to MP3 and mp3_bit_set is hard-coded to 120k
-    # Changing model.save_format to WAV does work and the wav_type_set is hard-coded to PCM_32
-    audio_file_ext = model.save_format.lower()
-    output_vocal_stem = os.path.join(export_path,'{}_(Vocals).{}'.format(audio_file_base,audio_file_ext))
-    output_instrumental_stem = os.path.join(export_path, '{}_(Instrumental).{}'.format(audio_file_base,audio_file_ext))
-    return output_vocal_stem, output_instrumental_stem
+# Separates audio that's already in memory without reading or writing any files.
+# mix is a (2, samples) float array at model.model_samplerate (44.1 kHz).
+# Returns the vocal and instrumental stems as float arrays with the same layout.
+def uvr_separate_array(mix, cpu_only = False, preset = 'quality'):
+    set_uvr_preset(preset, cpu_only)
+    separator = get_separator(cpu_only)
+    print('Running UVR...')
+    sources = separator.demix(mix)
+    print('')
+    separator.clear_gpu_cache()
+    return sources[VOCAL_STEM], sources[INST_STEM]
+
+# Separates a file into vocal and instrumental stems in stem_format (one of STEM_FORMATS) and returns their filenames.
+# If window_seconds is set, the file is streamed through UVR in crossfaded windows of that length instead of loaded whole.
+def uvr_separate(filename : str, export_path = './', count = 1, cpu_only = False, stem_format = 'wav', window_seconds = 0, crossfade_seconds = 2.0, preset = 'quality'):
+    set_uvr_preset(preset, cpu_only)
+    separator = get_separator(cpu_only)
+    print('Running UVR...')
+    audio_file_base = f"{count}_{os.path.splitext(os.path.basename(filename))[0]}"
+    if window_seconds > 0:
+        separator.separate_streaming(filename, export_path, audio_file_base, stem_format, window_seconds, crossfade_seconds)
+    else:
+        separator.separate(filename, export_path, audio_file_base, stem_format)
+    return get_stem_filenames(filename, export_path, count, stem_format)
+
+# Peak memory of the process so far in bytes. On the GPU, the peak allocated by torch since it was last reset.
+def get_peak_memory(device):
+    if str(device).startswith('cuda'):
+        return torch.cuda.max_memory_allocated()
+    try:
+        import resource # Unix only
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return max_rss if sys.platform == 'darwin' else max_rss * 1024 # ru_maxrss is in bytes on macOS and KB on Linux
+    except ImportError:
+        import psutil
+        memory_info = psutil.Process().memory_info()
+        return getattr(memory_info, 'peak_wset', memory_info.rss) # The peak working set on Windows
+
+DEFAULT_CPU_MEMORY_BUDGET = 8 * 1024 ** 3 # If the amount of RAM can't be found out
+def get_default_memory_budget(device):
+    if str(device).startswith('cuda'):
+        return torch.cuda.get_device_properties(0).total_memory * 0.8
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') * 0.5
+    except (AttributeError, ValueError, OSError): # No sysconf on Windows
+        try:
+            import psutil
+            return psutil.virtual_memory().total * 0.5
+        except ImportError:
+            return DEFAULT_CPU_MEMORY_BUDGET
+
+# Times separation of a short clip with every overlap and batch size, and stores the fastest batch size for each overlap
+# that stays within the memory budget, along with the fastest combination overall with at least min_overlap.
+# Batch sizes are tried from smallest to largest, since the CPU peak memory can only be measured for the whole process.
+def autotune(clip_filename = None, clip_seconds = 20.0, memory_budget = None, min_overlap = 2, cpu_only = False, overlaps = (2, 4, 8, 12), batch_sizes = (1, 2, 4, 8, 16)):
+    separator = get_separator(cpu_only)
+    model = separator.model_data
+    if clip_filename is not None:
+        reader = AudioReader(clip_filename, UVR_SAMPLE_RATE)
+        clip = reader.read(int(clip_seconds * UVR_SAMPLE_RATE))
+        reader.close()
+    else: # Noise takes as long to separate as anything else
+        clip = (np.random.default_rng(0).standard_normal((2, int(clip_seconds * UVR_SAMPLE_RATE))) * 0.1).astype(np.float32)
+    clip_seconds = clip.shape[1] / UVR_SAMPLE_RATE
+    if memory_budget is None:
+        memory_budget = get_default_memory_budget(separator.device)
+    print('Tuning UVR on {} with a {:.1f} second clip and a {:.1f} GB memory budget'.format(get_device_key(cpu_only), clip_seconds, memory_budget / 1024 ** 3))
+    model.overlap_mdx23, model.mdx_batch_size = overlaps[0], batch_sizes[0]
+    separator.demix(clip) # Warm up
+    print('')
+    results = []
+    for batch_size in batch_sizes:
+        over_budget = False
+        for overlap in overlaps:
+            model.overlap_mdx23, model.mdx_batch_size = overlap, batch_size
+            if str(separator.device).startswith('cuda'):
+                torch.cuda.reset_peak_memory_stats()
+            try:
+                start_time = time.perf_counter()
+                separator.demix(clip)
+                elapsed = time.perf_counter() - start_time
+            except RuntimeError as e: # Out of memory
+                print('\nOverlap {}, batch size {} failed: {}'.format(overlap, batch_size, e))
+                over_budget = True
+                break
+            peak_memory = get_peak_memory(separator.device)
+            results.append({'overlap': overlap, 'batch_size': batch_size, 'speed': clip_seconds / elapsed, 'peak_memory': peak_memory})
+            print('\rOverlap {:2d}, batch size {:2d}: {:6.2f}x realtime, {:.2f} GB peak'.format(overlap, batch_size, clip_seconds / elapsed, peak_memory / 1024 ** 3))
+            if peak_memory > memory_budget:
+                over_budget = True
+        separator.clear_gpu_cache()
+        if over_budget: # Larger batches only use more memory
+            break
+    within_budget = [result for result in results if result['peak_memory'] <= memory_budget]
+    if len(within_budget) == 0:
+        raise RuntimeError('Nothing fit in the memory budget of {:.1f} GB.'.format(memory_budget / 1024 ** 3))
+    batch_sizes = {}
+    for overlap in overlaps:
+        candidates = [result for result in within_budget if result['overlap'] == overlap]
+        if len(candidates) > 0:
+            batch_sizes[str(overlap)] = max(candidates, key=lambda result: result['speed'])['batch_size']
+    candidates = [result for result in within_budget if result['overlap'] >= min_overlap]
+    tuned = max(candidates if len(candidates) > 0 else within_budget, key=lambda result: result['speed'])
+    tuning = {'batch_sizes': batch_sizes, 'tuned': {'overlap': tuned['overlap'], 'batch_size': tuned['batch_size']}, 'results': results}
+    all_tuning = {}
+    if os.path.isfile(UVR_TUNING_FILE):
+        with open(UVR_TUNING_FILE, 'r') as f:
+            all_tuning = json.load(f)
+    all_tuning[get_device_key(cpu_only)] = tuning
+    os.makedirs(os.path.dirname(UVR_TUNING_FILE), exist_ok=True)
+    with open(UVR_TUNING_FILE, 'w') as f:
+        json.dump(all_tuning, f, indent=1)
+    print('Tuned preset: overlap {}, batch size {} ({:.2f}x realtime)'.format(tuned['overlap'], tuned['batch_size'], tuned['speed']))
+    print('Batch size for each overlap: {}'.format(', '.join('{}: {}'.format(overlap, batch_size) for overlap, batch_size in batch_sizes.items())))
+    return tuning
 
 if __name__ == '__main__':
-    filenames = sys.argv[1:]
-    for idx, filename in enumerate(filenames):
-        print(filename)
-        vocal_stem, instrumental_stem = uvr_separate(filename, count = idx + 1)
-        print(vocal_stem)
-        print(instrumental_stem)
\ No newline at end of file
+    if len(sys.argv) > 1 and sys.argv[1] == 'autotune':
+        parser = argparse.ArgumentParser(prog='uvr_cli.py autotune', description='Finds the fastest UVR overlap and batch size for this device within a memory budget.')
+        parser.add_argument('--clip', type=str, help='Audio to tune with. Default is generated noise.')
+        parser.add_argument('--clip_seconds', type=float, default=20.0, help='Length of the calibration clip, in seconds. Default is 20.')
+        parser.add_argument('--memory_budget', type=float, help='Peak memory budget in GB. Default is half of RAM, or 80%% of GPU memory.')
+        parser.add_argument('--min_overlap', type=int, default=2, help='Lowest overlap the tuned preset can use. Default is 2.')
+        parser.add_argument('--cpu_only', action='store_true', help='Tune CPU separation even if a GPU is available.')
+        args = parser.parse_args(sys.argv[2:])
+        autotune(args.clip, args.clip_seconds, args.memory_budget * 1024 ** 3 if args.memory_budget is not None else None, args.min_overlap, args.cpu_only)
+    else:
+        filenames = sys.argv[1:]
+        for idx, filename in enumerate(filenames):
+            print(filename)
+            vocal_stem, instrumental_stem = uvr_separate(filename, count = idx + 1)
+            print(vocal_stem)
+            print(instrumental_stem)
\ No newline at end of file
@@ -8,40 +8,61 @@ import torch
 sys.path.append('./Amphion') # For importing modules relative to the Amphion directory
 import Amphion.models.vc.vevo.vevo_utils as vevo_utils
 from huggingface_hub import snapshot_download
+from reference_cache import ReferenceCache
+import cpu_inference
+import onnx_inference
+import flow_matching
+from vevo_output import VEVO_SAMPLE_RATE, get_output_filename, store_output
 
 # Do vevo inference based on the provided mode string
 def run_inference(pipeline : vevo_utils.VevoInferencePipeline,
                   mode : str,
                   content : str,
                   ref_timbre : str,
-                  steps : int):
-    if mode == 'style':
-        return pipeline.inference_ar_and_fm(
-            src_wav_path=content,
-            src_text=None,
-            style_ref_wav_path=ref_timbre,
-            timbre_ref_wav_path=content,
-            flow_matching_steps=steps
-        )
-    elif mode == 'voice':
-        return pipeline.inference_ar_and_fm(
-            src_wav_path=content,
-            src_text=None,
-            style_ref_wav_path=ref_timbre,
-            timbre_ref_wav_path=ref_timbre,
-            flow_matching_steps=steps
-        )
-    elif mode == 'timbre':
-        return pipeline.inference_fm(
-            src_wav_path=content,
-            timbre_ref_wav_path=ref_timbre,
-            flow_matching_steps=steps
-        )
-    else:
-        raise RuntimeError("Unrecognized inference mode '{}'. Specify either 'style' or 'timbre'.".format(mode))
+                  steps : int,
+                  solver = 'euler',
+                  schedule = 'uniform'):
+    # The solver is swapped into the pipeline's flow matching for this call only
+    with flow_matching.solver_context(pipeline, solver, schedule):
+        if mode == 'style':
+            return pipeline.inference_ar_and_fm(
+                src_wav_path=content,
+                src_text=None,
+                style_ref_wav_path=ref_timbre,
+                timbre_ref_wav_path=content,
+                flow_matching_steps=steps
+            )
+        elif mode == 'voice':
+            return pipeline.inference_ar_and_fm(
+                src_wav_path=content,
+                src_text=None,
+                style_ref_wav_path=ref_timbre,
+                timbre_ref_wav_path=ref_timbre,
+                flow_matching_steps=steps
+            )
+        elif mode == 'timbre':
+            return pipeline.inference_fm(
+                src_wav_path=content,
+                timbre_ref_wav_path=ref_timbre,
+                flow_matching_steps=steps
+            )
+        else:
+            raise RuntimeError("Unrecognized inference mode '{}'. Specify either 'style' or 'timbre'.".format(mode))
 
-def load_model():
-    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+# The snapshot revision identifies the model weights for the feature and converted segment caches.
+# It's looked up without loading the models, so cached segments can be found before the models are needed.
+model_version = None
+def get_model_version():
+    global model_version
+    if model_version is None:
+        local_dir = snapshot_download(repo_id="amphion/Vevo", repo_type="model", cache_dir="./models/Vevo", allow_patterns=["acoustic_modeling/Vocoder/*"])
+        model_version = 'Vevo-{}'.format(os.path.basename(os.path.normpath(local_dir)))
+    return model_version
+
+# By default the models go on the GPU if there is one
+def load_model(device = None):
+    if device is None:
+        device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
     
     # Content Tokenizer
     local_dir = snapshot_download(
@@ -105,16 +126,105 @@ def load_model():
         vocoder_ckpt_path=vocoder_ckpt_path,
         device=device
     )
-    return pipeline
+    pipeline.model_version = get_model_version()
+    return cpu_inference.optimize_pipeline(onnx_inference.apply_onnx(pipeline))
+
+# The pipeline is loaded on first use and kept around so batch runs don't reload the models for every file
+loaded_pipeline = None
+reference_cache = None
+def get_pipeline(device = None):
+    global loaded_pipeline, reference_cache
+    if loaded_pipeline is None:
+        print('Loading vevo models...')
+        loaded_pipeline = load_model(device)
+        reference_cache = ReferenceCache(loaded_pipeline, loaded_pipeline.model_version)
+    return loaded_pipeline
+
+# Extracts the content-style tokens that the flow matching transformer is conditioned on
+def extract_codecs(pipeline : vevo_utils.VevoInferencePipeline, speech16k):
+    codecs = pipeline.extract_hubert_codec(pipeline.content_style_tokenizer, speech16k, token_type="hubert_codec")
+    return codecs[0] if isinstance(codecs, tuple) else codecs
+
+# Groups segment indices into batches, longest first so segments of similar length share the padding
+def plan_batches(lengths : list, max_batch_size : int, max_batch_frames = None):
+    order = sorted(range(len(lengths)), key=lambda idx: lengths[idx], reverse=True)
+    batches = []
+    current_batch = []
+    for idx in order:
+        padded_frames = lengths[current_batch[0]] * (len(current_batch) + 1) if current_batch else lengths[idx]
+        if current_batch and (len(current_batch) >= max_batch_size or (max_batch_frames is not None and padded_frames > max_batch_frames)):
+            batches.append(current_batch)
+            current_batch = []
+        current_batch.append(idx)
+    if current_batch:
+        batches.append(current_batch)
+    return batches
+
+# Timbre conversion of several segments in one pass of the flow matching transformer.
+# This is VevoInferencePipeline.inference_fm() with the segments padded into one batch.
+# Each segment's output only depends on its seed, so any batch size gives the same result.
+@torch.no_grad()
+def inference_fm_batch(pipeline : vevo_utils.VevoInferencePipeline, src_codecs : list, ref_codecs, prompt_mel, steps : int, seeds : list, solver = 'euler', schedule = 'uniform'):
+    fmt_model = pipeline.fmt_model
+    device = pipeline.device
+    prompt_len = prompt_mel.shape[1]
+    cond_codecs = [torch.cat([ref_codecs, codecs], dim=1) for codecs in src_codecs]
+    target_lengths = [codecs.shape[1] - prompt_len for codecs in cond_codecs]
+    padded_codecs = torch.zeros((len(cond_codecs), max(codecs.shape[1] for codecs in cond_codecs)), dtype=ref_codecs.dtype, device=device)
+    x_mask = torch.zeros((len(cond_codecs), max(target_lengths)), device=device)
+    for idx, codecs in enumerate(cond_codecs):
+        padded_codecs[idx, :codecs.shape[1]] = codecs[0]
+        x_mask[idx, :target_lengths[idx]] = 1
+    cond = fmt_model.cond_emb(padded_codecs)
+    noise = flow_matching.seeded_noise(target_lengths, seeds, fmt_model.mel_dim, prompt_mel.dtype, device)
+    predict_mel_feat = flow_matching.reverse_diffusion(fmt_model, cond, prompt_mel, x_mask, noise, steps, solver=solver, schedule=schedule)
+    # The vocoder runs per segment so padding can't leak into the edges of the audio
+    outputs = []
+    for idx, length in enumerate(target_lengths):
+        outputs.append(pipeline.vocoder_model(predict_mel_feat[idx:idx + 1, :length].transpose(1, 2)).detach().cpu()[0])
+    return outputs
+
+# Batched timbre inference. Segments are tokenized one at a time, then converted in batches of up to
+# batch_size segments or max_batch_frames total padded frames. Segment i uses seeds[i], or i if seeds isn't given.
+def vevo_infer_batched(pipeline : vevo_utils.VevoInferencePipeline, voice_segments : list, reference_path : str, reference_voice : str, flow_matching_steps : int, batch_size : int, max_batch_frames = None, seeds = None, in_memory = False, on_output = None, solver = 'euler', schedule = 'uniform'):
+    if seeds is None:
+        seeds = list(range(len(voice_segments)))
+    _, ref_speech24k, ref_speech16k = vevo_utils.load_wav(reference_path, pipeline.device)
+    ref_codecs = extract_codecs(pipeline, ref_speech16k)
+    prompt_mel = pipeline.extract_mel_feature(ref_speech24k)
+    src_codecs = [extract_codecs(pipeline, vevo_utils.load_wav(segment, pipeline.device)[2]) for segment in voice_segments]
+    outputs = [get_output_filename(segment, reference_voice) for segment in voice_segments]
+    batches = plan_batches([codecs.shape[1] for codecs in src_codecs], batch_size, max_batch_frames)
+    for batch_idx, batch in enumerate(batches):
+        print('Batch {}/{}: {}'.format(batch_idx + 1, len(batches), ', '.join(outputs[idx] for idx in batch)))
+        gen_audios = inference_fm_batch(pipeline, [src_codecs[idx] for idx in batch], ref_codecs, prompt_mel, flow_matching_steps, [seeds[idx] for idx in batch], solver, schedule)
+        for idx, gen_audio in zip(batch, gen_audios):
+            outputs[idx] = store_output(gen_audio, outputs[idx], in_memory, vevo_utils.save_audio)
+            if on_output is not None:
+                on_output(voice_segments[idx], outputs[idx])
+    return outputs
 
-def vevo_infer(voice_segments : list, reference_voice : str, inference_mode = 'timbre', flow_matching_steps = 32):
+# on_output is called with each segment and its output as soon as the segment is converted.
+# solver and schedule pick the flow matching sampler, see flow_matching.py.
+# Segment i is generated from seeds[i], or i if seeds isn't given, so its output is the same at any batch size and
+# when a resumed run converts it on its own. Timbre mode always goes through the batched path, even one at a time.
+def vevo_infer(voice_segments : list, reference_voice : str, inference_mode = 'timbre', flow_matching_steps = 32, batch_size = 1, max_batch_frames = None, in_memory = False, seeds = None, on_output = None, solver = 'euler', schedule = 'uniform'):
     print('Running vevo inference...')
     outputs = []
-    pipeline = load_model()
-    for segment in voice_segments:
-        output_filename = '{}_({}).wav'.format(os.path.splitext(os.path.basename(segment))[0], os.path.splitext(os.path.basename(reference_voice))[0])
+    pipeline = get_pipeline()
+    reference_path = reference_cache.register(reference_voice)
+    if seeds is None:
+        seeds = list(range(len(voice_segments)))
+    if inference_mode == 'timbre':
+        return vevo_infer_batched(pipeline, voice_segments, reference_path, reference_voice, flow_matching_steps, batch_size, max_batch_frames, seeds=seeds, in_memory=in_memory, on_output=on_output, solver=solver, schedule=schedule)
+    elif batch_size > 1:
+        print('Warning: Batched inference is only supported in timbre mode. Converting one segment at a time.')
+    for segment, seed in zip(voice_segments, seeds):
+        output_filename = get_output_filename(segment, reference_voice)
         print(output_filename)
-        gen_audio = run_inference(pipeline, inference_mode, segment, reference_voice, flow_matching_steps)
-        vevo_utils.save_audio(gen_audio, target_sample_rate=48000, output_path=output_filename)
-        outputs.append(output_filename)
-    return outputs
\ No newline at end of file
+        torch.manual_seed(seed)
+        gen_audio = run_inference(pipeline, inference_mode, segment, reference_path, flow_matching_steps, solver, schedule)
+        outputs.append(store_output(gen_audio, output_filename, in_memory, vevo_utils.save_audio))
+        if on_output is not None:
+            on_output(segment, outputs[-1])
+    return outputs
@@ -0,0 +1,19 @@
+# Naming and storing of converted segments, shared by vevo_cli, vevosing_cli and redubber's converted segment cache.
+# Kept free of torch and Amphion imports so redubber can name outputs without loading either.
+import os
+import audio_buffers
+
+VEVO_SAMPLE_RATE = 24000 # The sample rate vevo generates audio at
+OUTPUT_SAMPLE_RATE = 48000 # Output files are resampled to this
+
+# Converted segments are named after the segment and the reference voice, i.e. '1_song_(Vocals)_segment_3_(voice).wav'
+def get_output_filename(segment : str, reference_voice : str):
+    return '{}_({}).wav'.format(os.path.splitext(os.path.basename(segment))[0], os.path.splitext(os.path.basename(reference_voice))[0])
+
+# Registers the generated audio under the output name, or writes it with the pipeline's save_audio.
+# Returns the memory key or the filename.
+def store_output(gen_audio, output_filename : str, in_memory : bool, save_audio):
+    if in_memory:
+        return audio_buffers.register(output_filename, audio_buffers.array_to_segment(gen_audio.numpy(), VEVO_SAMPLE_RATE))
+    save_audio(gen_audio, target_sample_rate=OUTPUT_SAMPLE_RATE, output_path=output_filename)
+    return output_filename
@@ -1,9 +1,16 @@
+import json
 import os
 import sys
 import torch
 sys.path.append('./Amphion') # For importing modules relative to the Amphion directory
 import Amphion.models.svc.vevosing.vevosing_utils as vevosing_utils
 from huggingface_hub import snapshot_download
+from reference_cache import ReferenceCache, load_transcript
+import audio_buffers
+import cpu_inference
+import flow_matching
+from cache_utils import get_cache_dir, hash_file
+from vevo_output import VEVO_SAMPLE_RATE, get_output_filename, store_output
 
 # Do vevo inference based on the provided mode string
 def run_inference(pipeline : vevosing_utils.VevosingInferencePipeline,
@@ -14,44 +21,60 @@ def run_inference(pipeline : vevosing_utils.VevosingInferencePipeline,
                   content_transcript : str = None,
                   content_language = 'en',
                   ref_transcript : str = None,
-                  ref_language = 'en'):
-    if mode == 'voice':
-        return pipeline.inference_ar_and_fm(
-            task="recognition-synthesis",
-            src_wav_path=content,
-            src_text=content_transcript,
-            style_ref_wav_path=content,
-            style_ref_wav_text=content_transcript,
-            src_text_language=content_language,
-            style_ref_wav_text_language=ref_language,
-            timbre_ref_wav_path=ref_timbre,
-            use_style_tokens_as_ar_input=True,
-            flow_matching_steps=steps
-        )
-    elif mode == 'style':
-        return pipeline.inference_ar_and_fm(
-            task="recognition-synthesis",
-            src_wav_path=content,
-            src_text=content_transcript,
-            style_ref_wav_path=ref_timbre,
-            style_ref_wav_text=ref_transcript,
-            src_text_language=content_language,
-            style_ref_wav_text_language=ref_language,
-            timbre_ref_wav_path=ref_timbre,
-            use_style_tokens_as_ar_input=True,
-            flow_matching_steps=steps
-        )
-    elif mode == 'timbre':
-        return pipeline.inference_fm(
-            src_wav_path=content,
-            timbre_ref_wav_path=ref_timbre,
-            flow_matching_steps=steps
-        )
-    else:
-        raise RuntimeError("Unrecognized inference mode '{}'".format(mode))
+                  ref_language = 'en',
+                  solver = 'euler',
+                  schedule = 'uniform'):
+    # The solver is swapped into the pipeline's flow matching for this call only
+    with flow_matching.solver_context(pipeline, solver, schedule):
+        if mode == 'voice':
+            return pipeline.inference_ar_and_fm(
+                task="recognition-synthesis",
+                src_wav_path=content,
+                src_text=content_transcript,
+                style_ref_wav_path=content,
+                style_ref_wav_text=content_transcript,
+                src_text_language=content_language,
+                style_ref_wav_text_language=ref_language,
+                timbre_ref_wav_path=ref_timbre,
+                use_style_tokens_as_ar_input=True,
+                flow_matching_steps=steps
+            )
+        elif mode == 'style':
+            return pipeline.inference_ar_and_fm(
+                task="recognition-synthesis",
+                src_wav_path=content,
+                src_text=content_transcript,
+                style_ref_wav_path=ref_timbre,
+                style_ref_wav_text=ref_transcript,
+                src_text_language=content_language,
+                style_ref_wav_text_language=ref_language,
+                timbre_ref_wav_path=ref_timbre,
+                use_style_tokens_as_ar_input=True,
+                flow_matching_steps=steps
+            )
+        elif mode == 'timbre':
+            return pipeline.inference_fm(
+                src_wav_path=content,
+                timbre_ref_wav_path=ref_timbre,
+                flow_matching_steps=steps
+            )
+        else:
+            raise RuntimeError("Unrecognized inference mode '{}'".format(mode))
 
-def load_model():
-    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+# The snapshot revision identifies the model weights for the feature and converted segment caches.
+# It's looked up without loading the models, so cached segments can be found before the models are needed.
+model_version = None
+def get_model_version():
+    global model_version
+    if model_version is None:
+        local_dir = snapshot_download(repo_id="amphion/Vevo1.5", repo_type="model", cache_dir="./models/Vevo1.5", allow_patterns=["acoustic_modeling/Vocoder/*"])
+        model_version = 'Vevo1.5-{}'.format(os.path.basename(os.path.normpath(local_dir)))
+    return model_version
+
+# By default the models go on the GPU if there is one
+def load_model(device = None):
+    if device is None:
+        device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
     
     # Content Tokenizer
     local_dir = snapshot_download(
@@ -117,38 +140,108 @@ def load_model():
         vocoder_ckpt_path=vocoder_ckpt_path,
         device=device
     )
-    return pipeline
+    pipeline.model_version = get_model_version()
+    return cpu_inference.optimize_pipeline(pipeline)
+
+# Models are loaded on first use and kept around so batch runs don't reload them for every file
+loaded_pipeline = None
+reference_cache = None
+def get_pipeline(device = None):
+    global loaded_pipeline, reference_cache
+    if loaded_pipeline is None:
+        print('Loading vevo 1.5 models...')
+        loaded_pipeline = load_model(device)
+        reference_cache = ReferenceCache(loaded_pipeline, loaded_pipeline.model_version)
+    return loaded_pipeline
+
+WHISPER_MODEL_NAME = "large-v3-turbo"
+loaded_whisper_model = None
+loaded_whisper_device = None
+# device is "cuda" or "cpu". By default whisper runs on the GPU if there is one.
+def get_whisper_model(device = None):
+    global loaded_whisper_model, loaded_whisper_device
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    if loaded_whisper_model is None or loaded_whisper_device != device:
+        print('Loading whisper on {}...'.format(device))
+        import whisper
+        loaded_whisper_model = whisper.load_model(WHISPER_MODEL_NAME, device=device, download_root="./models/whisper")
+        loaded_whisper_device = device
+    return loaded_whisper_model
+
+# Transcribes with the loaded whisper model. Whisper takes 16 kHz samples directly for in-memory audio.
+def transcribe(audio_input : str, language : str, **kwargs):
+    whisper_input = audio_buffers.load_mono(audio_input, 16000) if audio_buffers.is_memory_audio(audio_input) else audio_input
+    return loaded_whisper_model.transcribe(whisper_input, language=language, fp16=loaded_whisper_device == "cuda", **kwargs)
 
-def vevosing_infer(voice_segments : list, reference_voice : str, inference_mode = 'timbre', flow_matching_steps = 32, src_language = 'en', ref_language = 'en'):
+# Transcribes a whole vocal track once with word timestamps, instead of setting up whisper's 30 second window for every segment.
+# Returns a list of [start, end, word] with times in seconds. Cached on disk by the hash of the decoded audio.
+def transcribe_words(audio_input : str, audio_hash : str, language : str, device = None):
+    cache_filename = os.path.join(get_cache_dir('transcripts', WHISPER_MODEL_NAME), '{}_{}.json'.format(audio_hash[:32], language))
+    if os.path.isfile(cache_filename):
+        try:
+            with open(cache_filename, 'r') as f:
+                return json.load(f)['words']
+        except Exception as e:
+            print('Warning: Ignoring unreadable cache file {}: {}'.format(cache_filename, e))
+    get_whisper_model(device)
+    print('Transcribing vocals...')
+    result = transcribe(audio_input, language, word_timestamps=True)
+    words = [[word['start'], word['end'], word['word']] for segment in result['segments'] for word in segment.get('words', [])]
+    with open(cache_filename, 'w') as f:
+        json.dump({'words': words, 'language': language}, f)
+    return words
+
+# Transcribes the reference into the disk cache without loading vevo, i.e. before starting worker processes that would each load whisper
+def transcribe_reference(reference_voice : str, language : str, device = None):
+    def transcribe_file():
+        get_whisper_model(device)
+        return transcribe(reference_voice, language)['text']
+    return load_transcript(hash_file(reference_voice), language, WHISPER_MODEL_NAME, transcribe_file)
+
+# Transcript of [start_ms, end_ms) of the transcribed track, made of the words whose middle falls within it
+def slice_transcript(words : list, start_ms : int, end_ms : int):
+    return ''.join(word for start, end, word in words if start_ms <= (start + end) * 500 < end_ms).strip()
+
+# on_output is called with each segment and its output as soon as the segment is converted.
+# content_transcripts are the transcripts of the segments for style and voice modes, i.e. sliced from transcribe_words().
+# Any that aren't given are transcribed one segment at a time. solver and schedule pick the flow matching sampler, see flow_matching.py.
+def vevosing_infer(voice_segments : list, reference_voice : str, inference_mode = 'timbre', flow_matching_steps = 32, src_language = 'en', ref_language = 'en', in_memory = False, on_output = None, content_transcripts = None, whisper_device = None, solver = 'euler', schedule = 'uniform'):
     print('Running vevo inference...')
     outputs = []
-    pipeline = load_model()
+    pipeline = get_pipeline()
+    reference_path = reference_cache.register(reference_voice)
     ref_transcript = None
     content_transcript = None
     if inference_mode != 'timbre':
-        print('Loading whisper...')
-        import whisper
-        whisper_model = whisper.load_model("large-v3-turbo", device="cuda", download_root="./models/whisper")
+        def transcribe_reference():
+            get_whisper_model(whisper_device)
+            return transcribe(reference_path, ref_language)['text']
         print('Transcribing reference...')
-        ref_result = whisper_model.transcribe(reference_voice, language=ref_language)
-        ref_transcript = ref_result['text']
+        ref_transcript = reference_cache.get_transcript(reference_path, ref_language, WHISPER_MODEL_NAME, transcribe_reference)
         print(ref_transcript)
-    for segment in voice_segments:
-        output_filename = '{}_({}).wav'.format(os.path.splitext(os.path.basename(segment))[0], os.path.splitext(os.path.basename(reference_voice))[0])
+    for idx, segment in enumerate(voice_segments):
+        output_filename = get_output_filename(segment, reference_voice)
         print(output_filename)
         if inference_mode != 'timbre':
-            content_result = whisper_model.transcribe(segment, language=ref_language)
-            content_transcript = content_result['text']
+            if content_transcripts is not None and content_transcripts[idx] is not None:
+                content_transcript = content_transcripts[idx]
+            else:
+                get_whisper_model(whisper_device)
+                content_transcript = transcribe(segment, src_language)['text']
             print(content_transcript)
         gen_audio = run_inference(pipeline,
                                   inference_mode,
                                   segment,
-                                  reference_voice,
+                                  reference_path,
                                   flow_matching_steps,
                                   content_transcript=content_transcript,
                                   content_language=src_language,
                                   ref_transcript=ref_transcript,
-                                  ref_language = ref_language)
-        vevosing_utils.save_audio(gen_audio, target_sample_rate=48000, output_path=output_filename)
-        outputs.append(output_filename)
+                                  ref_language = ref_language,
+                                  solver = solver,
+                                  schedule = schedule)
+        outputs.append(store_output(gen_audio, output_filename, in_memory, vevosing_utils.save_audio))
+        if on_output is not None:
+            on_output(segment, outputs[-1])
     return outputs
\ No newline at end of file